@@ -0,0 +1,89 @@
+import argparse
+import json
+import multiprocessing
+import sys
+from columnar import DEFAULT_COLUMNAR_PATH
+from snf_search import QueryError, SearchContext, add_metric_arguments, get_fields, get_weighted_metrics, parse_query
+
+# The context shared by every worker. It is loaded before the worker pool is created, so forked
+# workers inherit it copy-on-write rather than each loading or unpickling their own copy.
+context = None
+# The attributes of each result written, or None for all of them
+fields = None
+
+def run_query(line):
+    """Runs the search described by a single line of JSON, returning a line of JSON with its query and results."""
+    try:
+        spec = json.loads(line)
+    except ValueError as e:
+        return json.dumps({ "query": line.strip(), "error": str(e) })
+    try:
+        # per_anchor isn't a search parameter, but asks for the results from each anchor zip code on its own
+        params = dict(spec)
+        per_anchor = params.pop("per_anchor", False)
+        if not isinstance(per_anchor, bool):
+            raise QueryError("per_anchor must be true or false")
+        args = parse_query(params)
+    except (TypeError, ValueError, QueryError) as e:
+        return json.dumps({ "query": spec, "error": str(e) })
+    # Each worker process has its own copy of the context, and of its in-memory result cache
+    if per_anchor:
+        anchors = ['{"zip_code": %s, "results": [%s]}' % (json.dumps(zip_code), ", ".join(results)) for zip_code, results in context.search_anchors(args, fields)]
+        return '{"query": %s, "anchors": [%s]}' % (json.dumps(spec), ", ".join(anchors))
+    results = context.search(args, fields)
+    return '{"query": %s, "results": [%s]}' % (json.dumps(spec), ", ".join(results))
+
+def run_batch(input_file, output_file, workers = None, chunksize = 16):
+    """
+    Runs a search for each non-blank line of query specs in the input file, writing one line of results per query
+    to the output file in the same order. Searches are spread over a pool of worker processes.
+
+    Arguments:
+        input_file - A file of JSON query specs, one per line, e.g. {"zip_code": "02139", "num_facilities": 5}.
+        output_file - The file to write NDJSON results to.
+        workers (optional) - The number of worker processes, defaulting to the number of CPUs. With 1, searches run in this process.
+        chunksize (optional) - The number of queries sent to a worker at a time.
+    """
+    lines = (line for line in input_file if line.strip())
+    if workers == 1:
+        results = (run_query(line) for line in lines)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(run_query, lines, chunksize)
+    try:
+        for result in results:
+            output_file.write(result + "\n")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="SNF batch search. Reads JSON query specs, one per line, taking the same parameters as snf_search.py, and writes NDJSON results.")
+    argParser.add_argument("--input", dest="input", default="-", help="The file of query specs to read, or - for stdin.")
+    argParser.add_argument("--output", dest="output", default="-", help="The file to write results to, or - for stdout.")
+    argParser.add_argument("--workers", dest="workers", type=int, default=None, help="The number of worker processes. Defaults to the number of CPUs.")
+    argParser.add_argument("--chunksize", dest="chunksize", type=int, default=16, help="The number of queries sent to a worker at a time.")
+    argParser.add_argument("--db", dest="db_path", default="snf.db", help="The sqlite database to search.")
+    argParser.add_argument("--csv", action="store_true")
+    argParser.add_argument("--columnar", dest="columnar_path", nargs="?", const=DEFAULT_COLUMNAR_PATH, default=None, help="Search a columnar file written by columnar.py, snf.col by default, instead of the sqlite database.")
+    argParser.add_argument("--fields", dest="fields", type=get_fields, default=None, help="A comma separated list of the attributes of each result to write, such as name,city,score, rather than all of them.")
+    add_metric_arguments(argParser)
+    args = argParser.parse_args()
+    try:
+        metrics = get_weighted_metrics(args)
+    except ValueError as e:
+        argParser.error(str(e))
+
+    fields = args.fields
+    # Load everything once, before forking the workers
+    context = SearchContext(args.csv, args.db_path, columnar_path = args.columnar_path, metrics = metrics)
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, "r")
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    run_batch(input_file, output_file, args.workers, args.chunksize)
+    if input_file is not sys.stdin:
+        input_file.close()
+    if output_file is not sys.stdout:
+        output_file.close()
@@ -0,0 +1,252 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import generate_data
+from instrumentation import get_peak_rss_kb
+
+# Preset data sizes, as (providers, deficiencies). The medium preset is about the size of the CMS downloads.
+SCALES = {
+    "small": (15000, 200000),
+    "medium": (15000, 1000000),
+    "large": (100000, 10000000),
+    "xlarge": (500000, 50000000)
+}
+
+# Each stage runs in its own process, so that its peak memory is measured in isolation
+STAGES = ["csv_to_sqlite", "repositories_csv", "repositories_sqlite", "scorer_init", "populate_all_scores", "query_sqlite", "query_csv"]
+
+PARAMETERS_FILENAME = "benchmark_parameters.json"
+
+class Quiet(object):
+    """Silences anything printed to stdout within a with block, such as the progress printed by csv_to_sqlite.py."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def time_stage(name, zip_codes):
+    """
+    Runs a stage in the current directory, returning a dictionary of its measurements. Any setup a stage needs
+    is done before its timer starts, but counts towards its peak memory.
+    """
+    import csv_to_sqlite
+    import snf_search
+    from score import ProviderScorer
+    result = {}
+
+    if name == "csv_to_sqlite":
+        if os.path.exists("snf.db"):
+            os.remove("snf.db")
+        connection = sqlite3.connect("snf.db")
+        connection.text_factory = str
+        start = time.time()
+        with Quiet():
+            csv_to_sqlite.build(connection)
+        result["seconds"] = time.time() - start
+        result["rows"] = sum(connection.execute("SELECT count(*) FROM %s" % table.name).fetchone()[0] for table, csv_filename in csv_to_sqlite.SOURCE_TABLES)
+        connection.close()
+
+    elif name in ("repositories_csv", "repositories_sqlite"):
+        start = time.time()
+        if name == "repositories_csv":
+            zip_repository, provider_repository = snf_search.parse_csv()
+        else:
+            zip_repository, provider_repository, cdfs = snf_search.load_sqlite("snf.db")
+        result["seconds"] = time.time() - start
+        result["rows"] = len(provider_repository.get_all_providers())
+
+    elif name in ("scorer_init", "populate_all_scores"):
+        zip_repository, provider_repository, cdfs = snf_search.load_sqlite("snf.db")
+        start = time.time()
+        scorer = ProviderScorer(provider_repository, zip_repository)
+        result["seconds"] = time.time() - start
+        if name == "populate_all_scores":
+            providers = list(provider_repository.get_all_providers())
+            times = []
+            for zip_code in zip_codes:
+                start = time.time()
+                scorer.populate_all_scores(providers, zip_code)
+                times.append(time.time() - start)
+            result["seconds"] = sum(times) / len(times)
+            result["query_seconds"] = times
+        result["rows"] = len(provider_repository.get_all_providers())
+
+    elif name in ("query_sqlite", "query_csv"):
+        # The same steps snf_search.py takes for each search, other than starting the interpreter
+        times = []
+        for zip_code in zip_codes:
+            argv = [zip_code] + (["--csv", "--no_snapshot"] if name == "query_csv" else [])
+            start = time.time()
+            args = snf_search.argParser.parse_args(argv)
+            if args.csv:
+                zip_repository, provider_repository, cdfs = snf_search.load_csv()
+            else:
+                zip_repository, provider_repository, cdfs = snf_search.load_sqlite("snf.db", args)
+            scorer = ProviderScorer(provider_repository, zip_repository, cdfs)
+            results = [p.toJson() for p in snf_search.search(scorer, provider_repository.get_all_providers(), args)]
+            times.append(time.time() - start)
+        result["seconds"] = sum(times) / len(times)
+        result["query_seconds"] = times
+        result["rows"] = len(results)
+
+    else:
+        raise ValueError("Unknown stage %s" % name)
+    return result
+
+def run_stage_process(name, data_dir, zip_codes):
+    """Runs a stage in a new process, returning its measurements."""
+    command = [sys.executable, os.path.abspath(__file__), "--stage", name, "--data_dir", data_dir, "--query_zip_codes", ",".join(zip_codes)]
+    output = subprocess.check_output(command)
+    return json.loads(output.splitlines()[-1])
+
+def ensure_data(data_dir, parameters):
+    """Generates the data files in data_dir, unless they were already generated with the same parameters."""
+    parameters_path = os.path.join(data_dir, PARAMETERS_FILENAME)
+    try:
+        with open(parameters_path, "r") as f:
+            if json.load(f) == parameters:
+                return False
+    except (IOError, ValueError):
+        pass
+    print >> sys.stderr, "Generating data in %s..." % data_dir
+    generate_data.generate(data_dir, parameters["num_providers"], parameters["num_deficiencies"], parameters["num_penalties"],
+        parameters["num_zip_codes"], seed = parameters["seed"])
+    with open(parameters_path, "w") as f:
+        json.dump(parameters, f)
+    return True
+
+def choose_zip_codes(data_dir, num_queries, seed):
+    """Chooses zip codes to search from, at random but the same each run, from the generated zip code file."""
+    with open(os.path.join(data_dir, "zip_code_centroids.csv"), "r") as f:
+        reader = csv.reader(f)
+        next(reader)
+        zip_codes = [row[0] for row in reader]
+    return random.Random(seed).sample(zip_codes, min(num_queries, len(zip_codes)))
+
+def get_environment():
+    """Gets a dictionary describing the machine and software the benchmarks ran on."""
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": numpy_version
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Compares each stage's median time against a baseline results file, returning a list of
+    (stage, baseline seconds, seconds) tuples for the stages that got slower by more than the tolerance.
+    """
+    baseline_stages = { r["stage"]: r for r in baseline["results"] }
+    regressions = []
+    for result in results:
+        base = baseline_stages.get(result["stage"], None)
+        if base is not None and result["seconds"] > base["seconds"] * (1 + tolerance):
+            regressions.append((result["stage"], base["seconds"], result["seconds"]))
+    return regressions
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def run_benchmarks(data_dir, parameters, stages, repeat, num_queries):
+    """Runs each stage repeat times, returning a dictionary of the environment, parameters, and per-stage results."""
+    ensure_data(data_dir, parameters)
+    zip_codes = choose_zip_codes(data_dir, num_queries, parameters["seed"])
+    # Every stage other than loading reads snf.db, so make sure there is one
+    if "csv_to_sqlite" not in stages and not os.path.exists(os.path.join(data_dir, "snf.db")):
+        run_stage_process("csv_to_sqlite", data_dir, zip_codes)
+    results = []
+    for stage in stages:
+        runs = [run_stage_process(stage, data_dir, zip_codes) for i in xrange(repeat)]
+        seconds = [run["seconds"] for run in runs]
+        result = {
+            "stage": stage,
+            "seconds": median(seconds),
+            "min_seconds": min(seconds),
+            "max_seconds": max(seconds),
+            "peak_rss_kb": max(run["peak_rss_kb"] for run in runs),
+            "rows": runs[0]["rows"],
+            "runs": runs
+        }
+        results.append(result)
+        print >> sys.stderr, "%-20s %10.4fs  %10d KB peak  %10d rows" % (stage, result["seconds"], result["peak_rss_kb"], result["rows"])
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": get_environment(),
+        "parameters": parameters,
+        "zip_codes": zip_codes,
+        "results": results
+    }
+
+if __name__ == "__main__":
+    argParser = generate_data.add_generate_arguments(argparse.ArgumentParser(description="Benchmarks loading, scoring, and searching SNF data generated by generate_data.py."))
+    argParser.add_argument("--scale", dest="scale", choices=sorted(SCALES), default="small", help="A preset number of providers and deficiencies, overridden by --providers and --deficiencies.")
+    argParser.add_argument("--data_dir", dest="data_dir", default="benchmark_data", help="The directory to generate the data in. Data generated with the same parameters is reused.")
+    argParser.add_argument("--stages", dest="stages", default=",".join(STAGES), help="A comma separated list of the stages to run, from %s." % ", ".join(STAGES))
+    argParser.add_argument("--repeat", dest="repeat", type=int, default=3, help="The number of times to run each stage, reporting the median time.")
+    argParser.add_argument("--queries", dest="num_queries", type=int, default=5, help="The number of zip codes to search from in the scoring and query stages.")
+    argParser.add_argument("--output", dest="output", default=None, help="The file to write the JSON results to. Defaults to stdout.")
+    argParser.add_argument("--compare", dest="baseline", default=None, help="A results file to compare against, exiting with status 1 if any stage got slower by more than --tolerance.")
+    argParser.add_argument("--tolerance", dest="tolerance", type=float, default=0.25, help="The fraction a stage may slow down by before it's reported as a regression.")
+    # Used internally, to run a single stage in a new process
+    argParser.add_argument("--stage", dest="stage", default=None, help=argparse.SUPPRESS)
+    argParser.add_argument("--query_zip_codes", dest="query_zip_codes", default="", help=argparse.SUPPRESS)
+    # Sizes default to those of the --scale preset
+    argParser.set_defaults(num_providers = None, num_deficiencies = None)
+    args = argParser.parse_args()
+
+    if args.stage is not None:
+        os.chdir(args.data_dir)
+        baseline_rss_kb = get_peak_rss_kb()
+        result = time_stage(args.stage, args.query_zip_codes.split(","))
+        result["peak_rss_kb"] = get_peak_rss_kb()
+        result["baseline_rss_kb"] = baseline_rss_kb
+        print json.dumps(result)
+        sys.exit(0)
+
+    num_providers, num_deficiencies = SCALES[args.scale]
+    parameters = {
+        "num_providers": num_providers if args.num_providers is None else args.num_providers,
+        "num_deficiencies": num_deficiencies if args.num_deficiencies is None else args.num_deficiencies,
+        "num_penalties": args.num_penalties,
+        "num_zip_codes": args.num_zip_codes,
+        "seed": args.seed
+    }
+    if parameters["num_penalties"] is None:
+        parameters["num_penalties"] = parameters["num_providers"] // 5
+    report = run_benchmarks(os.path.abspath(args.data_dir), parameters, args.stages.split(","), args.repeat, args.num_queries)
+
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output is None:
+        print output
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(report["results"], json.load(f), args.tolerance)
+        for stage, baseline_seconds, seconds in regressions:
+            print >> sys.stderr, "Regression in %s: %.4fs, up from %.4fs" % (stage, seconds, baseline_seconds)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,166 @@
+import json
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A dictionary holding at most a given number of entries, which evicts its least recently used entry to make
+    room for a new one. Counts its hits, misses, and evictions, so that callers can report how well it is working.
+    """
+    def __init__(self, capacity):
+        """Initializes an LRUCache holding at most capacity entries. A capacity of 0 caches nothing."""
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default = None):
+        """Gets the value cached for a key, marking it the most recently used, or default if it isn't cached."""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches a value for a key, evicting the least recently used entries if the cache is over capacity."""
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        """Removes every entry, keeping the counters."""
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_stats(self):
+        """Gets a dictionary of the cache's size, capacity, hits, misses, and evictions."""
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def discard(self, key):
+        """Removes the entry for a key, if there is one, without counting a hit or miss."""
+        self.entries.pop(key, None)
+
+# The number of searches whose results a ResultCache keeps in memory by default
+DEFAULT_RESULT_CACHE_SIZE = 1024
+# The number of searches whose results a DiskResultCache keeps by default
+DEFAULT_DISK_RESULT_CACHE_SIZE = 100000
+DEFAULT_RESULT_CACHE_PATH = "snf_cache.db"
+
+class DiskResultCache(object):
+    """
+    Keeps the results of searches in the search_result table of a sqlite database, so that they outlive the process.
+    Each result is stored with the version of the data and scoring it was computed with, and only used by a cache of
+    the same version. Searches of other data sources, such as --csv or --metrics runs, can share the file, so results
+    of other versions are left to expire: the oldest results are deleted once there are more than max_entries, and
+    those older than ttl seconds when the cache is opened.
+    The cache is kept in its own database rather than snf.db, so that writing to it never changes the data it caches.
+    """
+    def __init__(self, path, version, max_entries = DEFAULT_DISK_RESULT_CACHE_SIZE, ttl = None):
+        """Initializes a DiskResultCache.
+
+        Arguments:
+            path - The path of the sqlite database, which is created if needed.
+            version - A string identifying the version of the data and scoring that results are computed with.
+            max_entries (optional) - The number of results to keep.
+            ttl (optional) - The number of seconds a result is kept for, or None to keep it until its version changes.
+        """
+        import sqlite3
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Servers answer searches on many threads, one at a time
+        self.connection = sqlite3.connect(path, timeout = 5, check_same_thread = False)
+        self.connection.text_factory = str
+        # Results are keyed on their version as well, so searches of different versions don't replace each other's.
+        # Caches written before that are just dropped.
+        columns = self.connection.execute("PRAGMA table_info(search_result)").fetchall()
+        if columns and "version" not in [column[1] for column in columns if column[5] > 0]:
+            self.connection.execute("DROP TABLE search_result")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS search_result(key TEXT, version TEXT, created REAL, results TEXT, PRIMARY KEY(key, version))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS search_result_created ON search_result(created)")
+        if ttl is not None:
+            self.connection.execute("DELETE FROM search_result WHERE created <= ?", (time.time() - ttl,))
+        self.connection.commit()
+
+    def get(self, key):
+        """Gets the list of results cached for a key string, or None if there are none of the current version."""
+        row = self.connection.execute("SELECT created, results FROM search_result WHERE key=? AND version=?", (key, self.version)).fetchone()
+        if row is None or (self.ttl is not None and row[0] + self.ttl <= time.time()):
+            return None
+        return json.loads(row[1])
+
+    def put(self, key, results):
+        """Caches a list of results for a key string, deleting the oldest results if the cache is over capacity."""
+        self.connection.execute("INSERT OR REPLACE INTO search_result(key, version, created, results) VALUES(?, ?, ?, ?)",
+            (key, self.version, time.time(), json.dumps(results)))
+        self.connection.execute("DELETE FROM search_result WHERE rowid IN (SELECT rowid FROM search_result ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+class ResultCache(object):
+    """
+    Caches the results of searches against one version of the data and scoring, keyed on their normalized parameters.
+    Results are kept in memory in an LRUCache, and optionally on disk in a DiskResultCache, which is checked on a miss.
+    """
+    def __init__(self, version, capacity = DEFAULT_RESULT_CACHE_SIZE, ttl = None, disk = None):
+        """Initializes a ResultCache.
+
+        Arguments:
+            version - A string identifying the version of the data and scoring that results are computed with.
+            capacity (optional) - The number of results to keep in memory.
+            ttl (optional) - The number of seconds a result is kept in memory for, or None to keep it until it is evicted.
+            disk (optional) - A DiskResultCache of the same version to also keep results in.
+        """
+        self.version = version
+        self.memory = LRUCache(capacity)
+        self.ttl = ttl
+        self.disk = disk
+
+    def get(self, key):
+        """Gets the results cached for a key, which is a tuple of normalized search parameters, or None if there are none."""
+        entry = self.memory.get(key)
+        if entry is not None:
+            expires, results = entry
+            if expires is None or expires > time.time():
+                return results
+            self.memory.discard(key)
+        if self.disk is None:
+            return None
+        results = self.disk.get(repr(key))
+        if results is not None:
+            self.put_memory(key, results)
+        return results
+
+    def put(self, key, results):
+        """Caches the results of a search for a key, which is a tuple of normalized search parameters."""
+        self.put_memory(key, results)
+        if self.disk is not None:
+            self.disk.put(repr(key), results)
+
+    def put_memory(self, key, results):
+        self.memory.put(key, (None if self.ttl is None else time.time() + self.ttl, results))
+
+    def get_stats(self):
+        """Gets a dictionary of the in-memory tier's size, capacity, hits, misses, and evictions."""
+        return self.memory.get_stats()
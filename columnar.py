@@ -0,0 +1,326 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from models import DEFAULT_ANCHOR_CACHE_SIZE, ZipCodeMappingModel, ZipCodeRepository, ProviderModel, ProviderRepository
+from cache import LRUCache
+from orm import get_all_fields
+from score import ProviderCdfs
+
+# A columnar file starts with MAGIC, then the length of a JSON directory describing each table's columns, then the
+# directory itself. The columns follow, each aligned to 8 bytes: numeric columns are packed little endian arrays,
+# and string columns are an array of n+1 offsets into a blob holding the strings end to end.
+MAGIC = "SNFCOL01"
+HEADER = struct.Struct("<8sI")
+ALIGNMENT = 8
+
+# The struct format of each numeric column type. Every other field is stored as a string column.
+NUMERIC_FORMATS = { "i": "<i", "d": "<d" }
+COLUMN_TYPES = { int: "i", float: "d" }
+
+DEFAULT_COLUMNAR_PATH = "snf.col"
+
+def align(offset):
+    """Rounds an offset up to the next multiple of ALIGNMENT."""
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def get_model_columns(model, records):
+    """Gets a (name, type, values) tuple for each field of a Model class, holding the values of the given Records."""
+    return [(name, COLUMN_TYPES.get(field.type, "s"), [getattr(r, name) for r in records]) for name, field in get_all_fields(model)]
+
+class ColumnarWriter(object):
+    """Writes tables of columns to a columnar file."""
+    def __init__(self):
+        self.tables = {}
+        self.chunks = []
+        self.size = 0
+
+    def add_chunk(self, data):
+        """Adds a block of data to the file, aligned, returning its offset from the start of the data."""
+        offset = self.size
+        padding = align(len(data)) - len(data)
+        self.chunks.append(data + "\0" * padding)
+        self.size += len(data) + padding
+        return offset
+
+    def add_table(self, name, columns):
+        """Adds a table, given a list of (name, type, values) tuples for its columns, which must all be of the same length."""
+        num_rows = len(columns[0][2]) if columns else 0
+        table = { "num_rows": num_rows, "columns": {} }
+        for column_name, column_type, values in columns:
+            nulls = [i for i, value in enumerate(values) if value is None]
+            if column_type in NUMERIC_FORMATS:
+                default = 0 if column_type == "i" else 0.0
+                data = struct.pack("<%d%s" % (num_rows, column_type), *[default if value is None else value for value in values])
+                column = { "type": column_type, "offset": self.add_chunk(data) }
+            else:
+                strings = ["" if value is None else str(value) for value in values]
+                offsets = [0]
+                for s in strings:
+                    offsets.append(offsets[-1] + len(s))
+                column = {
+                    "type": "s",
+                    "offsets": self.add_chunk(struct.pack("<%dI" % (num_rows + 1), *offsets)),
+                    "offset": self.add_chunk("".join(strings))
+                }
+            if nulls:
+                column["nulls"] = nulls
+            table["columns"][column_name] = column
+        self.tables[name] = table
+
+    def write(self, path, metadata = None):
+        """
+        Writes the tables added so far to a file, along with a dictionary of metadata. The file is written alongside
+        the path and renamed over it, since overwriting a file in place would change it under processes that have it mapped.
+        """
+        directory = json.dumps({ "tables": self.tables, "metadata": metadata or {} })
+        header = HEADER.pack(MAGIC, len(directory)) + directory
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "wb") as f:
+            f.write(header)
+            f.write("\0" * (align(len(header)) - len(header)))
+            for chunk in self.chunks:
+                f.write(chunk)
+        os.rename(temp_path, path)
+
+class NumericColumn(object):
+    """A lazily read column of numbers in a columnar file. Only the values read are paged in."""
+    def __init__(self, buffer, offset, num_rows, column_type, nulls):
+        self.buffer = buffer
+        self.offset = offset
+        self.num_rows = num_rows
+        self.format = struct.Struct(NUMERIC_FORMATS[column_type])
+        self.column_type = str(column_type)
+        self.nulls = nulls
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, i):
+        if self.nulls and i in self.nulls:
+            return None
+        return self.format.unpack_from(self.buffer, self.offset + i * self.format.size)[0]
+
+    def get_all(self):
+        """Reads every value in the column at once, which is much faster than reading them one at a time."""
+        values = list(struct.unpack_from("<%d%s" % (self.num_rows, self.column_type), self.buffer, self.offset))
+        for i in self.nulls:
+            values[i] = None
+        return values
+
+class StringColumn(object):
+    """A lazily read column of strings in a columnar file. Only the values read are paged in."""
+    def __init__(self, buffer, offsets_offset, offset, num_rows, nulls):
+        self.buffer = buffer
+        self.offsets_offset = offsets_offset
+        self.offset = offset
+        self.num_rows = num_rows
+        self.nulls = nulls
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, i):
+        if self.nulls and i in self.nulls:
+            return None
+        start, end = struct.unpack_from("<2I", self.buffer, self.offsets_offset + i * 4)
+        return self.buffer[self.offset + start:self.offset + end]
+
+    def get_all(self):
+        """Reads every value in the column at once."""
+        offsets = struct.unpack_from("<%dI" % (self.num_rows + 1), self.buffer, self.offsets_offset)
+        data = self.buffer[self.offset:self.offset + offsets[-1]]
+        values = [data[offsets[i]:offsets[i + 1]] for i in xrange(self.num_rows)]
+        for i in self.nulls:
+            values[i] = None
+        return values
+
+class ColumnarTable(object):
+    """A table in a columnar file, whose columns are read lazily."""
+    def __init__(self, buffer, base, table):
+        self.num_rows = table["num_rows"]
+        self.columns = {}
+        for name, column in table["columns"].iteritems():
+            nulls = frozenset(column.get("nulls", ()))
+            if column["type"] == "s":
+                self.columns[str(name)] = StringColumn(buffer, base + column["offsets"], base + column["offset"], self.num_rows, nulls)
+            else:
+                self.columns[str(name)] = NumericColumn(buffer, base + column["offset"], self.num_rows, column["type"], nulls)
+
+    def __len__(self):
+        return self.num_rows
+
+    def get_column(self, name):
+        """Gets the named column."""
+        return self.columns[name]
+
+    def get_record_builder(self, model, bulk = False):
+        """
+        Gets a function building a compact Record of a Model class from the values in a given row. Like a RowDecoder,
+        the column and cast of each field are resolved once, so building a Record is just a read and a cast per field.
+        If bulk is True, each column is read in full up front, which is faster when building most of the rows.
+        """
+        plan = []
+        for name, field in get_all_fields(model):
+            column = self.columns[name].get_all() if bulk else self.columns[name]
+            plan.append((column, field.cast if field.type is not None or field.intern else None))
+        record_class = model.get_record_class()
+        def build(i):
+            return record_class([column[i] if cast is None else cast(column[i]) for column, cast in plan])
+        return build
+
+class ColumnarFile(object):
+    """
+    A columnar file, opened with mmap. Nothing is read until it's asked for, so opening a file is nearly free,
+    and the pages read are shared through the page cache by every process with the file open.
+    """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, directory_length = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a columnar file" % path)
+        directory = json.loads(self.buffer[HEADER.size:HEADER.size + directory_length])
+        self.metadata = directory["metadata"]
+        base = align(HEADER.size + directory_length)
+        self.tables = { str(name): ColumnarTable(self.buffer, base, table) for name, table in directory["tables"].iteritems() }
+
+    def get_table(self, name):
+        """Gets the named table."""
+        return self.tables[name]
+
+    def close(self):
+        """Closes the file. Columns read from it can no longer be used."""
+        self.buffer.close()
+        self.file.close()
+
+class ColumnarZipCodeMapping(object):
+    """
+    A read only mapping from zip codes to ZipCodeMappingModel Records, backed by a zip code table sorted on zip_code.
+    Zip codes are found by binary search over the mmapped zip_code column, and their Records kept once built.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.zip_codes = table.get_column("zip_code")
+        self.build_record = table.get_record_builder(ZipCodeMappingModel)
+        self.record_class = ZipCodeMappingModel.get_record_class()
+        self.names = [f[0] for f in get_all_fields(ZipCodeMappingModel)]
+        self.records = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, zip_code, default = None):
+        try:
+            record = self.records[zip_code]
+        except KeyError:
+            i = bisect_left(self.zip_codes, zip_code)
+            if i < len(self.zip_codes) and self.zip_codes[i] == zip_code:
+                record = self.build_record(i)
+            else:
+                record = None
+            self.records[zip_code] = record
+        return default if record is None else record
+
+    def __getitem__(self, zip_code):
+        record = self.get(zip_code)
+        if record is None:
+            raise KeyError(zip_code)
+        return record
+
+    def __contains__(self, zip_code):
+        return self.get(zip_code) is not None
+
+    def itervalues(self):
+        for i in xrange(len(self.table)):
+            yield self.get(self.zip_codes[i])
+
+    def add(self, zip_code, lat, lng):
+        """Adds a zip code's Record from coordinates read elsewhere, sparing the search for it. None coordinates mark an unknown zip code."""
+        if zip_code not in self.records:
+            values = { "zip_code": zip_code, "lat": lat, "lng": lng }
+            self.records[zip_code] = None if lat is None else self.record_class([values[name] for name in self.names])
+
+class ColumnarZipCodeRepository(ZipCodeRepository):
+    """A ZipCodeRepository over the zip code table of a columnar file, whose mappings are read as they are needed."""
+    def __init__(self, table, anchor_cache_size = DEFAULT_ANCHOR_CACHE_SIZE):
+        self.anchor_cache = LRUCache(anchor_cache_size)
+        self.ziphash = ColumnarZipCodeMapping(table)
+
+def export(path, zip_repository, provider_repository, cdfs):
+    """
+    Writes the zip code mappings, providers, and CDFs to a columnar file. Each provider row also holds the
+    coordinates of its zip code, so that loading providers doesn't need to search the zip code table for them.
+    """
+    zip_mappings = sorted(zip_repository.ziphash.itervalues(), key = lambda z: z.zip_code)
+    providers = sorted(provider_repository.get_all_providers(), key = lambda p: p.num)
+    provider_zips = [zip_repository.ziphash.get(p.zip, None) for p in providers]
+    cdf_rows = list(cdfs.get_rows())
+
+    writer = ColumnarWriter()
+    writer.add_table("zipcode_mapping", get_model_columns(ZipCodeMappingModel, zip_mappings))
+    writer.add_table("provider", get_model_columns(ProviderModel, providers) + [
+        ("zip_lat", "d", [None if z is None else z.lat for z in provider_zips]),
+        ("zip_lng", "d", [None if z is None else z.lng for z in provider_zips])
+    ])
+    writer.add_table("provider_cdf", [
+        ("metric", "s", [r[0] for r in cdf_rows]),
+        ("value", "i", [r[1] for r in cdf_rows]),
+        ("rank", "i", [r[2] for r in cdf_rows])
+    ])
+    writer.write(path, { "num_providers": cdfs.num_providers })
+
+def load_columnar(path = DEFAULT_COLUMNAR_PATH, args = None):
+    """
+    Loads the zip code mappings, providers, and CDFs from a columnar file written by export.
+    Returns a tuple of (ZipCodeRepository, ProviderRepository, ProviderCdfs) for the loaded data.
+
+    Arguments:
+        path (optional) - The path to the columnar file.
+        args (optional) - Search arguments. If given, only providers passing their filters are loaded. The filters
+            are applied to the numeric columns, so the strings of other providers are never read.
+    """
+    columnar_file = ColumnarFile(path)
+    provider_table = columnar_file.get_table("provider")
+    if args is None:
+        rows = xrange(len(provider_table))
+    else:
+        ratings = provider_table.get_column("overall_rating").get_all()
+        deficiencies = provider_table.get_column("num_deficiencies").get_all()
+        penalties = provider_table.get_column("num_penalties").get_all()
+        rows = [i for i in xrange(len(provider_table)) if ratings[i] > args.min_overall_rating and
+            deficiencies[i] < args.max_num_deficiencies and penalties[i] < args.max_penalties]
+
+    zip_repository = ColumnarZipCodeRepository(columnar_file.get_table("zipcode_mapping"))
+    provider_repository = ProviderRepository(())
+    # Without filters every provider is built, so their columns are read in full rather than value by value
+    bulk = args is None
+    zip_lats = provider_table.get_column("zip_lat")
+    zip_lngs = provider_table.get_column("zip_lng")
+    if bulk:
+        zip_lats, zip_lngs = zip_lats.get_all(), zip_lngs.get_all()
+    build_provider = provider_table.get_record_builder(ProviderModel, bulk)
+    for i in rows:
+        provider = build_provider(i)
+        provider_repository.provider_hash[provider.num] = provider
+        zip_repository.ziphash.add(provider.zip, zip_lats[i], zip_lngs[i])
+
+    cdf_table = columnar_file.get_table("provider_cdf")
+    cdf_columns = [(name, cdf_table.get_column(name).get_all()) for name in ("metric", "value", "rank")]
+    cdf_rows = [{ name: values[i] for name, values in cdf_columns } for i in xrange(len(cdf_table))]
+    cdfs = ProviderCdfs.from_rows(cdf_rows, columnar_file.metadata["num_providers"])
+    return zip_repository, provider_repository, cdfs
+
+if __name__ == "__main__":
+    import snf_search
+    argParser = argparse.ArgumentParser(description="Exports the SNF data to a memory mapped columnar file, which snf_search.py --columnar loads nearly instantly.")
+    argParser.add_argument("--output", dest="output", default=DEFAULT_COLUMNAR_PATH, help="The columnar file to write.")
+    argParser.add_argument("--db", dest="db_path", default="snf.db", help="The sqlite database to export.")
+    argParser.add_argument("--csv", action="store_true", help="Export the CSV files in the current directory instead of the sqlite database.")
+    args = argParser.parse_args()
+    if args.csv:
+        export(args.output, *snf_search.load_csv())
+    else:
+        export(args.output, *snf_search.load_sqlite(args.db_path))
@@ -0,0 +1,133 @@
+import csv
+import multiprocessing
+import os
+from cStringIO import StringIO
+from orm import RowDecoder
+from models import ProviderModel
+
+# The most bytes of a file counted as one chunk by default. Chunks are read into memory whole, so this bounds
+# the memory each worker uses, while keeping the chunks large enough that each is worth sending to a worker.
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+# The size of the blocks a file is scanned in for the row boundaries between its chunks
+SCAN_BLOCK_BYTES = 1024 * 1024
+
+def read_counts(reader, columns = None):
+    """
+    Counts the rows for each provider in a csv reader over a deficiencies or penalties file. Only the provider
+    number of each row is decoded, from its column position, which is resolved from the header once.
+
+    Arguments:
+        reader - A csv reader, whose first row is the header unless columns is given.
+        columns (optional) - A sequence of the column names of the file, if reader is over rows after the header.
+    """
+    decoder = RowDecoder([("num", ProviderModel.get_key_field())], next(reader) if columns is None else columns)
+    counts = {}
+    for row in reader:
+        num = decoder.get_values(row)[0]
+        counts[num] = counts.get(num, 0) + 1
+    return counts
+
+def read_header(path):
+    """Gets a tuple of (list of column names, offset of the first row after the header) of a CSV file."""
+    with open(path, "rb") as f:
+        header = f.readline()
+        return next(csv.reader([header])), f.tell()
+
+def get_chunk_offsets(path, start, num_chunks):
+    """
+    Splits the rows of a CSV file from the offset start into up to num_chunks byte ranges of about the same size.
+    Returns a list of the offsets between them, starting with start and ending with the size of the file. A newline
+    within a quoted value doesn't end a row, so a chunk only starts after a newline preceded by an even number of
+    quotes, which the file is scanned for a block at a time.
+    """
+    size = os.path.getsize(path)
+    offsets = [start]
+    step = max(1, (size - start) // num_chunks)
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        quotes = 0
+        while len(offsets) < num_chunks:
+            block = f.read(SCAN_BLOCK_BYTES)
+            if not block:
+                break
+            # Quotes are counted up to each newline considered, then to the end of the block
+            counted = 0
+            index = max(0, start + step * len(offsets) - position)
+            while index < len(block) and len(offsets) < num_chunks:
+                newline = block.find("\n", index)
+                if newline < 0:
+                    break
+                quotes += block.count('"', counted, newline)
+                counted = newline
+                if quotes % 2 == 0:
+                    offsets.append(position + newline + 1)
+                    index = max(newline + 1, start + step * len(offsets) - position)
+                else:
+                    index = newline + 1
+            quotes += block.count('"', counted)
+            position += len(block)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return offsets
+
+def count_chunk(path, columns, start, end):
+    """Counts the rows for each provider in the byte range of a CSV file from start to end, which are row boundaries."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return read_counts(csv.reader(StringIO(data)), columns)
+
+def merge_counts(counts, chunk_counts):
+    """Adds the counts of a chunk to a dictionary of counts by provider number."""
+    for num, count in chunk_counts.iteritems():
+        counts[num] = counts.get(num, 0) + count
+    return counts
+
+class RowCounter(object):
+    """
+    Counts the rows for each provider in deficiencies and penalties files. Each file is split into chunks of at most
+    chunk_bytes at row boundaries, which are counted in a pool of worker processes, and the counts of each file's
+    chunks are merged as they are collected. The chunks are counted in the background as soon as a RowCounter is
+    created, so this process can parse the other files in the meantime.
+    """
+    def __init__(self, paths, workers = None, chunk_bytes = DEFAULT_CHUNK_BYTES):
+        """Initializes a RowCounter.
+
+        Arguments:
+            paths - A list of the paths of the files to count.
+            workers (optional) - The number of worker processes, defaulting to the number of CPUs. With 1, or if the
+                files are small enough to be counted in one chunk in total, they're counted in this process when
+                get_counts is called.
+            chunk_bytes (optional) - The most bytes of a file counted as one chunk.
+        """
+        self.pool = None
+        self.tasks = {}
+        workers = workers or multiprocessing.cpu_count()
+        sizes = [os.path.getsize(path) for path in paths]
+        if workers == 1 or sum(sizes) <= chunk_bytes:
+            return
+        for path, size in zip(paths, sizes):
+            columns, start = read_header(path)
+            num_chunks = max(1, -(-(size - start) // chunk_bytes))
+            offsets = get_chunk_offsets(path, start, num_chunks)
+            self.tasks[path] = [(path, columns, offsets[i], offsets[i + 1]) for i in xrange(len(offsets) - 1)]
+        self.pool = multiprocessing.Pool(min(workers, sum(len(tasks) for tasks in self.tasks.itervalues())))
+        self.results = { path: [self.pool.apply_async(count_chunk, task) for task in tasks] for path, tasks in self.tasks.iteritems() }
+
+    def get_counts(self, path):
+        """Gets a dictionary of the number of rows for each provider number in one of the files, waiting for its chunks to be counted."""
+        if self.pool is None:
+            with open(path, "rb") as f:
+                return read_counts(csv.reader(f))
+        counts = {}
+        for result in self.results[path]:
+            merge_counts(counts, result.get())
+        return counts
+
+    def close(self):
+        """Shuts down the worker processes, if any."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
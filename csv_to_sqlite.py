@@ -1,21 +1,375 @@
+import argparse
+import multiprocessing
 import sqlite3
 import csv
-from orm import ModelTableBuilder
+import time
+import uuid
+from orm import ModelTableBuilder, ROW_HASH_COLUMN
 from models import *
+from score import ProviderCdfs
 
-zipcode_table = ModelTableBuilder(""zipcode_mapping", ZipCodeMappingModel)
-provider_table = ModelTableBuilder("provider", ProviderModel, { "provider_overall_rating": ["overall_rating"] })
-deficiency_table = ModelTableBuilder("deficiency", DeficiencyModel)
-penalty_table = ModelTableBuilder("penalty", [PenaltyModel, FineModel, PaymentDenialModel])
+# Source tables store a hash of each row, so that a refresh can tell which rows have changed
+zipcode_table = ModelTableBuilder("zipcode_mapping", ZipCodeMappingModel, key = "zip_code", hashed = True)
+provider_table = ModelTableBuilder("provider", ProviderModel, { "provider_overall_rating": ["overall_rating"] }, key = "num", hashed = True)
+deficiency_table = ModelTableBuilder("deficiency", DeficiencyModel, { "deficiency_provider_num": ["provider_num"] }, hashed = True)
+penalty_table = ModelTableBuilder("penalty", [PenaltyModel, FineModel, PaymentDenialModel], { "penalty_provider_num": ["provider_num"] }, hashed = True)
 
-connection = sqlite3.connect("snf.db")
-connection.text_factory = str
-cursor = connection.cursor()
+# Each table, and the CSV file it is loaded from
+SOURCE_TABLES = [
+    (zipcode_table, "zip_code_centroids.csv"),
+    (provider_table, "ProviderInfo_Download.csv"),
+    (deficiency_table, "Deficiencies_Download.csv"),
+    (penalty_table, "Penalties_Download.csv")
+]
 
-zipcode_table.create_and_load(cursor, "zip_code_centroids.csv")
-provider_table.create_and_load(cursor, "ProviderInfo_Download.csv")
-deficiency_table.create_and_load(cursor, "Deficiencies_Download.csv")
-penalty_table.create_and_load(cursor, "Penalties_Download.csv")
+# The column of each source table naming the provider its rows count towards, if any
+PROVIDER_COLUMNS = {
+    "provider": "num",
+    "deficiency": "provider_num",
+    "penalty": "provider_num"
+}
 
-connection.commit()
-connection.close()
\ No newline at end of file
+# Derived tables, precomputed here so that snf_search.py can filter providers in SQL
+provider_stats_table = ModelTableBuilder("provider_stats", ProviderStatsModel, {
+    "provider_stats_num_deficiencies": ["num_deficiencies"],
+    "provider_stats_num_penalties": ["num_penalties"]
+})
+provider_cdf_table = ModelTableBuilder("provider_cdf", ProviderCdfModel, { "provider_cdf_metric": ["metric"] })
+dataset_version_table = ModelTableBuilder("dataset_version", DatasetVersionModel)
+
+# Trades durability for speed while bulk loading. A crash part way through leaves a corrupt database,
+# which is fine when it's being regenerated from the CSV files anyway.
+FAST_PRAGMAS = [
+    "PRAGMA journal_mode=OFF",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA temp_store=MEMORY"
+]
+
+def load_provider_stats(cursor):
+    """Rolls up deficiencies and penalties into per-provider counts and computes the CDFs used for scoring."""
+    provider_stats_table.create(cursor)
+    provider_cdf_table.create(cursor)
+    cursor.execute("DELETE FROM provider_stats")
+    cursor.execute("DELETE FROM provider_cdf")
+    cursor.execute("""INSERT INTO provider_stats(num, num_deficiencies, num_penalties)
+        SELECT p.num,
+            (SELECT count(*) FROM deficiency d WHERE d.provider_num=p.num),
+            (SELECT count(*) FROM penalty n WHERE n.provider_num=p.num)
+        FROM provider p""")
+
+    cursor.execute("SELECT p.overall_rating, s.num_deficiencies, s.num_penalties FROM provider p INNER JOIN provider_stats s ON s.num=p.num")
+    all_providers = [ProviderModel({ "overall_rating": r[0], "num_deficiencies": r[1], "num_penalties": r[2] }) for r in cursor.fetchall()]
+    cdfs = ProviderCdfs.from_providers(all_providers)
+    cursor.executemany("INSERT INTO provider_cdf(metric, value, rank) values(?, ?, ?)", cdfs.get_rows())
+
+def load_provider_locations(cursor):
+    """
+    Builds an R*Tree over the coordinates of each provider's zip code, keyed on the provider's rowid, so that
+    snf_search.py can find the providers in a bounding box without scanning the provider table.
+    """
+    cursor.execute("DROP TABLE IF EXISTS provider_location")
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE provider_location USING rtree(id, min_lat, max_lat, min_lng, max_lng)")
+    except sqlite3.OperationalError as e:
+        print "Not building provider_location, so distance filters will be applied in Python: %s" % e
+        return
+    cursor.execute("""INSERT INTO provider_location(id, min_lat, max_lat, min_lng, max_lng)
+        SELECT p.rowid, z.lat, z.lat, z.lng, z.lng FROM provider p INNER JOIN zipcode_mapping z ON z.zip_code=p.zip
+        WHERE z.lat IS NOT NULL AND z.lng IS NOT NULL""")
+
+def get_stats_providers(cursor):
+    """Gets a dictionary of a ProviderModel holding the rating and counts of each provider in the affected table, by provider number."""
+    cursor.execute("""SELECT p.num, p.overall_rating, s.num_deficiencies, s.num_penalties FROM affected a
+        INNER JOIN provider p ON p.num=a.num INNER JOIN provider_stats s ON s.num=a.num""")
+    return { r[0]: ProviderModel({ "overall_rating": r[1], "num_deficiencies": r[2], "num_penalties": r[3] }) for r in cursor.fetchall() }
+
+def refresh_provider_stats(cursor, provider_nums, apply_changes):
+    """
+    Refreshes the counts and CDFs of only the given providers, around applying changes to the source tables.
+    Each affected provider's old values are removed from the stored CDFs, and its new values added back in.
+
+    Arguments:
+        cursor - A cursor on the database being refreshed.
+        provider_nums - The numbers of the providers whose rows are changing.
+        apply_changes - A function of the cursor, which applies the changes to the source tables.
+    """
+    cursor.execute("CREATE TEMP TABLE affected(num TEXT PRIMARY KEY)")
+    cursor.executemany("INSERT INTO affected(num) values(?)", ((num,) for num in provider_nums))
+    old_providers = get_stats_providers(cursor)
+
+    apply_changes(cursor)
+
+    cursor.execute("DELETE FROM provider_stats WHERE num IN (SELECT num FROM affected)")
+    cursor.execute("""INSERT INTO provider_stats(num, num_deficiencies, num_penalties)
+        SELECT p.num,
+            (SELECT count(*) FROM deficiency d WHERE d.provider_num=p.num),
+            (SELECT count(*) FROM penalty n WHERE n.provider_num=p.num)
+        FROM provider p INNER JOIN affected a ON a.num=p.num""")
+    new_providers = get_stats_providers(cursor)
+
+    cursor.execute("SELECT count(*) FROM provider_stats")
+    num_providers = cursor.fetchone()[0] + len(old_providers) - len(new_providers)
+    cursor.execute("SELECT metric, value, rank FROM provider_cdf")
+    cdfs = ProviderCdfs.from_rows([{ "metric": r[0], "value": r[1], "rank": r[2] } for r in cursor.fetchall()], num_providers)
+    for provider in old_providers.itervalues():
+        cdfs.remove_provider(provider)
+    for provider in new_providers.itervalues():
+        cdfs.add_provider(provider)
+    cursor.execute("DELETE FROM provider_cdf")
+    cursor.executemany("INSERT INTO provider_cdf(metric, value, rank) values(?, ?, ?)", cdfs.get_rows())
+    cursor.execute("DROP TABLE affected")
+
+class TableChanges(object):
+    """The rows to insert into, update in, and delete from a source table to bring it up to date with its CSV file."""
+    def __init__(self, table):
+        self.table = table
+        self.inserts = []
+        self.updates = []
+        # Keys of rows to delete for keyed tables, or (row hash, number of copies) otherwise
+        self.deletes = []
+        self.provider_nums = set()
+
+    def apply(self, cursor):
+        """Applies the changes to the table."""
+        table = self.table
+        if table.key is not None:
+            cursor.executemany("DELETE FROM %s WHERE %s=?" % (table.name, table.key), ((key,) for key in self.deletes))
+            key_index = table.get_column_names().index(table.key)
+            cursor.executemany(table.get_update_statement(), (values + [values[key_index]] for values in self.updates))
+        else:
+            cursor.executemany("DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE %s=? LIMIT ?)" % (table.name, table.name, ROW_HASH_COLUMN), self.deletes)
+        cursor.executemany(table.get_insert_statement(), self.inserts)
+
+    def get_counts(self):
+        """Gets a tuple of the number of rows inserted, updated, and deleted."""
+        num_deleted = len(self.deletes) if self.table.key is not None else sum(count for row_hash, count in self.deletes)
+        return len(self.inserts), len(self.updates), num_deleted
+
+def get_table_changes(cursor, table, csv_filename):
+    """
+    Diffs a CSV file against the rows stored in its table, returning the TableChanges needed to bring the table up to date.
+    Rows of keyed tables are matched on their key, and updated when their hash differs. Tables without a key, whose rows
+    can legitimately repeat, are diffed as multisets of row hashes, so that only added or removed copies are touched.
+    """
+    changes = TableChanges(table)
+    column_names = table.get_column_names()
+    provider_column = PROVIDER_COLUMNS.get(table.name, None)
+    provider_index = column_names.index(provider_column) if provider_column is not None else None
+    csv_file = open(csv_filename, "r")
+    rows = table.get_values_from_reader(csv.reader(csv_file))
+
+    if table.key is not None:
+        key_index = column_names.index(table.key)
+        cursor.execute("SELECT %s, %s FROM %s" % (table.key, ROW_HASH_COLUMN, table.name))
+        stored_hashes = dict(cursor.fetchall())
+        seen = set()
+        for values in rows:
+            key = values[key_index]
+            seen.add(key)
+            stored_hash = stored_hashes.get(key, None)
+            if stored_hash is None:
+                changes.inserts.append(values)
+            elif stored_hash != values[-1]:
+                changes.updates.append(values)
+        changes.deletes = [key for key in stored_hashes if key not in seen]
+        if provider_index is not None:
+            changes.provider_nums.update(values[provider_index] for values in changes.inserts + changes.updates)
+            changes.provider_nums.update(changes.deletes)
+    else:
+        select_provider = provider_column if provider_column is not None else "NULL"
+        cursor.execute("SELECT %s, %s FROM %s" % (ROW_HASH_COLUMN, select_provider, table.name))
+        stored_counts = {}
+        stored_providers = {}
+        for row_hash, provider_num in cursor:
+            stored_counts[row_hash] = stored_counts.get(row_hash, 0) + 1
+            stored_providers[row_hash] = provider_num
+        for values in rows:
+            row_hash = values[-1]
+            if stored_counts.get(row_hash, 0) > 0:
+                stored_counts[row_hash] -= 1
+            else:
+                changes.inserts.append(values)
+        changes.deletes = [(row_hash, count) for row_hash, count in stored_counts.iteritems() if count > 0]
+        if provider_index is not None:
+            changes.provider_nums.update(values[provider_index] for values in changes.inserts)
+            changes.provider_nums.update(stored_providers[row_hash] for row_hash, count in changes.deletes)
+
+    csv_file.close()
+    return changes
+
+def record_version(cursor, mode, rows_inserted, rows_updated, rows_deleted, build_id = None):
+    """
+    Records a new dataset version, returning its number. A build is given a new random build_id, while a refresh
+    keeps that of the latest version, so that the pair is unique even across databases rebuilt from scratch.
+    """
+    if build_id is None:
+        cursor.execute("SELECT build FROM dataset_version ORDER BY version DESC LIMIT 1")
+        row = cursor.fetchone()
+        build_id = row[0] if row is not None and row[0] is not None else uuid.uuid4().hex
+    cursor.execute("INSERT INTO dataset_version(created, mode, rows_inserted, rows_updated, rows_deleted, build) values(datetime('now'), ?, ?, ?, ?, ?)",
+        (mode, rows_inserted, rows_updated, rows_deleted, build_id))
+    return cursor.lastrowid
+
+def create_version_table(cursor):
+    """Creates the dataset_version table if needed, adding the build column to one created before it existed."""
+    dataset_version_table.create(cursor)
+    cursor.execute("PRAGMA table_info(dataset_version)")
+    if "build" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE dataset_version ADD COLUMN build TEXT")
+
+def report(table_name, num_rows, seconds):
+    """Prints the loading rate for a table."""
+    print "Loaded %d rows into %s in %.2fs (%d rows/sec)" % (num_rows, table_name, seconds, num_rows / max(seconds, 1e-6))
+
+def parse_worker(table, csv_filename, queue, batch_size):
+    """Parses a CSV file in a worker process, sending batches of rows to the writer through the given queue."""
+    for batch in table.get_batches_from_file(csv_filename, batch_size):
+        queue.put((table.name, batch))
+    # Tell the writer this table is done
+    queue.put((table.name, None))
+
+def load_sequential(cursor, source_tables):
+    """Loads each table from its CSV file, one after another."""
+    for table, csv_filename in source_tables:
+        start = time.time()
+        num_rows = table.bulk_load(cursor, csv_filename)
+        report(table.name, num_rows, time.time() - start)
+
+def load_parallel(cursor, source_tables, batch_size = 10000):
+    """
+    Loads the tables from their CSV files, parsing each file in its own worker process. Parsed batches of rows
+    are sent back to this process, the single writer, which inserts them as they arrive.
+    """
+    # Bound the queue so fast parsers can't buffer whole files in memory ahead of the writer
+    queue = multiprocessing.Queue(4 * len(source_tables))
+    workers = [multiprocessing.Process(target = parse_worker, args = (table, csv_filename, queue, batch_size)) for table, csv_filename in source_tables]
+    tables = { table.name: table for table, csv_filename in source_tables }
+    num_rows = dict.fromkeys(tables, 0)
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    try:
+        remaining = len(workers)
+        while remaining > 0:
+            table_name, batch = queue.get()
+            if batch is None:
+                report(table_name, num_rows[table_name], time.time() - start)
+                remaining -= 1
+                continue
+            cursor.executemany(tables[table_name].get_insert_statement(), batch)
+            num_rows[table_name] += len(batch)
+    except:
+        # Workers blocked on the full queue would never exit once the writer fails, so they're stopped
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+def build(connection, fast = False):
+    """Builds the database from scratch, replacing any tables already in it."""
+    cursor = connection.cursor()
+    if fast:
+        for pragma in FAST_PRAGMAS:
+            cursor.execute(pragma)
+
+    # Indexes are created once the data is in, rather than maintained row by row while loading
+    for table, csv_filename in SOURCE_TABLES:
+        table.drop(cursor)
+        table.create(cursor, indexes = False)
+    connection.commit()
+
+    # All the inserts run in a single transaction
+    if fast:
+        load_parallel(cursor, SOURCE_TABLES)
+    else:
+        load_sequential(cursor, SOURCE_TABLES)
+    connection.commit()
+
+    for table, csv_filename in SOURCE_TABLES:
+        table.create_indexes(cursor)
+    load_provider_stats(cursor)
+    load_provider_locations(cursor)
+    cursor.execute("SELECT %s" % " + ".join("(SELECT count(*) FROM %s)" % table.name for table, csv_filename in SOURCE_TABLES))
+    num_rows = cursor.fetchone()[0]
+    create_version_table(cursor)
+    record_version(cursor, "build", num_rows, 0, 0, uuid.uuid4().hex)
+    connection.commit()
+
+def refresh(connection):
+    """
+    Refreshes a database built by this script from new CSV files, changing only the rows that differ from those
+    already stored, and recomputing the counts of only the providers those rows belong to. The changes are all
+    written in one short transaction once the files have been diffed, so readers are only locked out briefly.
+    """
+    cursor = connection.cursor()
+    for table, csv_filename in SOURCE_TABLES:
+        cursor.execute("PRAGMA table_info(%s)" % table.name)
+        if ROW_HASH_COLUMN not in [column[1] for column in cursor.fetchall()]:
+            raise ValueError("Table %s has no %s column to refresh from. Rebuild the database without --refresh first." % (table.name, ROW_HASH_COLUMN))
+
+    all_changes = []
+    for table, csv_filename in SOURCE_TABLES:
+        start = time.time()
+        changes = get_table_changes(cursor, table, csv_filename)
+        print "Diffed %s in %.2fs: %d inserted, %d updated, %d deleted" % ((table.name, time.time() - start) + changes.get_counts())
+        all_changes.append(changes)
+
+    def apply_changes(cursor):
+        for changes in all_changes:
+            changes.apply(cursor)
+
+    provider_nums = set()
+    for changes in all_changes:
+        provider_nums.update(changes.provider_nums)
+    create_version_table(cursor)
+    connection.commit()
+    # Python's sqlite3 commits its implicit transaction before any DDL, such as rebuilding provider_location,
+    # so the refresh is written in an explicit transaction it manages itself instead
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        cursor.execute("BEGIN")
+        try:
+            refresh_provider_stats(cursor, provider_nums, apply_changes)
+            print "Refreshed the stats of %d providers" % len(provider_nums)
+            # Provider locations depend on both providers' zip codes and the zip codes' coordinates
+            if any(changes.get_counts() != (0, 0, 0) for changes in all_changes if changes.table in (zipcode_table, provider_table)):
+                load_provider_locations(cursor)
+            counts = [sum(c) for c in zip(*[changes.get_counts() for changes in all_changes])]
+            # An unchanged drop keeps the current version, so nothing cached against it is invalidated
+            if sum(counts) > 0:
+                record_version(cursor, "refresh", *counts)
+            cursor.execute("COMMIT")
+        except:
+            try:
+                cursor.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                # Some errors roll the transaction back themselves
+                pass
+            raise
+    finally:
+        connection.isolation_level = isolation_level
+
+def main():
+    argParser = argparse.ArgumentParser(description="Builds the SNF sqlite database from the CSV files in the current directory.")
+    argParser.add_argument("--db", dest="db_path", default="snf.db", help="The sqlite database to build.")
+    argParser.add_argument("--fast", action="store_true", help="Bulk load with journaling and syncing turned off, parsing each CSV file in a separate process.")
+    argParser.add_argument("--refresh", action="store_true", help="Update an existing database in place, changing only the rows that differ from the CSV files.")
+    args = argParser.parse_args()
+
+    connection = sqlite3.connect(args.db_path)
+    connection.text_factory = str
+    start = time.time()
+    if args.refresh:
+        refresh(connection)
+        print "Refreshed %s in %.2fs" % (args.db_path, time.time() - start)
+    else:
+        build(connection, args.fast)
+        print "Built %s in %.2fs" % (args.db_path, time.time() - start)
+    connection.close()
+
+if __name__ == "__main__":
+    main()
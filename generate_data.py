@@ -0,0 +1,173 @@
+import argparse
+import csv
+import os
+import random
+from bisect import bisect_right
+
+# The header of each generated file, named as in the CMS downloads. These are the names and aliases
+# the models' fields are read from.
+ZIP_CODE_COLUMNS = ["zip_code", "lat", "lng"]
+PROVIDER_COLUMNS = ["provnum", "PROVNAME", "ADDRESS", "CITY", "STATE", "ZIP", "PHONE", "overall_rating"]
+DEFICIENCY_COLUMNS = ["provnum", "survey_date_output", "tag", "SurveyType", "tag_desc", "defpref"]
+PENALTY_COLUMNS = ["provnum", "pnlty_date", "filedate", "pnlty_type", "fine_amt", "payden_strt_dt", "payden_days"]
+
+STATES = ["AL", "AZ", "AR", "CA", "CO", "CT", "DE", "FL", "GA", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD",
+    "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ", "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC",
+    "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]
+CITY_WORDS = ["Spring", "Oak", "Cedar", "River", "Lake", "Pine", "Maple", "Fair", "Green", "Mount", "Glen", "Brook"]
+CITY_SUFFIXES = ["field", "ville", "ton", "wood", "dale", " Falls", " Heights", " City", "port", "view"]
+NAME_WORDS = ["Golden", "Sunrise", "Heritage", "Pleasant", "Meadow", "Harbor", "Willow", "Evergreen", "Valley", "Crest"]
+NAME_SUFFIXES = ["Nursing and Rehabilitation Center", "Health Care Center", "Care Center", "Manor", "Nursing Home", "Living Center"]
+STREET_NAMES = ["Main St", "Oak Ave", "Park Rd", "Elm St", "Church St", "Hospital Dr", "Center St", "Washington Ave"]
+SURVEY_TYPES = ["Health", "Fire Safety"]
+DEFICIENCY_PREFIXES = ["F", "K"]
+
+# The share of providers with each overall rating, roughly as in the CMS data, and of those with no rating
+RATING_WEIGHTS = [("1", 13), ("2", 19), ("3", 18), ("4", 24), ("5", 24), ("", 2)]
+
+class WeightedChoice(object):
+    """Chooses items at random in proportion to their weights, by bisecting the cumulative weights."""
+    def __init__(self, items, weights):
+        self.items = items
+        self.totals = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+        self.total = total
+
+    def choose(self, rand):
+        return self.items[bisect_right(self.totals, rand.random() * self.total)]
+
+def random_date(rand, first_year = 2012, last_year = 2015):
+    """Gets a random date string."""
+    return "%d-%02d-%02d" % (rand.randint(first_year, last_year), rand.randint(1, 12), rand.randint(1, 28))
+
+def write_rows(path, columns, rows, batch_size = 10000):
+    """Writes a header and a generated sequence of rows to a CSV file, in batches. Returns the number of rows written."""
+    num_rows = 0
+    with open(path, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.writerows(batch)
+                num_rows += len(batch)
+                batch = []
+        writer.writerows(batch)
+        num_rows += len(batch)
+    return num_rows
+
+def generate_zip_codes(rand, num_zip_codes, num_metros):
+    """
+    Generates zip code centroids clustered around metro areas across the continental US, as a list of
+    (zip_code, lat, lng, weight) tuples, where weight is how likely a provider is to be in that zip code.
+    """
+    metros = [(rand.uniform(26, 48), rand.uniform(-123, -70), rand.paretovariate(1.2)) for i in xrange(num_metros)]
+    metro_choice = WeightedChoice(metros, [m[2] for m in metros])
+    zip_codes = []
+    step = 99999 // max(num_zip_codes, 1)
+    for i in xrange(num_zip_codes):
+        lat, lng, size = metro_choice.choose(rand)
+        spread = 0.3 + rand.random()
+        zip_codes.append(("%05d" % (1 + i * step), lat + rand.gauss(0, spread), lng + rand.gauss(0, spread), size))
+    return zip_codes
+
+def generate_providers(rand, num_providers, zip_codes, unknown_zip_fraction):
+    """Generates provider rows, along with a list of each provider's weight for how many deficiencies and penalties it gets."""
+    zip_choice = WeightedChoice(zip_codes, [z[3] for z in zip_codes])
+    rating_choice = WeightedChoice([r[0] for r in RATING_WEIGHTS], [r[1] for r in RATING_WEIGHTS])
+    nums = []
+    weights = []
+    rows = []
+    for i in xrange(num_providers):
+        num = "%06d" % (i + 1)
+        zip_code = "%05d" % rand.randint(0, 99999) if rand.random() < unknown_zip_fraction else zip_choice.choose(rand)[0]
+        rating = rating_choice.choose(rand)
+        nums.append(num)
+        # Worse rated providers get more deficiencies and penalties, with a long tail
+        weights.append(rand.lognormvariate(0, 0.8) * (7 - int(rating or 3)))
+        rows.append([
+            num,
+            "%s %s %s" % (rand.choice(NAME_WORDS), rand.choice(NAME_WORDS), rand.choice(NAME_SUFFIXES)),
+            "%d %s" % (rand.randint(1, 9999), rand.choice(STREET_NAMES)),
+            rand.choice(CITY_WORDS) + rand.choice(CITY_SUFFIXES),
+            rand.choice(STATES),
+            zip_code,
+            "(%03d) %03d-%04d" % (rand.randint(200, 999), rand.randint(200, 999), rand.randint(0, 9999)),
+            rating
+        ])
+    return rows, nums, weights
+
+def generate_deficiencies(rand, num_deficiencies, provider_choice, num_tags):
+    """Generates deficiency rows, with tags drawn from a Zipf-like distribution."""
+    tags = ["%s%04d" % (rand.choice(DEFICIENCY_PREFIXES), 150 + i) for i in xrange(num_tags)]
+    tag_choice = WeightedChoice(tags, [1.0 / (i + 1) for i in xrange(num_tags)])
+    descriptions = { tag: "Failure to meet requirement %s, including care, safety, and records" % tag for tag in tags }
+    for i in xrange(num_deficiencies):
+        tag = tag_choice.choose(rand)
+        yield [provider_choice.choose(rand), random_date(rand), tag, SURVEY_TYPES[tag[0] == "K"], descriptions[tag], tag[0]]
+
+def generate_penalties(rand, num_penalties, provider_choice):
+    """Generates penalty rows, mostly fines with the rest payment denials."""
+    for i in xrange(num_penalties):
+        provider = provider_choice.choose(rand)
+        penalty_date = random_date(rand)
+        if rand.random() < 0.85:
+            yield [provider, penalty_date, random_date(rand), "Fine", "%.2f" % rand.lognormvariate(9, 1.2), "", ""]
+        else:
+            yield [provider, penalty_date, random_date(rand), "Payment Denial", "", random_date(rand), rand.randint(1, 90)]
+
+def generate(output_dir = ".", num_providers = 15000, num_deficiencies = 1000000, num_penalties = None, num_zip_codes = 33000,
+        num_metros = 400, num_tags = 300, unknown_zip_fraction = 0.01, seed = 1):
+    """
+    Generates zip_code_centroids.csv, ProviderInfo_Download.csv, Deficiencies_Download.csv and Penalties_Download.csv
+    in the given directory. The same arguments always generate the same files. Returns a dictionary of the number of
+    rows written to each file.
+
+    Arguments:
+        output_dir (optional) - The directory to write the files to, which is created if needed.
+        num_providers (optional) - The number of providers.
+        num_deficiencies (optional) - The number of deficiencies, spread unevenly over the providers.
+        num_penalties (optional) - The number of penalties, which defaults to one for every five providers.
+        num_zip_codes (optional) - The number of zip codes.
+        num_metros (optional) - The number of metro areas the zip codes are clustered in.
+        num_tags (optional) - The number of distinct deficiency tags.
+        unknown_zip_fraction (optional) - The fraction of providers whose zip codes aren't in the zip code file.
+        seed (optional) - The random seed.
+    """
+    rand = random.Random(seed)
+    if num_penalties is None:
+        num_penalties = num_providers // 5
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    path = lambda filename: os.path.join(output_dir, filename)
+
+    zip_codes = generate_zip_codes(rand, num_zip_codes, num_metros)
+    provider_rows, nums, weights = generate_providers(rand, num_providers, zip_codes, unknown_zip_fraction)
+    provider_choice = WeightedChoice(nums, weights)
+    return {
+        "zip_code_centroids.csv": write_rows(path("zip_code_centroids.csv"), ZIP_CODE_COLUMNS, ([z[0], "%.6f" % z[1], "%.6f" % z[2]] for z in zip_codes)),
+        "ProviderInfo_Download.csv": write_rows(path("ProviderInfo_Download.csv"), PROVIDER_COLUMNS, provider_rows),
+        "Deficiencies_Download.csv": write_rows(path("Deficiencies_Download.csv"), DEFICIENCY_COLUMNS, generate_deficiencies(rand, num_deficiencies, provider_choice, num_tags)),
+        "Penalties_Download.csv": write_rows(path("Penalties_Download.csv"), PENALTY_COLUMNS, generate_penalties(rand, num_penalties, provider_choice))
+    }
+
+def add_generate_arguments(parser):
+    """Adds the arguments describing the data to generate to the given ArgumentParser."""
+    parser.add_argument("--providers", dest="num_providers", type=int, default=15000, help="The number of providers.")
+    parser.add_argument("--deficiencies", dest="num_deficiencies", type=int, default=1000000, help="The number of deficiencies.")
+    parser.add_argument("--penalties", dest="num_penalties", type=int, default=None, help="The number of penalties. Defaults to one for every five providers.")
+    parser.add_argument("--zip_codes", dest="num_zip_codes", type=int, default=33000, help="The number of zip codes.")
+    parser.add_argument("--seed", dest="seed", type=int, default=1, help="The random seed. The same arguments and seed always generate the same files.")
+    return parser
+
+if __name__ == "__main__":
+    argParser = add_generate_arguments(argparse.ArgumentParser(description="Generates synthetic SNF CSV files, in the layout of the CMS downloads, at a given scale."))
+    argParser.add_argument("--output_dir", dest="output_dir", default=".", help="The directory to write the CSV files to.")
+    args = argParser.parse_args()
+    counts = generate(args.output_dir, args.num_providers, args.num_deficiencies, args.num_penalties, args.num_zip_codes, seed = args.seed)
+    for filename in sorted(counts):
+        print "Wrote %d rows to %s" % (counts[filename], os.path.join(args.output_dir, filename))
@@ -0,0 +1,164 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+
+# The number of functions listed in a stage's cProfile summary
+DEFAULT_CPROFILE_LIMIT = 30
+
+def get_rss_kb():
+    """Gets the current resident set size of this process in kilobytes, or None where it can't be read cheaply."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def get_peak_rss_kb():
+    """Gets the peak resident set size of this process so far, in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS X and kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def get_cprofile_summary(profile, limit = DEFAULT_CPROFILE_LIMIT):
+    """Gets a list of dictionaries describing the functions a cProfile.Profile spent the most cumulative time in."""
+    stats = pstats.Stats(profile)
+    entries = []
+    for (filename, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.stats.iteritems():
+        entries.append({
+            "function": "%s:%d(%s)" % (os.path.basename(filename), line, function),
+            "calls": calls,
+            "total_seconds": total,
+            "cumulative_seconds": cumulative
+        })
+    entries.sort(key = lambda e: e["cumulative_seconds"], reverse = True)
+    return entries[:limit]
+
+class Stage(object):
+    """
+    A stage being measured by a Profiler, used as a context manager. Code within the stage can set its rows
+    attribute to the number of rows or items it processed.
+    """
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        self.cprofile = cProfile.Profile() if self.name in self.profiler.cprofile_stages else None
+        self.rss_kb = get_rss_kb()
+        self.start = time.time()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        return self
+
+    def __exit__(self, *args):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        seconds = time.time() - self.start
+        rss_kb = get_rss_kb()
+        record = {
+            "stage": self.name,
+            "seconds": seconds,
+            "rows": self.rows,
+            "rss_kb": rss_kb,
+            "rss_kb_delta": None if rss_kb is None or self.rss_kb is None else rss_kb - self.rss_kb,
+            "peak_rss_kb": get_peak_rss_kb()
+        }
+        if self.cprofile is not None:
+            record["cprofile"] = get_cprofile_summary(self.cprofile, self.profiler.cprofile_limit)
+        self.profiler.stages.append(record)
+
+class NullStage(object):
+    """A stage that measures nothing, used when no Profiler is active so that instrumented code costs next to nothing."""
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        # Instrumented code sets rows whether or not anything is listening
+        pass
+
+NULL_STAGE = NullStage()
+
+class Profiler(object):
+    """
+    Records the wall time, row count, and memory use of each stage of a search, in the order the stages finish.
+    Memory is measured as the resident set size of the process, which is all that Python 2 can report cheaply:
+    rss_kb_delta is how much it grew over the stage, and peak_rss_kb the peak so far.
+    """
+    def __init__(self, cprofile_stages = (), cprofile_limit = DEFAULT_CPROFILE_LIMIT):
+        """Initializes a Profiler.
+
+        Arguments:
+            cprofile_stages (optional) - The names of stages to also run under cProfile, such as "score",
+                whose busiest functions are summarized in the report.
+            cprofile_limit (optional) - The number of functions to list in each cProfile summary.
+        """
+        self.cprofile_stages = frozenset(cprofile_stages)
+        self.cprofile_limit = cprofile_limit
+        self.stages = []
+        self.start = time.time()
+
+    def stage(self, name):
+        """Gets a context manager measuring a stage with the given name."""
+        return Stage(self, name)
+
+    def get_report(self):
+        """Gets a dictionary of the measurements of every stage so far."""
+        return {
+            "seconds": time.time() - self.start,
+            "peak_rss_kb": get_peak_rss_kb(),
+            "stages": self.stages
+        }
+
+    def write_report(self, path = None):
+        """Writes the report as JSON to the given file path, or to stderr if no path is given."""
+        report = json.dumps(self.get_report(), indent = 2)
+        if path is None or path == "-":
+            print >> sys.stderr, report
+        else:
+            with open(path, "w") as f:
+                f.write(report)
+
+# The Profiler that instrumented code reports to, if any
+active_profiler = None
+
+def stage(name):
+    """
+    Gets a context manager measuring a stage with the given name in the active Profiler, or doing nothing if there
+    is none. Library code wraps its stages in this, e.g. with stage("score") as s: ...; s.rows = len(providers)
+    """
+    if active_profiler is None:
+        return NULL_STAGE
+    return active_profiler.stage(name)
+
+class profiling(object):
+    """
+    A context manager making the given Profiler the active one within a with block, so that library calls made
+    within it report their stages to it. For example:
+
+        profiler = Profiler(cprofile_stages = ["score"])
+        with profiling(profiler):
+            results = search(scorer, providers, args)
+        report = profiler.get_report()
+    """
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        global active_profiler
+        self.previous = active_profiler
+        active_profiler = self.profiler
+        return self.profiler
+
+    def __exit__(self, *args):
+        global active_profiler
+        active_profiler = self.previous
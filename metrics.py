@@ -0,0 +1,240 @@
+import csv
+from datetime import date
+from orm import RowDecoder
+from models import DeficiencyModel, DeficiencyTypeModel, PenaltyModel, FineModel, PaymentDenialModel
+from score import PercentileIndex
+
+# The weighted metrics that can be scored alongside the rating, deficiency, and penalty counts. Each ranks providers
+# with lower values higher.
+WEIGHTED_DEFICIENCIES = "weighted_deficiencies"
+RECENT_DEFICIENCIES = "recent_deficiencies"
+FINE_DOLLARS = "fine_dollars"
+DENIAL_DAYS = "denial_days"
+METRICS = (WEIGHTED_DEFICIENCIES, RECENT_DEFICIENCIES, FINE_DOLLARS, DENIAL_DAYS)
+
+# The number of days over which the weight of a deficiency in recent_deficiencies halves by default
+DEFAULT_HALF_LIFE_DAYS = 365.0
+
+# Metric values are rounded to this many decimal places, so that sums taken in a different order by sqlite and by
+# a pass over the CSV files rank providers alike
+METRIC_PRECISION = 6
+
+def to_number(value):
+    """Casts a raw fine amount or number of days to a float, counting blank or malformed values as 0."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def to_ordinal(survey_date):
+    """Gets the proleptic Gregorian ordinal of a YYYY-MM-DD date, or None if it isn't one."""
+    try:
+        return date(int(survey_date[0:4]), int(survey_date[5:7]), int(survey_date[8:10])).toordinal()
+    except (TypeError, ValueError):
+        return None
+
+class ProviderMetrics(object):
+    """
+    The values of a list of weighted metrics for a population of providers, keyed by provider number, along with
+    a PercentileIndex of each across the population. Providers without a value have a value of 0.
+    """
+    def __init__(self, names, values, num_providers):
+        """Initializes a ProviderMetrics.
+
+        Arguments:
+            names - The names of the metrics, in the order they are scored.
+            values - A dictionary of each metric's dictionary of values by provider number.
+            num_providers - The number of providers in the population, including those without values.
+        """
+        self.names = list(names)
+        self.values = [values[name] for name in self.names]
+        self.cdfs = []
+        for metric_values in self.values:
+            observed = list(metric_values.itervalues())
+            observed.extend([0.0] * (num_providers - len(observed)))
+            self.cdfs.append(PercentileIndex(observed, True))
+
+    def get_columns(self):
+        """Gets a (values by provider number, PercentileIndex) tuple for each metric, in the order they are scored."""
+        return zip(self.values, self.cdfs)
+
+class WeightedMetrics(object):
+    """
+    The configuration of the weighted metrics scored for each provider, which computes them from either the
+    sqlite database or the CSV files without building a Model for any deficiency or penalty:
+
+        weighted_deficiencies - The sum of the weight of each deficiency, by its tag, or else its tag's prefix (defpref).
+        recent_deficiencies - The number of deficiencies, each decayed by half every half_life_days before as_of.
+        fine_dollars - The total amount of fines.
+        denial_days - The total number of days of payment denials.
+
+    Weights are looked up once per distinct tag, which deficiencies refer to through a dictionary of tags.
+    """
+    def __init__(self, names, deficiency_weights = None, default_weight = 1.0, half_life_days = DEFAULT_HALF_LIFE_DAYS, as_of = None):
+        """Initializes a WeightedMetrics.
+
+        Arguments:
+            names - A list of the metrics to compute, from METRICS.
+            deficiency_weights (optional) - A dictionary of weights by deficiency tag, such as F0880, or tag prefix, such as F.
+            default_weight (optional) - The weight of deficiencies with neither their tag nor its prefix in deficiency_weights.
+            half_life_days (optional) - The number of days over which the weight of a deficiency in recent_deficiencies halves.
+            as_of (optional) - The YYYY-MM-DD date recent_deficiencies are decayed to, defaulting to the latest survey date.
+        """
+        unknown = [name for name in names if name not in METRICS]
+        if unknown or not names:
+            raise ValueError("unknown metrics %s, expected a comma separated list of %s" % (", ".join(unknown), ", ".join(METRICS)))
+        if half_life_days <= 0:
+            raise ValueError("half_life_days must be positive")
+        if as_of is not None and to_ordinal(as_of) is None:
+            raise ValueError("as_of must be a YYYY-MM-DD date")
+        self.names = list(names)
+        self.deficiency_weights = dict((str(k), float(v)) for k, v in (deficiency_weights or {}).iteritems())
+        self.default_weight = float(default_weight)
+        self.half_life_days = float(half_life_days)
+        self.as_of = as_of
+
+    def get_signature(self):
+        """Gets a string identifying this configuration, which changes whenever the metrics it computes could."""
+        return repr((self.names, sorted(self.deficiency_weights.items()), self.default_weight, self.half_life_days, self.as_of))
+
+    def get_weight(self, tag, defpref):
+        """Gets the weight of a deficiency with the given tag and tag prefix."""
+        weight = self.deficiency_weights.get(tag, None)
+        if weight is None:
+            weight = self.deficiency_weights.get(defpref, self.default_weight)
+        return weight
+
+    def get_decay(self, age_days):
+        """Gets the weight in recent_deficiencies of a deficiency surveyed the given number of days before as_of, or 0 if its date is unknown."""
+        if age_days is None:
+            return 0.0
+        return 0.5 ** (max(age_days, 0) / self.half_life_days)
+
+    def uses_deficiencies(self):
+        return WEIGHTED_DEFICIENCIES in self.names or RECENT_DEFICIENCIES in self.names
+
+    def uses_penalties(self):
+        return FINE_DOLLARS in self.names or DENIAL_DAYS in self.names
+
+    def get_decays(self, dates):
+        """
+        Gets a (survey date, weight in recent_deficiencies) tuple for each of a list of (survey date, ordinal) tuples,
+        decayed to as_of, or else to the latest of the dates.
+        """
+        known = [ordinal for survey_date, ordinal in dates if ordinal is not None]
+        as_of = to_ordinal(self.as_of) if self.as_of is not None else max(known) if known else None
+        return [(survey_date, self.get_decay(None if ordinal is None or as_of is None else float(as_of - ordinal))) for survey_date, ordinal in dates]
+
+    def get_metrics(self, sums, provider_nums):
+        """
+        Builds the ProviderMetrics of the configured metrics, for the providers with the given numbers, from a
+        dictionary of each metric's sums by provider number.
+        """
+        values = {}
+        for name in self.names:
+            values[name] = dict((num, round(value, METRIC_PRECISION)) for num, value in sums[name].iteritems() if num in provider_nums)
+        return ProviderMetrics(self.names, values, len(provider_nums))
+
+    def compute_sqlite(self, connection):
+        """
+        Computes the metrics for every provider in a database built by csv_to_sqlite.py, with a single grouped
+        aggregate over each of the deficiency and penalty tables. Returns a ProviderMetrics.
+        """
+        sums = dict((name, {}) for name in METRICS)
+        if self.uses_deficiencies():
+            # Each distinct tag and survey date is weighted once, into temporary tables deficiencies are joined with
+            connection.execute("DROP TABLE IF EXISTS temp.deficiency_weight")
+            connection.execute("CREATE TEMP TABLE deficiency_weight(tag TEXT PRIMARY KEY, weight REAL)")
+            # A tag's prefix is the greatest given with it, as in compute_csv
+            tags = connection.execute("SELECT coalesce(tag, ''), max(nullif(defpref, '')) FROM deficiency GROUP BY coalesce(tag, '')").fetchall()
+            connection.executemany("INSERT INTO temp.deficiency_weight(tag, weight) VALUES (?, ?)", [(tag, self.get_weight(tag, defpref)) for tag, defpref in tags])
+            recent, decay_join = "0", ""
+            if RECENT_DEFICIENCIES in self.names:
+                connection.execute("DROP TABLE IF EXISTS temp.survey_decay")
+                connection.execute("CREATE TEMP TABLE survey_decay(survey_date TEXT PRIMARY KEY, decay REAL)")
+                dates = [(survey_date, to_ordinal(survey_date)) for (survey_date,) in connection.execute("SELECT DISTINCT survey_date FROM deficiency WHERE survey_date IS NOT NULL")]
+                connection.executemany("INSERT INTO temp.survey_decay(survey_date, decay) VALUES (?, ?)", self.get_decays(dates))
+                recent, decay_join = "coalesce(sum(s.decay), 0)", "LEFT JOIN temp.survey_decay s ON s.survey_date=d.survey_date"
+            # Every deficiency is read, so a sequential scan beats reading them through the provider_num index
+            rows = connection.execute("""SELECT d.provider_num, sum(w.weight), %s FROM deficiency d NOT INDEXED INNER JOIN temp.deficiency_weight w ON w.tag=coalesce(d.tag, '')
+                %s GROUP BY d.provider_num""" % (recent, decay_join))
+            weighted, decayed = sums[WEIGHTED_DEFICIENCIES], sums[RECENT_DEFICIENCIES]
+            for num, weight, decay in rows:
+                weighted[num] = weight
+                decayed[num] = decay
+            connection.execute("DROP TABLE IF EXISTS temp.deficiency_weight")
+            connection.execute("DROP TABLE IF EXISTS temp.survey_decay")
+        if self.uses_penalties():
+            rows = connection.execute("""SELECT n.provider_num, sum(coalesce(n.fine_amount, 0)), sum(coalesce(n.payment_denial_days, 0))
+                FROM penalty n GROUP BY n.provider_num""")
+            for num, fines, days in rows:
+                sums[FINE_DOLLARS][num] = float(fines)
+                sums[DENIAL_DAYS][num] = float(days)
+        # Deficiencies and penalties of unknown providers are dropped once summed, rather than joined with every row
+        provider_nums = set(num for (num,) in connection.execute("SELECT num FROM provider"))
+        return self.get_metrics(sums, provider_nums)
+
+    def compute_csv(self, deficiencies_path, penalties_path, provider_nums):
+        """
+        Computes the metrics for each of the given provider numbers from the deficiency and penalty CSV files,
+        in a single streaming pass over each that decodes only the columns the metrics need. Returns a ProviderMetrics.
+        """
+        sums = dict((name, {}) for name in METRICS)
+        if self.uses_deficiencies():
+            with open(deficiencies_path, "r") as deficiencies_file:
+                reader = csv.reader(deficiencies_file)
+                decoder = RowDecoder([("num", DeficiencyModel.provider_num), ("tag", DeficiencyTypeModel.tag),
+                    ("defpref", DeficiencyTypeModel.defpref), ("survey_date", DeficiencyModel.survey_date)], next(reader))
+                # Tags and survey dates are each decoded once, into indexes into tag_prefixes and date_ordinals
+                tag_codes, tag_prefixes = {}, []
+                date_codes, date_ordinals = {}, []
+                # The number of deficiencies of each provider with each tag, and on each survey date, weighted once
+                # every tag's prefix and the latest date are known
+                tag_counts = {}
+                survey_counts = {}
+                for row in reader:
+                    num, tag, defpref, survey_date = decoder.get_values(row)
+                    date_code = date_codes.get(survey_date, None)
+                    if date_code is None:
+                        date_code = date_codes[survey_date] = len(date_ordinals)
+                        date_ordinals.append(to_ordinal(survey_date))
+                    # As in sqlite, a tag's prefix is the greatest given with it, whether or not the provider is known
+                    tag = tag or ""
+                    defpref = defpref or None
+                    tag_code = tag_codes.get(tag, None)
+                    if tag_code is None:
+                        tag_code = tag_codes[tag] = len(tag_prefixes)
+                        tag_prefixes.append(defpref)
+                    elif defpref is not None and (tag_prefixes[tag_code] is None or defpref > tag_prefixes[tag_code]):
+                        tag_prefixes[tag_code] = defpref
+                    if num not in provider_nums:
+                        continue
+                    key = (num, tag_code)
+                    tag_counts[key] = tag_counts.get(key, 0) + 1
+                    key = (num, date_code)
+                    survey_counts[key] = survey_counts.get(key, 0) + 1
+            tag_weights = [None] * len(tag_prefixes)
+            for tag, code in tag_codes.iteritems():
+                tag_weights[code] = self.get_weight(tag, tag_prefixes[code])
+            weighted = sums[WEIGHTED_DEFICIENCIES]
+            for (num, code), count in tag_counts.iteritems():
+                weighted[num] = weighted.get(num, 0.0) + count * tag_weights[code]
+            if RECENT_DEFICIENCIES in self.names:
+                # As in sqlite, the latest date is that of any deficiency, whether or not its provider is known
+                dates = sorted(date_codes.iteritems(), key = lambda item: item[1])
+                decays = [decay for survey_date, decay in self.get_decays([(survey_date, date_ordinals[code]) for survey_date, code in dates])]
+                recent = sums[RECENT_DEFICIENCIES]
+                for (num, code), count in survey_counts.iteritems():
+                    recent[num] = recent.get(num, 0.0) + count * decays[code]
+        if self.uses_penalties():
+            with open(penalties_path, "r") as penalties_file:
+                reader = csv.reader(penalties_file)
+                decoder = RowDecoder([("num", PenaltyModel.provider_num), ("amount", FineModel.amount), ("days", PaymentDenialModel.days)], next(reader))
+                fines, days = sums[FINE_DOLLARS], sums[DENIAL_DAYS]
+                for row in reader:
+                    num, amount, num_days = decoder.get_values(row)
+                    if num not in provider_nums:
+                        continue
+                    fines[num] = fines.get(num, 0.0) + to_number(amount)
+                    days[num] = days.get(num, 0.0) + to_number(num_days)
+        return self.get_metrics(sums, provider_nums)
@@ -1,6 +1,10 @@
 
 from math import radians, cos, sin, asin, sqrt
 from orm import ModelField, Model, SQL_MODEL_UNION
+from cache import LRUCache
+
+# The number of anchor zip codes whose distances a ZipCodeRepository keeps by default
+DEFAULT_ANCHOR_CACHE_SIZE = 128
 
 def haversine(lon1, lat1, lon2, lat2, si = False):
     """
@@ -21,14 +25,27 @@ def haversine(lon1, lat1, lon2, lat2, si = False):
 class ZipCodeRepository(object):
     """
     A repository for mappings between zip codes and their lat, long centers. 
+    Mappings are held as compact ZipCodeMappingModel Records. The distances from recently used anchor zip codes
+    are kept in an LRUCache of AnchorDistances, so searches from the same zip code don't recompute them.
     """
-    def __init__(self, zipreader):
+    def __init__(self, zipreader, columns = None, anchor_cache_size = DEFAULT_ANCHOR_CACHE_SIZE):
         """Initializes a ZipCodeRepository with a given dictionary reader.
         
         Arguments:
             zipreader - A sequence of dictionaries containing zip_code, lat, and lng attributes.
+            columns (optional) - A sequence of column names. If given, zipreader is instead a sequence of rows
+                holding values in the order of these columns, such as a csv reader or sqlite cursor.
+            anchor_cache_size (optional) - The number of anchor zip codes to keep distances from.
         """
-        self.ziphash = { z["zip_code"] : ZipCodeMappingModel(z) for z in zipreader }
+        self.anchor_cache = LRUCache(anchor_cache_size)
+        if columns is None:
+            self.ziphash = { z["zip_code"] : ZipCodeMappingModel.get_record(z) for z in zipreader }
+        else:
+            decode = ZipCodeMappingModel.get_decoder(columns, compact = True)
+            self.ziphash = {}
+            for row in zipreader:
+                mapping = decode(row)
+                self.ziphash[mapping.zip_code] = mapping
         
     def get_distance_between(self, zip1, zip2):
         """
@@ -40,33 +57,94 @@ class ZipCodeRepository(object):
         coords2 = self.ziphash[zip2]
         return haversine(coords1.lng, coords1.lat, coords2.lng, coords2.lat)
     
+    def get_anchor_distances(self, zip_code):
+        """Gets the AnchorDistances from the given zip code string, reusing those of a recent search from it."""
+        distances = self.anchor_cache.get(zip_code)
+        if distances is None:
+            distances = AnchorDistances(self, zip_code)
+            self.anchor_cache.put(zip_code, distances)
+        return distances
+    
+    def get_anchor_cache_stats(self):
+        """Gets a dictionary of the size, capacity, hits, misses, and evictions of the anchor distance cache."""
+        return self.anchor_cache.get_stats()
+    
     def get(self, zip):
         """
         Gets the zip code mapping corresponding to the given zip code string. 
         """
         return self.ziphash[zip]
 
+class AnchorDistances(object):
+    """
+    The distances in miles from one anchor zip code to other zip codes, each computed the first time it's needed.
+    Since many providers share a zip code, scoring them computes one distance per distinct zip code. Values derived
+    from a distance, such as its commute percentile, are kept alongside it.
+    """
+    def __init__(self, zipcode_repository, zip_code):
+        """Initializes an AnchorDistances from the given zip code string, using the mappings in the given ZipCodeRepository."""
+        self.zip_code = zip_code
+        self.ziphash = zipcode_repository.ziphash
+        self.anchor = self.ziphash.get(zip_code, None)
+        self.distances = {}
+        self.percentiles = {}
+    
+    def get_distance(self, zip_code):
+        """Gets the distance in miles to the given zip code string, as ZipCodeRepository.get_distance_between does."""
+        try:
+            return self.distances[zip_code]
+        except KeyError:
+            pass
+        mapping = self.ziphash.get(zip_code, None)
+        if mapping is None or self.anchor is None:
+            distance = float("inf")
+        else:
+            distance = haversine(mapping.lng, mapping.lat, self.anchor.lng, self.anchor.lat)
+        self.distances[zip_code] = distance
+        return distance
+    
+    def get_percentile(self, zip_code, percentile):
+        """
+        Gets a value derived from the distance to the given zip code string by the function percentile,
+        such as get_distance_percentile. Only one such function may be used with any AnchorDistances.
+        """
+        try:
+            return self.percentiles[zip_code]
+        except KeyError:
+            pass
+        value = percentile(self.get_distance(zip_code))
+        self.percentiles[zip_code] = value
+        return value
+
 class ZipCodeMappingModel(Model):
     """
     Represents a mapping between a zip code string and its geographical center.
     """
-    zip_code = ModelField("zip_code", key=True, sqltype="TEXT PRIMARY KEY")
-    lat = ModelField("lat", type=float, sqltyp="REAL")
+    zip_code = ModelField("zip_code", key=True, sqltype="TEXT PRIMARY KEY", intern=True)
+    lat = ModelField("lat", type=float, sqltype="REAL")
     lng = ModelField("lng", type=float, sqltype="REAL")
         
 class ProviderRepository(object):
     """
-    A repository for ProviderModel objects. 
+    A repository for ProviderModel objects, held as compact Records. 
     """
-    def __init__(self, provider_reader):
+    def __init__(self, provider_reader, columns = None):
         """
         Populates a ProviderRepository with providers from a sequence of dictionaries containing data
         to construct the ProviderModels. Typically obtained by reading a CSV file or SQL query.
+        If a sequence of column names is given, provider_reader is instead a sequence of rows holding
+        values in the order of these columns, such as a csv reader or sqlite cursor.
         """
         self.provider_hash = {}
-        for row in provider_reader:
-            num = ProviderModel.get_key(row)
-            self.provider_hash[num] = ProviderModel(row)
+        if columns is None:
+            for row in provider_reader:
+                num = ProviderModel.get_key(row)
+                self.provider_hash[num] = ProviderModel.get_record(row)
+        else:
+            decode = ProviderModel.get_decoder(columns, compact = True)
+            for row in provider_reader:
+                provider = decode(row)
+                self.provider_hash[provider.num] = provider
     
     def get_provider(self, rowdict):
         """
@@ -76,6 +154,10 @@ class ProviderRepository(object):
         num = ProviderModel.get_key(rowdict)
         return self.provider_hash.get(num, None) 
     
+    def get_provider_by_num(self, num):
+        """Gets the provider with the given provider number, or None if there is no such provider."""
+        return self.provider_hash.get(num, None)
+    
     def get_all_providers(self):
         """Gets a view to all providers contained in this repository."""
         return self.provider_hash.viewvalues()
@@ -87,21 +169,81 @@ class ProviderModel(Model):
     num = ModelField("num", ["provnum", "provider_num"], key = True, sqltype="TEXT PRIMARY KEY")
     name = ModelField("name", ["PROVNAME"], sqltype="TEXT")
     street = ModelField("street", ["ADDRESS", "address"], sqltype="TEXT")
-    city = ModelField("city", ["CITY"], sqltype="TEXT")
-    state = ModelField("state", ["STATE"], sqltype="TEXT")
-    zip = ModelField("zip", ["ZIP"], sqltype="TEXT REFERENCES zipcode_mapping(zip_code)")
+    city = ModelField("city", ["CITY"], sqltype="TEXT", intern=True)
+    state = ModelField("state", ["STATE"], sqltype="TEXT", intern=True)
+    zip = ModelField("zip", ["ZIP"], sqltype="TEXT REFERENCES zipcode_mapping(zip_code)", intern=True)
     phone = ModelField("phone", ["PHONE"], sqltype="TEXT")
     overall_rating = ModelField("overall_rating", type = int, default = 0, sqltype="INTEGER")
+    # The number of deficiencies and penalties default to zero, and must be updated when the corresponding 
+    # data are read in for those Models, unless the row was joined against the provider_stats table. 
+    # These have no SQL type, since they're stored in provider_stats rather than the provider table. 
+    num_deficiencies = ModelField("num_deficiencies", type = int, default = 0)
+    num_penalties = ModelField("num_penalties", type = int, default = 0)
     
-    def __init__(self, *args, **kwargs):
-        """
-        Initializes a ProviderModel and sets the number of deficiencies and penalties to zero. 
-        These values must be updated when the corresponding data are read in for those Models. 
-        """
-        super(ProviderModel, self).__init__(*args, **kwargs)
-        self.num_deficiencies = 0
-        self.num_penalties = 0
+    # Set by ProviderScorer when the provider is scored
+    extra_attributes = ("lat", "lng", "distance_miles", "score")
         
+class ProviderStatsModel(Model):
+    """
+    Represents the per-provider counts of deficiencies and penalties, precomputed when the database is built 
+    so that providers can be filtered on them at query time.
+    """
+    num = ModelField("num", ["provnum", "provider_num"], key = True, sqltype="TEXT PRIMARY KEY REFERENCES provider(num)")
+    num_deficiencies = ModelField("num_deficiencies", type = int, default = 0, sqltype="INTEGER")
+    num_penalties = ModelField("num_penalties", type = int, default = 0, sqltype="INTEGER")
+
+class ProviderCdfModel(Model):
+    """
+    Represents a single point on a precomputed CDF over all providers: the number of providers
+    ranked below the given value of the given metric.
+    """
+    metric = ModelField("metric", sqltype="TEXT")
+    value = ModelField("value", sqltype="INTEGER")
+    rank = ModelField("rank", type = int, default = 0, sqltype="INTEGER")
+
+class DatasetVersionModel(Model):
+    """
+    Represents one build or refresh of the database from a drop of the CMS CSV files,
+    along with the number of rows it inserted, updated, and deleted. Version numbers start again at 1 in a new
+    database, so each build also has a random id, which its refreshes keep.
+    """
+    version = ModelField("version", key = True, type = int, sqltype="INTEGER PRIMARY KEY AUTOINCREMENT")
+    build = ModelField("build", sqltype="TEXT")
+    created = ModelField("created", sqltype="TEXT")
+    mode = ModelField("mode", sqltype="TEXT")
+    rows_inserted = ModelField("rows_inserted", type = int, default = 0, sqltype="INTEGER")
+    rows_updated = ModelField("rows_updated", type = int, default = 0, sqltype="INTEGER")
+    rows_deleted = ModelField("rows_deleted", type = int, default = 0, sqltype="INTEGER")
+
+class TileProfileModel(Model):
+    """
+    Represents a set of search filters that regional tiles were precomputed for by tiles.py, along with the
+    number of providers kept in each tile and the version of the data and scoring they were computed from.
+    """
+    profile = ModelField("profile", key = True, type = int, sqltype="INTEGER PRIMARY KEY")
+    min_overall_rating = ModelField("min_overall_rating", type = int, default = 1, sqltype="INTEGER")
+    max_num_deficiencies = ModelField("max_num_deficiencies", type = float, default = float("inf"), sqltype="REAL")
+    max_penalties = ModelField("max_penalties", type = float, default = float("inf"), sqltype="REAL")
+    tile_size = ModelField("tile_size", type = int, default = 0, sqltype="INTEGER")
+    region_digits = ModelField("region_digits", type = int, default = 3, sqltype="INTEGER")
+    version = ModelField("version", sqltype="TEXT")
+
+class TileRegionModel(Model):
+    """
+    Represents the tile of a filter profile for the zip codes sharing a prefix. No provider outside the tile
+    can score above the threshold from any zip code in the region, which is null if the tile holds every provider.
+    """
+    profile = ModelField("profile", type = int, sqltype="INTEGER REFERENCES tile_profile(profile)")
+    region = ModelField("region", sqltype="TEXT")
+    threshold = ModelField("threshold", type = float, sqltype="REAL NULL")
+
+class ProviderTileModel(Model):
+    """Represents a provider kept in the tile of a filter profile for a region, ranked by the best score it could have there."""
+    profile = ModelField("profile", type = int, sqltype="INTEGER REFERENCES tile_profile(profile)")
+    region = ModelField("region", sqltype="TEXT")
+    rank = ModelField("rank", type = int, default = 0, sqltype="INTEGER")
+    num = ModelField("num", sqltype="TEXT REFERENCES provider(num)")
+
 class DeficiencyTypeModel(Model):
     """
     Represents a type of deficiency, as well as a repository for these types.
@@ -1,13 +1,68 @@
+import csv
+import hashlib
 import json  
+import struct
+from operator import attrgetter
 
 SQL_MODEL_UNION = "UNION"
+ROW_HASH_COLUMN = "row_hash"
+
+def get_row_hash(values):
+    """Gets a 64 bit hash of a row's values, used to detect changed rows when refreshing a table."""
+    return struct.unpack("<q", hashlib.sha1(repr(values)).digest()[:8])[0]
+  
+def get_public_attributes(obj):
+    """Gets a dictionary of an object's attributes that don't start with an underscore, including any held in __slots__."""
+    attributes = {}
+    for cls in reversed(type(obj).__mro__):
+        for name in cls.__dict__.get("__slots__", ()):
+            if not name.startswith("_") and hasattr(obj, name):
+                attributes[name] = getattr(obj, name)
+    obj_dict = getattr(obj, "__dict__", {})
+    for k in obj_dict:
+        if not k.startswith("_"):
+            attributes[k] = obj_dict[k]
+    return attributes
   
+# Marks an attribute that was never set, which is left out of an object's JSON
+MISSING = object()
+
+class JsonEncoder(object):
+    """
+    Serializes objects as JSON objects holding a fixed list of their attributes. The attributes are read with a
+    single attrgetter and encoded by json's C encoder, rather than discovered on each object as toJson does.
+    """
+    def __init__(self, names):
+        """Initializes a JsonEncoder with the names of the attributes to serialize. Attributes an object doesn't have are left out."""
+        self.names = list(names)
+        getter = attrgetter(*self.names)
+        # An attrgetter of one attribute returns its value rather than a tuple
+        self.get_values = getter if len(self.names) > 1 else lambda obj: (getter(obj),)
+        self.encode = json.JSONEncoder(check_circular = False, default = get_public_attributes).encode
+
+    def get_dict(self, obj):
+        """Gets a dictionary of the attributes of an object that are serialized."""
+        try:
+            return dict(zip(self.names, self.get_values(obj)))
+        except AttributeError:
+            values = {}
+            for name in self.names:
+                value = getattr(obj, name, MISSING)
+                if value is not MISSING:
+                    values[name] = value
+            return values
+
+    def __call__(self, obj):
+        """Gets the JSON string representation of an object."""
+        return self.encode(self.get_dict(obj))
+
 class JsonSerializableObject(object):
     """An object that can be serialized as JSON"""
+    __slots__ = ()
     
     def toJson(self):
         """Returns a JSON string representation of this object."""
-        return json.dumps(self, default=lambda obj: { k: obj.__dict__[k] for k in obj.__dict__ if not k.startswith("_")})
+        return json.dumps(self, default=get_public_attributes)
         
 class ModelField(object):
     """Represents a field within a Model."""
@@ -24,8 +79,10 @@ class ModelField(object):
             type (optional) - A python type to cast the value of this field to. 
             sqltype (optional) - A string representing the type to use in a SQL column definition, or
                 SQL_MODEL_UNION if this field should be flattened into the parent Model's table. 
+            intern (optional) - A Boolean stating whether to intern this field's string values, which saves memory
+                for values repeated across many instances, such as states and zip codes.
         """
-        order = ("name", "aliases", "model", "required", "key", "type", "default", "sqltype")
+        order = ("name", "aliases", "model", "required", "key", "type", "default", "sqltype", "intern")
         num_args = len(args)
         for i in range(len(order)):
             setattr(self, order[i], args[i] if i < num_args else None)
@@ -46,7 +103,7 @@ class ModelField(object):
         else:
             try:
                 value = rowdict[self._cached_alias]
-            except AttributeError:
+            except (AttributeError, KeyError):
                 key = self.name
                 value = rowdict.get(key, None)
                 i = 0
@@ -57,14 +114,26 @@ class ModelField(object):
                     i += 1
                 self._cached_alias = key
 
+        return self.cast(value)
+    
+    def cast(self, value):
+        """Casts a raw value to this field's type, falling back to this field's default if the value can't be cast."""
         if self.type is not None:
             try:
                 value = self.type(value)
-            except ValueError:
+            except (TypeError, ValueError):
                 value = self.default
-        
+        elif self.intern and isinstance(value, str):
+            value = intern(value)
         return value
     
+    def get_column_index(self, columns):
+        """Gets the position of this field's value within a row with the given column names, or None if it has no column."""
+        for key in [self.name] + list(self.aliases or []):
+            if key in columns:
+                return columns.index(key)
+        return None
+    
     def get_column_definition(self):
         """Get the string defining a SQL column to store this field's value."""
         return "%s %s"%(self.name, self.sqltype)
@@ -77,15 +146,97 @@ def get_all_fields(*args):
     """
     fields = []
     for cls in args:
-        fields.extend([f for f in cls.__dict__.iteritems() if isinstance(f[1], ModelField)])
+        # Private attributes, such as the key field cached by Model.get_key_field, aren't fields in their own right
+        fields.extend([f for f in cls.__dict__.iteritems() if isinstance(f[1], ModelField) and not f[0].startswith("_")])
         for field in fields:
             if field[1].sqltype == SQL_MODEL_UNION:
                 fields.remove(field)
                 fields.extend(get_all_fields(field[1].model))
     return fields
 
+class RowDecoder(object):
+    """
+    Decodes the values of a list of fields from rows with a fixed column layout, such as the header of a CSV file 
+    or the description of a sqlite cursor. Each field's name and aliases are resolved to a column position once, 
+    when the decoder is built, so decoding a row is just a lookup and a cast per field.
+    """
+    def __init__(self, fields, columns):
+        """Initializes a RowDecoder.
+        
+        Arguments:
+            fields - A list of (attribute name, ModelField) tuples, as returned by get_all_fields.
+            columns - A sequence of the column names in each row, in order.
+        """
+        self.columns = list(columns)
+        self.names = [f[0] for f in fields]
+        self.plan = []
+        for name, field in fields:
+            if field.model is not None:
+                self.plan.append((None, None, field))
+            else:
+                self.plan.append((field.get_column_index(self.columns), field.cast if field.type is not None or field.intern else None, None))
+    
+    def get_values(self, row):
+        """Gets a list of the value of each field in the given row, which is a sequence of values in column order."""
+        values = []
+        rowdict = None
+        num_values = len(row)
+        for index, cast, reference in self.plan:
+            if reference is not None:
+                # References to other models are built from the whole row, as ModelField.get_value does
+                if rowdict is None:
+                    rowdict = dict(zip(self.columns, row))
+                values.append(reference.get_value(rowdict))
+                continue
+            value = row[index] if index is not None and index < num_values else None
+            values.append(cast(value) if cast is not None else value)
+        return values
+
+class ModelDecoder(RowDecoder):
+    """
+    A RowDecoder that builds instances of a Model class, as Model.__init__ would from the equivalent dictionary,
+    or compact Records of the Model class.
+    """
+    def __init__(self, model, columns, compact = False):
+        super(ModelDecoder, self).__init__(get_all_fields(model), columns)
+        self.model = model
+        self.record_class = model.get_record_class() if compact else None
+        
+    def __call__(self, row):
+        """Builds an instance of this decoder's Model, or a Record of it, from the given row."""
+        if self.record_class is not None:
+            return self.record_class(self.get_values(row))
+        instance = self.model.__new__(self.model)
+        instance.__dict__.update(zip(self.names, self.get_values(row)))
+        return instance
+
+class Record(JsonSerializableObject):
+    """
+    A compact representation of a Model instance, holding its field values in __slots__ rather than an instance
+    dictionary. Record classes are generated for each Model class by Model.get_record_class, and support the same
+    attribute access and JSON serialization as the Model's instances, in a fraction of the memory.
+    """
+    __slots__ = ()
+    # The Model class this Record class was generated from
+    model = None
+    
+    def __init__(self, values):
+        """Initializes a Record with the values of its Model's fields, in the order returned by get_all_fields."""
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+            
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.toJson())
+
+    def toJson(self):
+        """Returns a JSON string representation of this Record, by its Model's compiled JsonEncoder."""
+        return self.model.get_json_encoder()(self)
+
 class Model(JsonSerializableObject):
     """Represents a structured object pulled from a database or CSV file. """
+    # Attributes set on instances at runtime, beyond their fields, which compact Records must make room for
+    extra_attributes = ()
+    
     def __init__(self, *args, **kwargs):
         """Initializes each field in this Model with values from a dictionary. 
         
@@ -119,6 +270,66 @@ class Model(JsonSerializableObject):
                 
         return key_field.get_value(rowdict)
         
+    @classmethod
+    def get_decoder(cls, columns, compact = False):
+        """
+        Gets a ModelDecoder that builds instances of this Model class from rows with the given column names,
+        or compact Records if compact is True. Decoders are compiled once per class and column layout, then reused.
+        """
+        decoders = cls.__dict__.get("_decoders", None)
+        if decoders is None:
+            decoders = {}
+            cls._decoders = decoders
+        key = (tuple(columns), compact)
+        decoder = decoders.get(key, None)
+        if decoder is None:
+            decoder = ModelDecoder(cls, columns, compact)
+            decoders[key] = decoder
+        return decoder
+    
+    @classmethod
+    def get_attribute_names(cls):
+        """Gets the names of this Model class's fields and extra attributes, in the order Records hold them."""
+        return list(cls.get_record_class().__slots__)
+    
+    @classmethod
+    def get_json_encoder(cls, names = None):
+        """
+        Gets a JsonEncoder serializing the given attributes of this Model class's instances and Records, or all of its
+        fields and extra attributes if names is None. Encoders are built once per class and list of names, then reused.
+        """
+        encoders = cls.__dict__.get("_json_encoders", None)
+        if encoders is None:
+            encoders = {}
+            cls._json_encoders = encoders
+        key = None if names is None else tuple(names)
+        encoder = encoders.get(key, None)
+        if encoder is None:
+            encoder = JsonEncoder(cls.get_attribute_names() if names is None else names)
+            encoders[key] = encoder
+        return encoder
+    
+    @classmethod
+    def get_record_class(cls):
+        """Gets the Record class for this Model class, with a slot for each field and extra attribute, generating it on first use."""
+        record_class = cls.__dict__.get("_record_class", None)
+        if record_class is None:
+            names = [f[0] for f in get_all_fields(cls)]
+            names.extend(a for a in cls.extra_attributes if a not in names)
+            record_class = type(cls.__name__ + "Record", (Record,), {
+                "__slots__": tuple(names),
+                "__module__": cls.__module__,
+                "__doc__": "A compact Record of a %s." % cls.__name__,
+                "model": cls
+            })
+            cls._record_class = record_class
+        return record_class
+    
+    @classmethod
+    def get_record(cls, rowdict):
+        """Builds a compact Record of this Model class from a dictionary, as Model.__init__ would build an instance."""
+        return cls.get_record_class()([f[1].get_value(rowdict) for f in get_all_fields(cls)])
+        
     @classmethod
     def get(cls, *args, **kwargs):
         """Gets an instance of a Model class. Useful for overriding in subclasses that might intern complex instances."""
@@ -126,12 +337,33 @@ class Model(JsonSerializableObject):
 
 class ModelTableBuilder(object):
     """Given a set of models, provides methods for building and populating a SQL table with its values."""
-    def __init__(self, name, models, indexes = None):
+    def __init__(self, name, models, indexes = None, key = None, hashed = False):
         """Initializes a ModelTableBuilder with a table name, a list of models to store in it, and a list of indexes to create.
+        
+        Arguments:
+            name - The name of the table.
+            models - A Model class, or a list of Model classes, whose fields are stored in the table.
+            indexes (optional) - A dictionary mapping index names to the list of columns to index.
+            key (optional) - The name of the column that uniquely identifies each row, if there is one.
+            hashed (optional) - A Boolean stating whether to store a hash of each row's values in a row_hash column,
+                so the table can later be refreshed by loading only the rows that have changed.
         """
         self.name = name
-        self.columns = get_all_fields(*models) if isinstance(models, list) else get_all_fields(models)
-        self.indexes = {} if indexes is None else indexes
+        columns = get_all_fields(*models) if isinstance(models, list) else get_all_fields(models)
+        # Fields without a SQL type are computed at runtime rather than stored
+        self.columns = [c for c in columns if c[1].sqltype is not None]
+        self.indexes = {} if indexes is None else dict(indexes)
+        self.key = key
+        self.hashed = hashed
+        if hashed:
+            self.indexes["%s_%s" % (name, ROW_HASH_COLUMN)] = [ROW_HASH_COLUMN]
+        
+    def get_column_names(self):
+        """Gets the names of the columns in this table, in the order of the values in each row."""
+        names = [c[1].name for c in self.columns]
+        if self.hashed:
+            names.append(ROW_HASH_COLUMN)
+        return names
         
     def get_create_index_statements(self):
         """Gets a list of SQL statements for creating the indexes designated on this table."""
@@ -143,7 +375,10 @@ class ModelTableBuilder(object):
         
     def get_column_definitions(self):
         """Get the SQL column definitions for this table. """
-        return ", ".join(c[1].get_column_definition() for c in self.columns)
+        definitions = [c[1].get_column_definition() for c in self.columns]
+        if self.hashed:
+            definitions.append("%s INTEGER" % ROW_HASH_COLUMN)
+        return ", ".join(definitions)
         
     def get_create_statement(self):
         """Gets the SQL CREATE statement for creating this table."""
@@ -151,30 +386,62 @@ class ModelTableBuilder(object):
         
     def get_insert_statement(self):
         """Gets a SQL INSERT statement for inserting values into this table, including wildcards."""
-        column_names = ", ".join(c[1].name for c in self.columns)
-        wildcards = ",".join("?"*len(self.columns))
-        return "insert into %s(%s) values(%s)"%(self.name, column_names, wildcards)
+        column_names = self.get_column_names()
+        wildcards = ",".join("?"*len(column_names))
+        return "insert into %s(%s) values(%s)"%(self.name, ", ".join(column_names), wildcards)
         
-    def create(self, cursor):
-        """Creates the table represented by this builder."""
+    def get_update_statement(self):
+        """Gets a SQL UPDATE statement for replacing a row's values, keyed on this table's key column. The key's value is passed last."""
+        assignments = ", ".join("%s=?" % c for c in self.get_column_names())
+        return "update %s set %s where %s=?" % (self.name, assignments, self.key)
+        
+    def create(self, cursor, indexes = True):
+        """Creates the table represented by this builder, and its indexes unless indexes is False."""
         print self.get_create_statement()
         cursor.execute(self.get_create_statement())
+        if indexes:
+            self.create_indexes(cursor)
+            
+    def create_indexes(self, cursor):
+        """Creates the indexes designated on this table. Creating these after bulk loading is much faster than maintaining them during it."""
         index_statements = self.get_create_index_statements()
         for statement in index_statements:
             print statement
             cursor.execute(statement)
-        
+
+    def drop(self, cursor):
+        """Drops the table represented by this builder, and its indexes, if it exists."""
+        cursor.execute("DROP TABLE IF EXISTS %s" % self.name)
+
     def get_values_from_reader(self, reader):
-        """Gets values from the given dictionary reader to bulk load data into this builder's table."""
+        """Gets values from the given csv reader, whose first row is the header, to bulk load data into this builder's table."""
+        decoder = RowDecoder(self.columns, next(reader))
         for row in reader:
-            yield [col[1].get_value(row) for col in self.columns]
+            values = decoder.get_values(row)
+            if self.hashed:
+                values.append(get_row_hash(values))
+            yield values
+
+    def get_batches_from_file(self, csv_filename, batch_size = 10000):
+        """Generates lists of up to batch_size rows of values from the given csv file to bulk load into this builder's table."""
+        csv_file = open(csv_filename, "r")
+        batch = []
+        for values in self.get_values_from_reader(csv.reader(csv_file)):
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        csv_file.close()
 
     def bulk_load(self, cursor, csv_filename):
-        """Bulk loads data from a given csv file into the cursor provided."""
+        """Bulk loads data from a given csv file into the cursor provided, returning the number of rows loaded."""
         csv_file = open(csv_filename, "r")
-        csv_reader = csv.DictReader(csv_file)
+        csv_reader = csv.reader(csv_file)
         cursor.executemany(self.get_insert_statement(), self.get_values_from_reader(csv_reader))
         csv_file.close()
+        return cursor.rowcount
         
     def create_and_load(self, cursor, csv_filename):
         """Creates this table and bulk loads the given csv file's data into it."""
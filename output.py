@@ -0,0 +1,98 @@
+import csv
+from cStringIO import StringIO
+from models import ProviderModel
+
+# The formats a ResultWriter can write
+FORMATS = ("ndjson", "json", "csv")
+# The number of results serialized and written at a time by default
+DEFAULT_BATCH_SIZE = 1000
+
+def parse_fields(value, model = ProviderModel):
+    """
+    Parses a comma separated list of attribute names of a Model class, such as name,city,score, raising a ValueError
+    naming any that the Model's Records don't have.
+    """
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    names = model.get_attribute_names()
+    unknown = [f for f in fields if f not in names]
+    if unknown or not fields:
+        raise ValueError("unknown fields %s, expected a comma separated list of %s" % (", ".join(unknown), ", ".join(names)))
+    return fields
+
+class ResultWriter(object):
+    """
+    Writes search results to a file as NDJSON (one JSON object per line), a JSON array, or CSV with a header row.
+    Results are serialized with the compiled JsonEncoder of their Model class, or a CSV writer over the same fields,
+    and written in batches rather than one at a time.
+    """
+    def __init__(self, output_file, format = "ndjson", fields = None, model = ProviderModel, batch_size = DEFAULT_BATCH_SIZE):
+        """Initializes a ResultWriter.
+
+        Arguments:
+            output_file - The file to write results to.
+            format (optional) - One of FORMATS.
+            fields (optional) - A list of the attributes of each result to write, or None to write them all.
+            model (optional) - The Model class of the results.
+            batch_size (optional) - The number of results serialized and written at a time.
+        """
+        if format not in FORMATS:
+            raise ValueError("unknown format %s, expected one of %s" % (format, ", ".join(FORMATS)))
+        self.output_file = output_file
+        self.format = format
+        self.fields = model.get_attribute_names() if fields is None else list(fields)
+        self.encoder = model.get_json_encoder(fields)
+        self.batch_size = batch_size
+        self.num_written = 0
+        if format == "csv":
+            self.buffer = StringIO()
+            self.csv_writer = csv.writer(self.buffer, lineterminator = "\n")
+            self.output_file.write(self.get_csv_line(self.fields) + "\n")
+        elif format == "json":
+            self.output_file.write("[")
+
+    def get_csv_line(self, values):
+        """Gets a row of values as a line of CSV, without its line terminator."""
+        self.csv_writer.writerow(values)
+        line = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return line[:-1]
+
+    def serialize(self, results):
+        """Gets a list of each result serialized on its own, as a JSON object or a line of CSV, which write_serialized writes."""
+        if self.format != "csv":
+            return [self.encoder(r) for r in results]
+        lines = []
+        for r in results:
+            values = self.encoder.get_dict(r)
+            lines.append(self.get_csv_line([values.get(f, "") for f in self.fields]))
+        return lines
+
+    def write_serialized(self, serialized):
+        """Writes results already serialized by serialize, a batch at a time."""
+        separator = ", " if self.format == "json" else "\n"
+        for i in xrange(0, len(serialized), self.batch_size):
+            batch = serialized[i:i + self.batch_size]
+            if self.format == "json":
+                prefix = separator if self.num_written > 0 else ""
+                self.output_file.write(prefix + separator.join(batch))
+            else:
+                self.output_file.write(separator.join(batch) + separator)
+            self.num_written += len(batch)
+
+    def write(self, results):
+        """Serializes and writes a sequence of results, a batch at a time."""
+        batch = []
+        for r in results:
+            batch.append(r)
+            if len(batch) >= self.batch_size:
+                self.write_serialized(self.serialize(batch))
+                batch = []
+        if batch:
+            self.write_serialized(self.serialize(batch))
+
+    def close(self):
+        """Finishes writing, closing the JSON array if there is one, and flushes the file. The file is left open."""
+        if self.format == "json":
+            self.output_file.write("]\n")
+        self.output_file.flush()
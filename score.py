@@ -1,3 +1,13 @@
+import hashlib
+import heapq
+from bisect import bisect_left, bisect_right, insort
+from instrumentation import stage
+
+try:
+    import numpy
+except ImportError:
+    # The vectorized scoring engine is optional; ProviderScorer falls back to scoring one provider at a time
+    numpy = None
 
 # The following CDF was built from the PDF provided here: 
 # https://www.rita.dot.gov/bts/sites/rita.dot.gov.bts/files/publications/omnistats/volume_03_issue_04/pdf/entire.pdf
@@ -11,6 +21,19 @@ DOT_AVERAGE_COMMUTE_CDF = {
     35: 93
 }
 
+# Bumped whenever the way providers are scored changes, so that results cached under the old scoring are not reused
+SCORING_VERSION = 1
+
+def get_scoring_signature(metrics = None):
+    """
+    Gets a string identifying how providers are scored, which changes whenever their scores could, including
+    the configuration of any WeightedMetrics scored as well.
+    """
+    signature = repr(sorted(DOT_AVERAGE_COMMUTE_CDF.items()))
+    if metrics is not None:
+        signature += metrics.get_signature()
+    return "%d:%s" % (SCORING_VERSION, hashlib.sha1(signature).hexdigest()[:16])
+
 def get_bisection(key1, key2, distance):
     """
     Compute a percentile rank for a given distance that lies between the distances 
@@ -35,6 +58,106 @@ def get_distance_percentile(distance):
         last_distance = d
     return 0
 
+# The rules for combining a provider's distances from several anchor zip codes into one distance
+COMBINE_RULES = ("min", "mean", "weighted")
+
+def combine_distances(distances, combine = "min", weights = None):
+    """
+    Combines a provider's distances in miles from several anchor zip codes into one distance, which is scored as
+    the distance from a single anchor zip code would be.
+
+    Arguments:
+        distances - A list of the distances from each anchor zip code.
+        combine (optional) - One of COMBINE_RULES: the distance from the nearest anchor, the mean distance,
+            or the mean distance weighted by weights.
+        weights (optional) - With weighted, a list of the non-negative weight of each anchor zip code.
+    """
+    if combine == "min":
+        return min(distances)
+    if combine == "mean":
+        weights = [1.0] * len(distances)
+    # Anchors with no weight are left out, so that an unknown one can't make the distance undefined
+    total = 0.0
+    weight_sum = 0.0
+    for distance, weight in zip(distances, weights):
+        if weight > 0:
+            total += weight * distance
+            weight_sum += weight
+    return total / weight_sum
+
+class PercentileIndex(object):
+    """
+    A sorted list of observations of a metric, which ranks a value by the number of observations that fall
+    strictly below it (or strictly above it, in reverse order). Building the index is O(n log n), ranking 
+    a value is a bisection, and single observations can be inserted or removed without rebuilding the index.
+    """
+    def __init__(self, values = (), reverse = False):
+        """Initializes a PercentileIndex.
+        
+        Arguments:
+            values (optional) - A sequence of observations to index.
+            reverse (optional) - A boolean stating whether values rank in reverse order, i.e. lower values rank higher.
+        """
+        self.values = sorted(values)
+        self.reverse = reverse
+        
+    @classmethod
+    def from_ranks(cls, ranks, num_values, reverse = False):
+        """Rebuilds a PercentileIndex from a dictionary mapping each distinct value to its rank, as returned by items().
+        
+        Arguments:
+            ranks - A dictionary mapping each distinct observed value to its rank.
+            num_values - The total number of observations.
+            reverse (optional) - A boolean stating whether values rank in reverse order.
+        """
+        index = cls((), reverse)
+        distinct = sorted(ranks, key = lambda v: ranks[v])
+        for i, value in enumerate(distinct):
+            next_rank = ranks[distinct[i + 1]] if i + 1 < len(distinct) else num_values
+            index.values.extend([value] * (next_rank - ranks[value]))
+        index.values.sort()
+        return index
+        
+    def __len__(self):
+        return len(self.values)
+        
+    def __getitem__(self, value):
+        return self.rank(value)
+        
+    def rank(self, value):
+        """Gets the number of observations that rank below the given value."""
+        if self.reverse:
+            return len(self.values) - bisect_right(self.values, value)
+        return bisect_left(self.values, value)
+    
+    def max_rank(self):
+        """Gets the highest rank of any observation in this index."""
+        if not self.values:
+            return 0
+        return self.rank(self.values[0] if self.reverse else self.values[-1])
+        
+    def items(self):
+        """Gets a sorted list of (value, rank) tuples for each distinct observed value."""
+        items = []
+        i = 0
+        n = len(self.values)
+        while i < n:
+            value = self.values[i]
+            items.append((value, self.rank(value)))
+            i = bisect_right(self.values, value, i)
+        return items
+        
+    def insert(self, value):
+        """Adds a single observation to this index."""
+        insort(self.values, value)
+        
+    def remove(self, value):
+        """Removes a single observation from this index, raising a ValueError if the value was never observed."""
+        i = bisect_left(self.values, value)
+        if i == len(self.values) or self.values[i] != value:
+            raise ValueError("%r is not in this PercentileIndex" % (value,))
+        del self.values[i]
+
 def compute_cdf(all_providers, metric, reverse = True):
     """Computes the CDF for a given metric across all providers. 
     
@@ -43,12 +166,7 @@ def compute_cdf(all_providers, metric, reverse = True):
     metric - A function that takes a provider and returns a number to analyze
     reverse - A boolean stating whether to sort the given metric in reverse order. Defaults to True
     """
-    counts = [metric(p) for p in all_providers]
-    counts.sort(reverse = reverse)
-    cdf = {}
-    for num in set(counts):
-        cdf[num] = counts.index(num)
-    return cdf
+    return PercentileIndex((metric(p) for p in all_providers), reverse)
     
 def deficiencies_cdf(all_providers):
     return compute_cdf(all_providers, lambda p: p.num_deficiencies, True)
@@ -59,29 +177,123 @@ def penalties_cdf(all_providers):
 def rating_cdf(all_providers):
     return compute_cdf(all_providers, lambda p: p.overall_rating, False)
 
+class ProviderCdfs(object):
+    """
+    The rating, deficiency, and penalty CDFs for a population of providers. These can be computed 
+    from the providers themselves, or read back from the provider_cdf table built by csv_to_sqlite.py, 
+    which allows the providers being scored to be filtered before they are ever loaded. The ProviderMetrics
+    of any weighted metrics scored as well are held in metrics.
+    """
+    RATING = "overall_rating"
+    DEFICIENCIES = "num_deficiencies"
+    PENALTIES = "num_penalties"
+    
+    def __init__(self, r_cdf, d_cdf, p_cdf, metrics = None):
+        """Initializes a ProviderCdfs with a PercentileIndex for each metric, and optionally a ProviderMetrics."""
+        self.r_cdf = r_cdf
+        self.d_cdf = d_cdf
+        self.p_cdf = p_cdf
+        self.metrics = metrics
+        
+    @property
+    def num_providers(self):
+        return len(self.r_cdf)
+        
+    @classmethod
+    def from_providers(cls, all_providers):
+        """Computes the CDFs across all of the given providers."""
+        return cls(rating_cdf(all_providers), deficiencies_cdf(all_providers), penalties_cdf(all_providers))
+    
+    @classmethod
+    def from_rows(cls, cdf_rows, num_providers):
+        """Reads the CDFs from a sequence of dictionaries containing metric, value, and rank attributes.
+        
+        Arguments:
+            cdf_rows - A sequence of dictionaries, typically read from the provider_cdf table.
+            num_providers - The number of providers the CDFs were computed across.
+        """
+        ranks = { cls.RATING: {}, cls.DEFICIENCIES: {}, cls.PENALTIES: {} }
+        for row in cdf_rows:
+            ranks[row["metric"]][row["value"]] = row["rank"]
+        return cls(PercentileIndex.from_ranks(ranks[cls.RATING], num_providers, False),
+            PercentileIndex.from_ranks(ranks[cls.DEFICIENCIES], num_providers, True),
+            PercentileIndex.from_ranks(ranks[cls.PENALTIES], num_providers, True))
+    
+    def get_rows(self):
+        """Gets a (metric, value, rank) tuple for each point on each CDF, suitable for storing in the provider_cdf table."""
+        for metric, cdf in ((self.RATING, self.r_cdf), (self.DEFICIENCIES, self.d_cdf), (self.PENALTIES, self.p_cdf)):
+            for value, rank in cdf.items():
+                yield (metric, value, rank)
+                
+    def add_provider(self, provider):
+        """Adds a single provider's metrics to the CDFs."""
+        self.r_cdf.insert(provider.overall_rating)
+        self.d_cdf.insert(provider.num_deficiencies)
+        self.p_cdf.insert(provider.num_penalties)
+        
+    def remove_provider(self, provider):
+        """Removes a single provider's metrics from the CDFs. The provider must hold the same values it was added with."""
+        self.r_cdf.remove(provider.overall_rating)
+        self.d_cdf.remove(provider.num_deficiencies)
+        self.p_cdf.remove(provider.num_penalties)
+
 class ProviderScorer:
-    def __init__(self, provider_repository, zipcode_repository):
-        """ Initializes a ProviderScorer with a ProviderRepository and a ZipCodeReposiory."""
-        all_providers = provider_repository.get_all_providers()
-        self.num_providers = len(all_providers)
-        self.r_cdf = rating_cdf(all_providers)
-        self.p_cdf = penalties_cdf(all_providers)
-        self.d_cdf = deficiencies_cdf(all_providers)
+    def __init__(self, provider_repository, zipcode_repository, cdfs = None):
+        """ Initializes a ProviderScorer with a ProviderRepository and a ZipCodeReposiory.
+        
+        Arguments:
+            provider_repository - The providers to score.
+            zipcode_repository - The zip code mappings used to compute distances.
+            cdfs (optional) - Precomputed ProviderCdfs. If not given, these are computed across all providers
+                in the provider_repository, which must then contain every provider rather than a filtered subset.
+        """
+        if cdfs is None:
+            with stage("cdfs") as s:
+                cdfs = ProviderCdfs.from_providers(provider_repository.get_all_providers())
+                s.rows = cdfs.num_providers
+        self.num_providers = cdfs.num_providers
+        self.r_cdf = cdfs.r_cdf
+        self.p_cdf = cdfs.p_cdf
+        self.d_cdf = cdfs.d_cdf
+        # The values by provider number and PercentileIndex of each weighted metric, which are extra criteria
+        self.metric_columns = cdfs.metrics.get_columns() if cdfs.metrics is not None else []
+        # The rating, deficiencies, penalties, and distance, along with any weighted metrics
+        self.num_criteria = 4 + len(self.metric_columns)
         self.zipcode_repository = zipcode_repository
 
-    def populate_score(self, provider, zipcode):
+    def get_percentiles(self, provider):
+        """
+        Gets the rating, deficiencies, and penalties percentiles for the given provider, followed by those of any
+        weighted metrics, none of which depend on distance.
+        """
+        rating_percentile = 100 * self.r_cdf[provider.overall_rating] / self.num_providers
+        deficiencies_percentile = 100 * self.d_cdf[provider.num_deficiencies] / self.num_providers
+        penalties_percentile = 100 * self.p_cdf[provider.num_penalties] / self.num_providers
+        percentiles = [rating_percentile, deficiencies_percentile, penalties_percentile]
+        for values, cdf in self.metric_columns:
+            percentiles.append(100 * cdf[values.get(provider.num, 0.0)] / self.num_providers)
+        return percentiles
+
+    def populate_score(self, provider, zipcode, percentiles = None, anchor = None):
         """Populates the score, lat, lng, and distance_miles fields on the given provider.
         
         Arguments:
             provider - The provider to score.
             zipcode - The zipcode to score distances against.
+            percentiles (optional) - The provider's percentiles, if already computed by get_percentiles.
+            anchor (optional) - The AnchorDistances from the zipcode, if already looked up.
         """
-        rating_percentile = 100 * self.r_cdf[provider.overall_rating] / self.num_providers
-        deficiencies_percentile = 100 * self.d_cdf[provider.num_deficiencies] / self.num_providers
-        penalties_percentile = 100 * self.p_cdf[provider.num_penalties] / self.num_providers
-        distance = self.zipcode_repository.get_distance_between(provider.zip, zipcode)
-        distance_percentile = get_distance_percentile(distance)
-        criteria = [rating_percentile, deficiencies_percentile, penalties_percentile, distance_percentile]
+        if percentiles is None:
+            percentiles = self.get_percentiles(provider)
+        if anchor is None:
+            anchor = self.zipcode_repository.get_anchor_distances(zipcode)
+        distance = anchor.get_distance(provider.zip)
+        distance_percentile = anchor.get_percentile(provider.zip, get_distance_percentile)
+        self.populate_location(provider, distance)
+        provider.score = self.get_score(percentiles, distance_percentile)
+    
+    def populate_location(self, provider, distance):
+        """Populates the lat, lng, and distance_miles fields on the given provider, if its zip code is known."""
         try:
             zip_mapping = self.zipcode_repository.get(provider.zip)
             provider.lat = zip_mapping.lat
@@ -90,12 +302,394 @@ class ProviderScorer:
         except KeyError:
             # Looks like there were some missing zip codes in the mapping csv...
             pass
-        
+    
+    def get_score(self, percentiles, distance_percentile):
+        """Combines a provider's percentiles, as returned by get_percentiles, with its distance percentile into its score."""
+        criteria = percentiles + [distance_percentile]
         # Equally weighting scores at the moment... we can weigh things differently if 
         # we determine that one metric is more important than another
-        provider.score = sum(criteria) / len(criteria)
+        return sum(criteria) / len(criteria)
     
     def populate_all_scores(self, providers, zipcode):
         """Populates scores and geographical information on all providers passed in."""
+        if numpy is not None:
+            ArrayScoringEngine(providers, self).populate_scores(zipcode)
+            return
+        anchor = self.zipcode_repository.get_anchor_distances(zipcode)
+        for p in providers:
+            self.populate_score(p, zipcode, None, anchor)
+    
+    def get_max_score(self, distance):
+        """Gets an upper bound on the score of any provider at least the given distance in miles from the anchor zip code."""
+        best_ranks = self.r_cdf.max_rank() + self.d_cdf.max_rank() + self.p_cdf.max_rank() + sum(cdf.max_rank() for values, cdf in self.metric_columns)
+        best_percentiles = 100 * best_ranks / float(self.num_providers)
+        return (best_percentiles + get_distance_percentile(distance)) / float(self.num_criteria)
+    
+    def iter_scored(self, providers, zipcode, top_providers = None, anchor = None):
+        """Generates each of the given providers after populating its score.
+        
+        Arguments:
+            providers - The providers to score.
+            zipcode - The zipcode to score distances against.
+            top_providers (optional) - A TopProviders being filled from this generator. Providers that could not 
+                place in it even at zero distance are skipped without computing their distance.
+            anchor (optional) - The AnchorDistances from the zipcode, if already looked up.
+        """
+        if anchor is None:
+            anchor = self.zipcode_repository.get_anchor_distances(zipcode)
         for p in providers:
-            self.populate_score(p, zipcode)
\ No newline at end of file
+            percentiles = self.get_percentiles(p)
+            if top_providers is not None and not top_providers.could_place(sum(percentiles + [100]) / float(self.num_criteria), p.num):
+                continue
+            self.populate_score(p, zipcode, percentiles, anchor)
+            yield p
+    
+    def get_top_providers(self, providers, zipcode, num_facilities):
+        """Scores the given providers and returns the num_facilities best, sorted by descending score and then provider number."""
+        top_providers = TopProviders(num_facilities)
+        # Scoring includes selecting the top providers, which is interleaved with it when pruning
+        with stage("score") as s:
+            providers = list(providers)
+            if numpy is not None:
+                # Scoring everyone in one batched pass is cheaper than pruning one provider at a time
+                self.populate_all_scores(providers, zipcode)
+                scored = providers
+            else:
+                scored = self.iter_scored(providers, zipcode, top_providers)
+            for p in scored:
+                top_providers.push(p)
+            s.rows = len(providers)
+        with stage("sort") as s:
+            top = top_providers.get_sorted()
+            s.rows = len(top)
+        return top
+    
+    def get_nearest_top_providers(self, locator, zipcode, num_facilities, max_distance_miles = float("inf"), accept = None):
+        """
+        Scores providers in increasing order of distance from the given zipcode, stopping once no farther 
+        provider could place in the top num_facilities, and returns the num_facilities best as get_top_providers does.
+        
+        Arguments:
+            locator - A ProviderLocator over the providers to score.
+            zipcode - The zipcode to score distances against.
+            num_facilities - The number of top scoring providers to return.
+            max_distance_miles (optional) - The maximum distance of any provider to score.
+            accept (optional) - A function that takes a provider and returns whether it may be scored at all.
+        """
+        top_providers = TopProviders(num_facilities)
+        if num_facilities <= 0:
+            return []
+        with stage("score") as s:
+            s.rows = self.push_nearest(top_providers, locator, zipcode, max_distance_miles, accept)
+        with stage("sort") as s:
+            top = top_providers.get_sorted()
+            s.rows = len(top)
+        return top
+
+    def push_nearest(self, top_providers, locator, zipcode, max_distance_miles, accept):
+        """Scores providers in increasing order of distance into top_providers, for get_nearest_top_providers. Returns the number scored."""
+        num_scored = 0
+        anchor = self.zipcode_repository.get_anchor_distances(zipcode)
+        for distance, providers in locator.iter_nearest(zipcode):
+            # Locator distances can differ from haversine in the last few bits, so err on the near side
+            distance *= 1 - 1e-9
+            if distance > max_distance_miles:
+                break
+            if top_providers.is_full() and self.get_max_score(distance) < top_providers.get_threshold():
+                break
+            if anchor.get_distance(providers[0].zip) > max_distance_miles:
+                continue
+            if accept is not None:
+                providers = [p for p in providers if accept(p)]
+            for p in self.iter_scored(providers, zipcode, top_providers, anchor):
+                top_providers.push(p)
+                num_scored += 1
+        return num_scored
+
+    def populate_combined_scores(self, providers, zipcodes, combine = "min", weights = None):
+        """
+        Populates scores and geographical information on all providers passed in, scoring each by its distances from
+        several anchor zip codes combined by combine_distances, with distance_miles the combined distance. Returns a
+        list of the combined distance of each provider.
+        """
+        if numpy is not None:
+            return ArrayScoringEngine(providers, self).populate_combined_scores(zipcodes, combine, weights)
+        anchors = [self.zipcode_repository.get_anchor_distances(z) for z in zipcodes]
+        distances = []
+        for p in providers:
+            distance = combine_distances([anchor.get_distance(p.zip) for anchor in anchors], combine, weights)
+            self.populate_location(p, distance)
+            p.score = self.get_score(self.get_percentiles(p), get_distance_percentile(distance))
+            distances.append(distance)
+        return distances
+    
+    def get_combined_top_providers(self, providers, zipcodes, num_facilities, combine = "min", weights = None, max_distance_miles = float("inf")):
+        """
+        Scores the given providers by their combined distances from several anchor zip codes, as populate_combined_scores
+        does, and returns the num_facilities best within max_distance_miles of combined distance, sorted as get_top_providers does.
+        """
+        top_providers = TopProviders(num_facilities)
+        with stage("score") as s:
+            providers = list(providers)
+            distances = self.populate_combined_scores(providers, zipcodes, combine, weights)
+            for p, distance in zip(providers, distances):
+                if distance <= max_distance_miles:
+                    top_providers.push(p)
+            s.rows = len(providers)
+        with stage("sort") as s:
+            top = top_providers.get_sorted()
+            s.rows = len(top)
+        return top
+    
+    def iter_anchor_top_providers(self, providers, zipcodes, num_facilities, max_distance_miles = float("inf")):
+        """
+        Scores the given providers against each of several anchor zip codes, generating a (zipcode, top providers) tuple
+        for each, with the num_facilities best within max_distance_miles sorted as get_top_providers does. Percentiles
+        that don't depend on distance are computed once for all anchors. Scores live on the providers, so the providers
+        of each anchor must be used before the next is generated.
+        """
+        providers = list(providers)
+        if numpy is not None:
+            for zipcode, top in ArrayScoringEngine(providers, self).iter_top_providers(zipcodes, num_facilities, max_distance_miles):
+                yield zipcode, top
+            return
+        percentiles = [self.get_percentiles(p) for p in providers]
+        for zipcode in zipcodes:
+            anchor = self.zipcode_repository.get_anchor_distances(zipcode)
+            top_providers = TopProviders(num_facilities)
+            for p, p_percentiles in zip(providers, percentiles):
+                if anchor.get_distance(p.zip) <= max_distance_miles:
+                    self.populate_score(p, zipcode, p_percentiles, anchor)
+                    top_providers.push(p)
+            yield zipcode, top_providers.get_sorted()
+
+class RankedProvider(object):
+    """A scored provider held in a TopProviders heap, ordered so that the worst provider is the smallest."""
+    __slots__ = ("score", "num", "provider")
+    
+    def __init__(self, score, num, provider = None):
+        self.score = score
+        self.num = num
+        self.provider = provider
+        
+    def __lt__(self, other):
+        # Ties on score are broken by provider number, with lower numbers ranking better
+        return self.score < other.score or (self.score == other.score and self.num > other.num)
+
+class TopProviders(object):
+    """
+    Keeps the best K scored providers seen so far in a bounded min-heap, so that selecting them from n providers
+    takes O(n log K) time and O(K) memory. Providers rank by descending score, and then by ascending provider number.
+    """
+    def __init__(self, k):
+        """Initializes a TopProviders which keeps at most k providers."""
+        self.k = k
+        self.heap = []
+        
+    def is_full(self):
+        return len(self.heap) >= self.k
+        
+    def get_threshold(self):
+        """Gets the score of the worst provider kept, which any new provider must beat once this is full."""
+        return self.heap[0].score
+        
+    def could_place(self, score, num):
+        """Gets whether a provider with the given score and number would be kept if pushed now."""
+        if self.k <= 0:
+            return False
+        return not self.is_full() or self.heap[0] < RankedProvider(score, num)
+        
+    def push(self, provider):
+        """Offers a scored provider, keeping it only if it ranks among the best k seen so far."""
+        if self.k <= 0:
+            return
+        entry = RankedProvider(provider.score, provider.num, provider)
+        if not self.is_full():
+            heapq.heappush(self.heap, entry)
+        elif self.heap[0] < entry:
+            heapq.heapreplace(self.heap, entry)
+            
+    def get_sorted(self):
+        """Gets the providers kept, best first."""
+        return [e.provider for e in sorted(self.heap, reverse = True)]
+
+class ArrayScoringEngine(object):
+    """
+    Scores a set of providers in a single batched pass, holding their locations and percentiles as NumPy columns.
+    Distances come from the same scalar haversine as ProviderScorer.populate_score, and every step after mirrors
+    its arithmetic, including Python 2 integer division on the percentiles, so distances and scores match those of
+    the scalar implementation exactly.
+    """
+    def __init__(self, providers, scorer):
+        """Initializes an ArrayScoringEngine with a sequence of providers and the ProviderScorer holding their CDFs."""
+        self.providers = list(providers)
+        self.zipcode_repository = scorer.zipcode_repository
+        n = scorer.num_providers
+        ziphash = self.zipcode_repository.ziphash
+        
+        self.num_criteria = scorer.num_criteria
+        lats, lngs, located, static = [], [], [], []
+        # Distances are computed once for each distinct zip code, indexed by zip_positions
+        self.zip_codes = []
+        zip_positions = {}
+        positions = []
+        for p in self.providers:
+            if scorer.metric_columns:
+                static.append(sum(scorer.get_percentiles(p)))
+            else:
+                static.append(100 * scorer.r_cdf[p.overall_rating] / n + 100 * scorer.d_cdf[p.num_deficiencies] / n + 100 * scorer.p_cdf[p.num_penalties] / n)
+            mapping = ziphash.get(p.zip, None)
+            located.append(mapping is not None)
+            lats.append(mapping.lat if mapping is not None else 0.0)
+            lngs.append(mapping.lng if mapping is not None else 0.0)
+            if mapping is None:
+                positions.append(0)
+                continue
+            position = zip_positions.get(p.zip, None)
+            if position is None:
+                position = zip_positions[p.zip] = len(self.zip_codes)
+                self.zip_codes.append(p.zip)
+            positions.append(position)
+        self.lat = numpy.array(lats, dtype=numpy.float64)
+        self.lng = numpy.array(lngs, dtype=numpy.float64)
+        self.located = numpy.array(located, dtype=bool)
+        self.zip_positions = numpy.array(positions, dtype=numpy.intp)
+        # The sum of the rating, deficiencies, penalties, and any weighted metric percentiles, which don't depend on the anchor zip code
+        self.static = numpy.array(static, dtype=numpy.int64)
+        
+        distances = sorted(DOT_AVERAGE_COMMUTE_CDF)
+        self.commute_distances = numpy.array(distances, dtype=numpy.float64)
+        self.commute_scores = numpy.array([DOT_AVERAGE_COMMUTE_CDF[d] for d in distances], dtype=numpy.float64)
+        
+    def get_zip_distances(self, zipcode):
+        """
+        Gets an array of the distance in miles from each distinct zip code to the given zipcode. Each is computed by
+        the zipcode's AnchorDistances with the scalar haversine, since NumPy's trigonometry can differ from the math
+        module's in the last bits, and is shared with the scalar scorer through it. Only the percentiles and scores
+        derived from the distances are vectorized.
+        """
+        anchor = self.zipcode_repository.get_anchor_distances(zipcode)
+        return numpy.array([anchor.get_distance(z) for z in self.zip_codes], dtype=numpy.float64)
+    
+    def get_distances(self, zipcode):
+        """Gets an array of the distance in miles from each provider to the given zipcode, as computed by haversine."""
+        distances = numpy.empty(len(self.providers), dtype=numpy.float64)
+        distances.fill(float("inf"))
+        if self.zip_codes:
+            zip_distances = self.get_zip_distances(zipcode)
+            distances[self.located] = zip_distances[self.zip_positions[self.located]]
+        return distances
+    
+    def get_distance_percentiles(self, distances):
+        """
+        Vectorized get_distance_percentile. The interpolation is spelled out rather than left to numpy.interp,
+        so that each value is computed with the same operations, in the same order, as get_bisection.
+        """
+        percentiles = numpy.zeros(len(distances), dtype=numpy.float64)
+        within = distances < self.commute_distances[-1]
+        d = distances[within]
+        upper = numpy.searchsorted(self.commute_distances, d, side="right")
+        key2 = self.commute_distances[upper]
+        score2 = self.commute_scores[upper]
+        lower = upper - 1
+        has_lower = lower >= 0
+        key1 = numpy.where(has_lower, self.commute_distances[numpy.maximum(lower, 0)], 0.0)
+        score1 = numpy.where(has_lower, self.commute_scores[numpy.maximum(lower, 0)], 0.0)
+        percentiles[within] = 100 - ((score2 - score1) * (d - key1) / (key2 - key1) + score1)
+        return percentiles, within
+    
+    def get_distance_matrix(self, zipcodes):
+        """
+        Gets an array of the distance in miles from each provider (by column) to each of the given zip codes (by row).
+        The distances between each anchor zip code and every distinct provider zip code are computed once, by
+        get_zip_distances, and spread over the providers in a single batched operation.
+        """
+        matrix = numpy.empty((len(zipcodes), len(self.providers)), dtype=numpy.float64)
+        matrix.fill(float("inf"))
+        ziphash = self.zipcode_repository.ziphash
+        rows = [i for i, z in enumerate(zipcodes) if z in ziphash]
+        if not rows or not self.zip_codes:
+            return matrix
+        zip_distances = numpy.array([self.get_zip_distances(zipcodes[i]) for i in rows], dtype=numpy.float64)
+        located = numpy.flatnonzero(self.located)
+        matrix[numpy.ix_(rows, located)] = zip_distances[:, self.zip_positions[located]]
+        return matrix
+    
+    def get_scores(self, distances):
+        """
+        Gets a tuple of (float scores, integer scores, within) arrays for an array of distances of any shape, whose
+        last axis is the providers. A provider's score is its float score where within, and else its integer score.
+        """
+        percentiles, within = self.get_distance_percentiles(distances.ravel())
+        percentiles = percentiles.reshape(distances.shape)
+        within = within.reshape(distances.shape)
+        # Beyond the commute table, get_distance_percentile returns the integer 0, so the score is an integer average
+        float_scores = (self.static + percentiles) / float(self.num_criteria)
+        int_scores = self.static // self.num_criteria
+        return float_scores, int_scores, within
+    
+    def populate_provider(self, i, distance, float_score, int_score, within):
+        """Populates the score, lat, lng, and distance_miles fields on the provider at index i, from its entries in the arrays of get_scores."""
+        p = self.providers[i]
+        if self.located[i]:
+            p.lat = self.lat[i].item()
+            p.lng = self.lng[i].item()
+            p.distance_miles = distance.item()
+        p.score = float_score.item() if within else int_score.item()
+    
+    def populate_scores(self, zipcode):
+        """Populates the score, lat, lng, and distance_miles fields on each provider, as ProviderScorer.populate_score does."""
+        distances = self.get_distances(zipcode)
+        float_scores, int_scores, within = self.get_scores(distances)
+        for i in xrange(len(self.providers)):
+            self.populate_provider(i, distances[i], float_scores[i], int_scores[i], within[i])
+    
+    def get_combined_distances(self, zipcodes, combine = "min", weights = None):
+        """Gets an array of the distances of each provider from the given zip codes, combined as combine_distances does."""
+        matrix = self.get_distance_matrix(zipcodes)
+        if combine == "min":
+            return matrix.min(axis=0)
+        if combine == "mean":
+            weights = [1.0] * len(zipcodes)
+        # Summed one anchor at a time, in the same order as combine_distances
+        total = numpy.zeros(len(self.providers), dtype=numpy.float64)
+        weight_sum = 0.0
+        for row, weight in zip(matrix, weights):
+            if weight > 0:
+                total += weight * row
+                weight_sum += weight
+        return total / weight_sum
+    
+    def populate_combined_scores(self, zipcodes, combine = "min", weights = None):
+        """Populates each provider's fields as ProviderScorer.populate_combined_scores does, returning a list of their combined distances."""
+        distances = self.get_combined_distances(zipcodes, combine, weights)
+        float_scores, int_scores, within = self.get_scores(distances)
+        for i in xrange(len(self.providers)):
+            self.populate_provider(i, distances[i], float_scores[i], int_scores[i], within[i])
+        return distances.tolist()
+    
+    def get_num_ranks(self):
+        """Gets an array of the rank of each provider's number among all of theirs, which breaks ties on score."""
+        ranks = numpy.empty(len(self.providers), dtype=numpy.intp)
+        ranks[sorted(xrange(len(self.providers)), key = lambda i: self.providers[i].num)] = numpy.arange(len(self.providers))
+        return ranks
+    
+    def iter_top_providers(self, zipcodes, num_facilities, max_distance_miles = float("inf")):
+        """
+        Generates the (zipcode, top providers) tuples of ProviderScorer.iter_anchor_top_providers, from one distance matrix
+        across every anchor. Only the top providers of each anchor have their fields populated, just before they are generated.
+        """
+        distances = self.get_distance_matrix(zipcodes)
+        float_scores, int_scores, within = self.get_scores(distances)
+        ranking = numpy.where(within, float_scores, int_scores)
+        num_ranks = self.get_num_ranks()
+        for row, zipcode in enumerate(zipcodes):
+            top = []
+            if num_facilities > 0:
+                candidates = numpy.flatnonzero(distances[row] <= max_distance_miles)
+                # Best first: by descending score, and then by ascending provider number, as TopProviders sorts them
+                order = numpy.lexsort((num_ranks[candidates], -ranking[row, candidates]))[:num_facilities]
+                top = candidates[order].tolist()
+            for i in top:
+                self.populate_provider(i, distances[row, i], float_scores[row, i], int_scores[i], within[row, i])
+            yield zipcode, [self.providers[i] for i in top]
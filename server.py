@@ -0,0 +1,111 @@
+import argparse
+import json
+import threading
+import time
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from cache import DEFAULT_RESULT_CACHE_PATH, DEFAULT_RESULT_CACHE_SIZE
+from columnar import DEFAULT_COLUMNAR_PATH
+from output import parse_fields
+from snf_search import QueryError, SearchContext, add_metric_arguments, get_weighted_metrics, parse_query
+
+def parse_query_string(query_string):
+    """
+    Parses a URL query string into a tuple of (search arguments, list of fields or None), using the same parameters
+    as the command line interface. For example, zip_code=02139&num_facilities=5&nearest=1&fields=num,name is parsed
+    as 02139 --num_facilities 5 --nearest --fields num,name. Raises a ValueError naming any unknown fields.
+    """
+    params = urlparse.parse_qs(query_string, keep_blank_values = True)
+    params = { name: values[-1] for name, values in params.iteritems() }
+    # fields isn't a search parameter, but selects the attributes of each result returned
+    fields = params.pop("fields", None)
+    return parse_query(params), None if fields is None else parse_fields(fields)
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET /search requests with a JSON array of providers."""
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/search":
+            self.send_json(404, json.dumps({ "error": "not found" }))
+            return
+        # Grab the current context once, so a reload in the middle of this request can't affect it
+        context = self.server.context
+        try:
+            args, fields = parse_query_string(url.query)
+        except (TypeError, ValueError, QueryError) as e:
+            self.send_json(400, json.dumps({ "error": str(e) }))
+            return
+        self.send_json(200, "[%s]" % ", ".join(context.search(args, fields)))
+
+    def send_json(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class SearchServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server holding a warm SearchContext. When the underlying data files change, a new context
+    is loaded in the background and swapped in with a single assignment, so each request sees either the old
+    or the new data in full.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, use_csv = False, db_path = "snf.db", reload_interval = 5, columnar_path = None,
+            result_cache_size = DEFAULT_RESULT_CACHE_SIZE, result_cache_path = None, result_cache_ttl = None, metrics = None):
+        HTTPServer.__init__(self, address, SearchRequestHandler)
+        self.use_csv = use_csv
+        self.db_path = db_path
+        self.columnar_path = columnar_path
+        self.result_cache_size = result_cache_size
+        self.result_cache_path = result_cache_path
+        self.result_cache_ttl = result_cache_ttl
+        self.metrics = metrics
+        self.reload_interval = reload_interval
+        self.context = self.load_context()
+        if reload_interval > 0:
+            watcher = threading.Thread(target = self.watch)
+            watcher.daemon = True
+            watcher.start()
+
+    def load_context(self):
+        """Loads a new SearchContext from the data files, with an empty in-memory result cache."""
+        return SearchContext(self.use_csv, self.db_path, columnar_path = self.columnar_path, result_cache_size = self.result_cache_size,
+            result_cache_path = self.result_cache_path, result_cache_ttl = self.result_cache_ttl, metrics = self.metrics)
+
+    def watch(self):
+        """Polls the data files, reloading the context whenever they change."""
+        while True:
+            time.sleep(self.reload_interval)
+            if not self.context.is_stale():
+                continue
+            try:
+                self.context = self.load_context()
+            except Exception as e:
+                # Keep serving the old data if the new data can't be loaded, e.g. while it's still being written
+                print "Failed to reload data: %s" % e
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="SNF search server. Answers GET /search requests taking the same parameters as snf_search.py.")
+    argParser.add_argument("--host", dest="host", default="127.0.0.1", help="The address to listen on.")
+    argParser.add_argument("--port", dest="port", type=int, default=8080, help="The port to listen on.")
+    argParser.add_argument("--db", dest="db_path", default="snf.db", help="The sqlite database to serve.")
+    argParser.add_argument("--reload_interval", dest="reload_interval", type=float, default=5, help="Seconds between checks for changed data files, or 0 to never reload.")
+    argParser.add_argument("--csv", action="store_true")
+    argParser.add_argument("--columnar", dest="columnar_path", nargs="?", const=DEFAULT_COLUMNAR_PATH, default=None, help="Serve a columnar file written by columnar.py, snf.col by default, instead of the sqlite database.")
+    argParser.add_argument("--result_cache_size", dest="result_cache_size", type=int, default=DEFAULT_RESULT_CACHE_SIZE, help="The number of searches whose results are kept in memory.")
+    argParser.add_argument("--result_cache", dest="result_cache_path", nargs="?", const=DEFAULT_RESULT_CACHE_PATH, default=None, help="Also keep results in a sqlite result cache, snf_cache.db by default, which outlives the server.")
+    argParser.add_argument("--result_cache_ttl", dest="result_cache_ttl", type=float, default=None, help="The number of seconds cached results are used for.")
+    add_metric_arguments(argParser)
+    args = argParser.parse_args()
+    try:
+        metrics = get_weighted_metrics(args)
+    except ValueError as e:
+        argParser.error(str(e))
+
+    server = SearchServer((args.host, args.port), args.csv, args.db_path, args.reload_interval, args.columnar_path,
+        args.result_cache_size, args.result_cache_path, args.result_cache_ttl, metrics)
+    print "Serving SNF searches on http://%s:%d/search" % (args.host, args.port)
+    server.serve_forever()
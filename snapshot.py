@@ -0,0 +1,120 @@
+import hashlib
+import marshal
+import os
+import sys
+from models import ZipCodeMappingModel, ZipCodeRepository, ProviderModel, ProviderRepository
+from orm import get_all_fields
+
+# Bumped whenever the layout of a snapshot changes, so that old snapshots are rebuilt rather than misread
+SNAPSHOT_FORMAT = 1
+DEFAULT_SNAPSHOT_PATH = "snf_csv.snapshot"
+
+def get_file_hash(path, block_size = 1 << 20):
+    """Gets the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+    return digest.hexdigest()
+
+def get_sources(paths):
+    """Gets a (path, size, mtime, hash) tuple identifying the contents of each of the given files."""
+    sources = []
+    for path in paths:
+        stat = os.stat(path)
+        sources.append((path, stat.st_size, stat.st_mtime, get_file_hash(path)))
+    return sources
+
+def check_sources(sources):
+    """
+    Checks whether any of the files identified by the given (path, size, mtime, hash) tuples have changed.
+    A file whose size and mtime are unchanged is assumed unchanged. One whose size is unchanged but whose mtime
+    differs, as when it is copied or touched, is hashed to check whether its contents really changed.
+    Returns None if any file has changed or no longer exists, or else the sources with their current mtimes.
+    """
+    current = []
+    for path, size, mtime, file_hash in sources:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size != size or (stat.st_mtime != mtime and get_file_hash(path) != file_hash):
+            return None
+        current.append((path, size, stat.st_mtime, file_hash))
+    return current
+
+def write_snapshot(snapshot_path, sources, zip_repository, provider_repository):
+    """
+    Writes the zip code mappings and providers, along with their deficiency and penalty counts, to a snapshot file.
+    Records are stored as tuples of their field values, since their classes are generated at runtime. The file is
+    written alongside the snapshot and renamed over it, so a concurrent reader never sees a partial snapshot.
+    """
+    zip_fields = get_all_fields(ZipCodeMappingModel)
+    provider_fields = get_all_fields(ProviderModel)
+    save_snapshot(snapshot_path, {
+        "format": SNAPSHOT_FORMAT,
+        "sources": sources,
+        "zip_columns": [f[1].name for f in zip_fields],
+        "zip_rows": [tuple(getattr(z, f[0]) for f in zip_fields) for z in zip_repository.ziphash.itervalues()],
+        "provider_columns": [f[1].name for f in provider_fields],
+        "provider_rows": [tuple(getattr(p, f[0]) for f in provider_fields) for p in provider_repository.get_all_providers()]
+    })
+
+def save_snapshot(snapshot_path, snapshot):
+    """Writes a snapshot's dictionary to a file, via a temporary file renamed over it."""
+    temp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+    with open(temp_path, "wb") as f:
+        marshal.dump(snapshot, f)
+    os.rename(temp_path, snapshot_path)
+
+def read_snapshot(snapshot_path):
+    """Reads a snapshot file, returning its dictionary, or None if it is missing, unreadable, or of another format."""
+    try:
+        with open(snapshot_path, "rb") as f:
+            snapshot = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("format", None) != SNAPSHOT_FORMAT:
+        return None
+    return snapshot
+
+def load_repositories(snapshot):
+    """Builds a (ZipCodeRepository, ProviderRepository) tuple from a snapshot's dictionary."""
+    zip_repository = ZipCodeRepository(snapshot["zip_rows"], snapshot["zip_columns"])
+    provider_repository = ProviderRepository(snapshot["provider_rows"], snapshot["provider_columns"])
+    return zip_repository, provider_repository
+
+def load_cached(paths, load, snapshot_path = DEFAULT_SNAPSHOT_PATH):
+    """
+    Loads the zip code mappings and providers from a snapshot of the given source files, or by calling load()
+    and snapshotting its results if there is no snapshot or any of the files have changed since it was taken.
+    Returns a (ZipCodeRepository, ProviderRepository) tuple.
+
+    Arguments:
+        paths - The paths of the files the data is loaded from.
+        load - A function loading the data from those files, returning a (ZipCodeRepository, ProviderRepository) tuple.
+        snapshot_path (optional) - The path of the snapshot file.
+    """
+    snapshot = read_snapshot(snapshot_path)
+    if snapshot is not None and [s[0] for s in snapshot["sources"]] == list(paths):
+        sources = check_sources(snapshot["sources"])
+        if sources is not None:
+            if sources != snapshot["sources"]:
+                # Only the mtimes changed, so record them to avoid hashing the files again next time
+                snapshot["sources"] = sources
+                try:
+                    save_snapshot(snapshot_path, snapshot)
+                except (IOError, OSError):
+                    pass
+            return load_repositories(snapshot)
+
+    # Identify the sources before loading, so that a change made while loading triggers another rebuild
+    sources = get_sources(paths)
+    zip_repository, provider_repository = load()
+    try:
+        write_snapshot(snapshot_path, sources, zip_repository, provider_repository)
+    except (IOError, OSError) as e:
+        print >> sys.stderr, "Could not write snapshot %s: %s" % (snapshot_path, e)
+    return zip_repository, provider_repository
@@ -1,97 +1,641 @@
 import argparse
 import csv
-from models import ProviderModel, DeficiencyModel, PenaltyModel, ZipCodeRepository, ProviderRepository
-
-argParser = argparse.ArgumentParser(description="SNF search command line interface.")
-argParser.add_argument("zip_code", help="The patient's zip code.")
-argParser.add_argument("--num_facilities", dest="num_facilities", type=int, default=20, required=False, help="The maximum number of facilities to return.")
-argParser.add_argument("--min_overall_rating", dest="min_overall_rating", type=int, choices=range(1,6), default=1, required=False, help="The minimum allowable overall quality rating for each returned SNF.")
-argParser.add_argument("--max_num_deficiencies", dest="max_num_deficiencies", type=float, default=float("inf"), required=False, help="The maximum number of allowable deficiencies for each returned SNF.")
-argParser.add_argument("--max_penalties", dest="max_penalties", type=float, default=float("inf"), required=False, help="The maximum number of allowable penalties for each returned SNF.")
+import functools
+import json
+import math
+import os
+import sys
+import threading
+from orm import RowDecoder
+from models import haversine, ProviderModel, DeficiencyModel, PenaltyModel, ZipCodeRepository, ProviderRepository
+from score import COMBINE_RULES, ProviderScorer, ProviderCdfs, get_scoring_signature
+from spatial import ProviderLocator, get_bounding_boxes
+from snapshot import DEFAULT_SNAPSHOT_PATH, load_cached
+from columnar import DEFAULT_COLUMNAR_PATH, load_columnar
+from instrumentation import Profiler, profiling, stage
+from cache import DEFAULT_RESULT_CACHE_PATH, DEFAULT_RESULT_CACHE_SIZE, DiskResultCache, ResultCache
+from output import FORMATS, ResultWriter, parse_fields
+from metrics import DEFAULT_HALF_LIFE_DAYS, METRICS, WeightedMetrics
+from csv_ingest import RowCounter
+
+def get_fields(value):
+    """Parses the --fields argument, rejecting attributes providers don't have."""
+    try:
+        return parse_fields(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def add_metric_arguments(parser):
+    """Adds the arguments configuring the weighted metrics scored with each provider to the given ArgumentParser."""
+    parser.add_argument("--metrics", dest="metrics", default=None, help="A comma separated list of weighted metrics to score providers on as well, from %s." % ", ".join(METRICS))
+    parser.add_argument("--deficiency_weights", dest="deficiency_weights", default=None, help="With --metrics weighted_deficiencies, a JSON object of the weight of deficiencies by tag or tag prefix, e.g. {\"K\": 0.5, \"F0880\": 3}. Others weigh 1.")
+    parser.add_argument("--half_life_days", dest="half_life_days", type=float, default=DEFAULT_HALF_LIFE_DAYS, help="With --metrics recent_deficiencies, the number of days over which a deficiency's weight halves.")
+    parser.add_argument("--metrics_as_of", dest="metrics_as_of", default=None, help="With --metrics recent_deficiencies, the YYYY-MM-DD date deficiencies are decayed to, defaulting to the latest survey date.")
+    return parser
+
+def get_weighted_metrics(args):
+    """Gets the WeightedMetrics configured by the arguments added by add_metric_arguments, or None if none are scored. Raises a ValueError if they are invalid."""
+    if args.metrics is None:
+        return None
+    if args.columnar_path is not None and not args.csv:
+        raise ValueError("--metrics can't be computed from a columnar file")
+    weights = json.loads(args.deficiency_weights) if args.deficiency_weights is not None else None
+    if weights is not None and not isinstance(weights, dict):
+        raise ValueError("--deficiency_weights must be a JSON object")
+    return WeightedMetrics([m.strip() for m in args.metrics.split(",") if m.strip()], weights, half_life_days = args.half_life_days, as_of = args.metrics_as_of)
+
+def parse_list(value):
+    """Parses a comma separated list argument, such as --anchors."""
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+def format_zip_code(zip_code):
+    """Formats a zip code given as a string or a number, restoring the leading zeroes numbers have lost."""
+    return "%05d" % zip_code if isinstance(zip_code, (int, long)) else str(zip_code)
+
+def get_anchors(args):
+    """
+    Gets a tuple of (list of anchor zip codes, list of their weights or None) for a search, whose first anchor is the
+    patient's zip code. Raises a QueryError if --anchors, --combine, and --anchor_weights don't agree.
+    """
+    zip_codes = [args.zip_code] + (args.anchors or [])
+    if args.anchor_weights is None:
+        if args.combine == "weighted":
+            raise QueryError("--combine weighted requires --anchor_weights")
+        return zip_codes, None
+    if args.combine != "weighted":
+        raise QueryError("--anchor_weights requires --combine weighted")
+    try:
+        weights = [float(w) for w in args.anchor_weights]
+    except ValueError:
+        raise QueryError("--anchor_weights must be a list of numbers")
+    if len(weights) != len(zip_codes):
+        raise QueryError("--anchor_weights needs a weight for the patient's zip code and each of --anchors")
+    if any(w < 0 or w != w for w in weights) or not sum(weights) > 0:
+        raise QueryError("--anchor_weights must be non-negative and not all 0")
+    return zip_codes, weights
+
+def add_query_arguments(parser):
+    """Adds the arguments describing a single search to the given ArgumentParser."""
+    parser.add_argument("zip_code", help="The patient's zip code.")
+    parser.add_argument("--num_facilities", dest="num_facilities", type=int, default=20, required=False, help="The maximum number of facilities to return.")
+    parser.add_argument("--min_overall_rating", dest="min_overall_rating", type=int, choices=range(1,6), default=1, required=False, help="The minimum allowable overall quality rating for each returned SNF.")
+    parser.add_argument("--max_num_deficiencies", dest="max_num_deficiencies", type=float, default=float("inf"), required=False, help="The maximum number of allowable deficiencies for each returned SNF.")
+    parser.add_argument("--max_penalties", dest="max_penalties", type=float, default=float("inf"), required=False, help="The maximum number of allowable penalties for each returned SNF.")
+    parser.add_argument("--max_distance_miles", dest="max_distance_miles", type=float, default=float("inf"), required=False, help="The maximum distance in miles from the patient's zip code of each returned SNF.")
+    parser.add_argument("--anchors", dest="anchors", type=parse_list, default=None, help="A comma separated list of other zip codes, such as a caregiver's, to score distances from along with the patient's.")
+    parser.add_argument("--combine", dest="combine", choices=COMBINE_RULES, default="min", help="With --anchors, how distances from each zip code are combined: the distance from the nearest, the mean, or the weighted mean.")
+    parser.add_argument("--anchor_weights", dest="anchor_weights", type=parse_list, default=None, help="With --combine weighted, a comma separated list of the weight of the patient's zip code and each of --anchors.")
+    parser.add_argument("--nearest", action="store_true", help="Score SNFs in order of distance from the patient's zip code, stopping once no farther SNF can place in the top num_facilities.")
+    return parser
+
+argParser = add_query_arguments(argparse.ArgumentParser(description="SNF search command line interface."))
 argParser.add_argument("--csv", action="store_true")
+argParser.add_argument("--snapshot", dest="snapshot_path", default=DEFAULT_SNAPSHOT_PATH, help="With --csv, the snapshot file the parsed CSV files are cached in.")
+argParser.add_argument("--no_snapshot", action="store_true", help="With --csv, always parse the CSV files rather than loading or writing a snapshot.")
+argParser.add_argument("--csv_workers", dest="csv_workers", type=int, default=None, help="With --csv, the number of worker processes counting deficiencies and penalties. Defaults to the number of CPUs.")
+argParser.add_argument("--columnar", dest="columnar_path", nargs="?", const=DEFAULT_COLUMNAR_PATH, default=None, help="Search a columnar file written by columnar.py, snf.col by default, instead of the sqlite database.")
+argParser.add_argument("--profile", dest="profile_path", nargs="?", const="-", default=None, help="Write a JSON report of the time, rows, and memory of each stage of the search to the given file, or to stderr.")
+argParser.add_argument("--cprofile", dest="cprofile_stages", default=None, help="With --profile, a comma separated list of stages to also run under cProfile, such as score.")
+argParser.add_argument("--result_cache", dest="result_cache_path", nargs="?", const=DEFAULT_RESULT_CACHE_PATH, default=None, help="Answer the search from, and save its results to, a sqlite result cache, snf_cache.db by default.")
+argParser.add_argument("--no_tiles", action="store_true", help="Always search every provider, rather than answering from the tiles built by tiles.py.")
+add_metric_arguments(argParser)
+argParser.add_argument("--format", dest="format", choices=FORMATS, default="ndjson", help="Write the results as one JSON object per line, a JSON array, or CSV with a header row.")
+argParser.add_argument("--fields", dest="fields", type=get_fields, default=None, help="A comma separated list of the attributes of each result to write, such as name,city,score, rather than all of them.")
+argParser.add_argument("--result_cache_ttl", dest="result_cache_ttl", type=float, default=None, help="With --result_cache, the number of seconds cached results are used for.")
+
+class QueryError(Exception):
+    """Raised when the parameters of a search request are invalid."""
+    pass
+
+class QueryArgumentParser(argparse.ArgumentParser):
+    """An ArgumentParser for search requests, which raises a QueryError instead of exiting on invalid arguments."""
+    def error(self, message):
+        raise QueryError(message)
+
+queryParser = add_query_arguments(QueryArgumentParser(description="SNF search request."))
+
+def parse_query(params):
+    """
+    Parses a dictionary of search parameters, named as the command line arguments are, into search arguments.
+    For example, { "zip_code": "02139", "num_facilities": 5, "nearest": True } is parsed as 02139 --num_facilities 5 --nearest.
+    """
+    params = dict(params)
+    if params.get("zip_code", None) is None:
+        raise QueryError("zip_code is required")
+    zip_code = params.pop("zip_code")
+    argv = [format_zip_code(zip_code)]
+    for name, value in params.iteritems():
+        if value is None:
+            continue
+        if name == "nearest":
+            if value not in (False, 0, "", "0") and str(value).lower() != "false":
+                argv.append("--nearest")
+        elif isinstance(value, (list, tuple)):
+            # Lists, such as anchors, are given as they are on the command line
+            argv.extend(["--%s" % name, ",".join(format_zip_code(v) if name == "anchors" else str(v) for v in value)])
+        else:
+            argv.extend(["--%s" % name, str(value)])
+    args = queryParser.parse_args(argv)
+    get_anchors(args)
+    return args
+
+def normalize_count_limit(limit):
+    """
+    Normalizes a maximum number of deficiencies or penalties. Counts are whole numbers, so a count is below
+    any limit exactly when it is below the limit rounded up, e.g. 2.5 and 3 allow the same providers.
+    """
+    limit = float(limit)
+    if math.isinf(limit) or math.isnan(limit):
+        return limit
+    return float(math.ceil(limit))
+
+def get_query_key(args):
+    """
+    Gets a tuple identifying the results of a search, which is the same for any two searches with the same results.
+    --nearest only changes how the results are found, so it isn't part of the key.
+    """
+    key = (args.zip_code, max(args.num_facilities, 0), args.min_overall_rating, normalize_count_limit(args.max_num_deficiencies),
+        normalize_count_limit(args.max_penalties), float(args.max_distance_miles))
+    if args.anchors:
+        zip_codes, weights = get_anchors(args)
+        key += (tuple(zip_codes), args.combine, None if weights is None else tuple(weights))
+    return key
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+def passes_filters(provider, args):
+    """Gets whether the given provider passes the rating, deficiency, and penalty filters of a search."""
+    return provider.num_deficiencies < args.max_num_deficiencies and provider.num_penalties < args.max_penalties and provider.overall_rating > args.min_overall_rating
+
+CSV_FILES = ["zip_code_centroids.csv", "ProviderInfo_Download.csv", "Deficiencies_Download.csv", "Penalties_Download.csv"]
+
+def load_csv(snapshot_path = None, metrics = None, workers = None):
+    """
+    Loads the zip code mappings, providers, deficiencies, and penalties from the CSV files in the current directory.
+    Returns a tuple of (ZipCodeRepository, ProviderRepository, ProviderCdfs) for the loaded data.
+
+    Arguments:
+        snapshot_path (optional) - The path of a snapshot file. If given, the data is loaded from the snapshot unless any
+            of the CSV files have changed since it was written, in which case they are parsed and the snapshot rewritten.
+        metrics (optional) - A WeightedMetrics to compute from the deficiency and penalty files, which aren't snapshotted.
+        workers (optional) - The number of worker processes counting the deficiency and penalty files, defaulting to the number of CPUs.
+    """
+    if snapshot_path is None:
+        zip_repository, provider_repository = parse_csv(workers)
+    else:
+        # Stages parsing the CSV files are only reported when the snapshot is out of date
+        with stage("snapshot_load") as s:
+            zip_repository, provider_repository = load_cached(CSV_FILES, functools.partial(parse_csv, workers), snapshot_path)
+            s.rows = len(provider_repository.provider_hash)
+    # Every provider is loaded, so the CDFs can be computed from the repository
+    with stage("cdfs") as s:
+        cdfs = ProviderCdfs.from_providers(provider_repository.get_all_providers())
+        s.rows = cdfs.num_providers
+    if metrics is not None:
+        with stage("metrics") as s:
+            cdfs.metrics = metrics.compute_csv("Deficiencies_Download.csv", "Penalties_Download.csv", provider_repository.provider_hash)
+            s.rows = sum(len(values) for values in cdfs.metrics.values)
+    return zip_repository, provider_repository, cdfs
+
+def parse_csv(workers = None):
+    """
+    Parses the zip code mappings, providers, deficiencies, and penalties from the CSV files in the current directory,
+    returning a tuple of (ZipCodeRepository, ProviderRepository) holding providers with their deficiency and penalty counts.
+    The deficiency and penalty files are counted in chunks by a RowCounter with the given number of worker processes,
+    while this process parses the zip code and provider files.
+    """
+    # We're only getting counts of deficiencies / penalties... the weighted metrics in metrics.py
+    # take in the nature of the deficiencies / penalties, in a separate pass when they are scored.
+    counter = RowCounter(["Deficiencies_Download.csv", "Penalties_Download.csv"], workers)
+    try:
+        # Read zip code file, creating a dictionary to look up coordinates later...
+        with stage("zip_repository") as s:
+            with open("zip_code_centroids.csv", "rb") as zipfile:
+                zipreader = csv.reader(zipfile)
+                zip_repository = ZipCodeRepository(zipreader, next(zipreader))
+            s.rows = len(zip_repository.ziphash)
+
+        # Read providers file, creating provider objects and interning them in Provider.Repository
+        with stage("provider_repository") as s:
+            with open("ProviderInfo_Download.csv", "rb") as provider_file:
+                provider_reader = csv.reader(provider_file)
+                provider_repository = ProviderRepository(provider_reader, next(provider_reader))
+            s.rows = len(provider_repository.provider_hash)
+
+        with stage("deficiency_counts") as s:
+            counts = counter.get_counts("Deficiencies_Download.csv")
+            for num, count in counts.iteritems():
+                provider = provider_repository.get_provider_by_num(num)
+                if provider is not None:
+                    provider.num_deficiencies += count
+            s.rows = sum(counts.itervalues())
+        with stage("penalty_counts") as s:
+            counts = counter.get_counts("Penalties_Download.csv")
+            for num, count in counts.iteritems():
+                provider = provider_repository.get_provider_by_num(num)
+                if provider is not None:
+                    provider.num_penalties += count
+            s.rows = sum(counts.itervalues())
+    finally:
+        counter.close()
+    return zip_repository, provider_repository
+
+def get_column_names(cursor):
+    """Gets the column names of the rows returned by a sqlite cursor."""
+    return [col[0] for col in cursor.description]
 
-args = argParser.parse_args()
+def has_table(connection, name):
+    """Gets whether a sqlite database has a table, or virtual table, with the given name."""
+    return connection.execute("SELECT count(*) FROM sqlite_master WHERE name=?", (name,)).fetchone()[0] > 0
 
+def read_cdfs(connection):
+    """Reads the rows of the provider_cdf table as dictionaries, returning a tuple of (rows, the number of providers)."""
+    cdf_cursor = connection.cursor()
+    cdf_cursor.row_factory = dict_factory
+    cdf_rows = cdf_cursor.execute("SELECT metric, value, rank FROM provider_cdf").fetchall()
+    num_providers = connection.execute("SELECT count(*) FROM provider_stats").fetchone()[0]
+    return cdf_rows, num_providers
 
-if args.csv:
-    zipfile = open("zip_code_centroids.csv", "r")
-    zipreader = csv.DictReader(zipfile)
-    
-    provider_file = open("ProviderInfo_Download.csv", "r")
-    provider_reader = csv.DictReader(provider_file)
+def get_count_conditions(args, conditions, params):
+    """Adds the SQL conditions, and their parameters, of a search's rating, deficiency, and penalty filters on providers p and their stats s."""
+    conditions.append("p.overall_rating > ?")
+    params.append(args.min_overall_rating)
+    if args.max_num_deficiencies != float("inf"):
+        conditions.append("s.num_deficiencies < ?")
+        params.append(args.max_num_deficiencies)
+    if args.max_penalties != float("inf"):
+        conditions.append("s.num_penalties < ?")
+        params.append(args.max_penalties)
 
-    deficiencies_file = open("Deficiencies_Download.csv", "r")
-    deficiencies_reader = csv.DictReader(deficiencies_file)
+def load_tile(db_path, args):
+    """
+    Loads the zip code mappings, providers, and CDFs needed to answer a search from a tile built by tiles.py.
+    Only the providers of the tile for the patient's region, of the tightest filter profile that allows every
+    provider the search does, are loaded. Returns a tuple of (ZipCodeRepository, ProviderRepository, ProviderCdfs,
+    threshold), or None if there is no such tile of the current data version large enough for the search.
+    A search's results are only those of the tile if its worst result scores above the threshold.
+    """
+    import sqlite3
+
+    # Tiles are built around a single anchor zip code
+    if args.anchors or not os.path.exists(db_path):
+        return None
+    version = get_dataset_version([db_path], db_path)
+    connection = sqlite3.connect(db_path)
+    connection.text_factory = str
+    try:
+        if not has_table(connection, "tile_profile"):
+            return None
+        anchor = connection.execute("SELECT zip_code, lat, lng FROM zipcode_mapping WHERE zip_code=?", (args.zip_code,)).fetchone()
+        if anchor is None or None in anchor:
+            return None
+        tile = connection.execute("""SELECT t.profile, r.region, r.threshold FROM tile_profile t INNER JOIN tile_region r ON r.profile=t.profile
+            WHERE r.region=substr(?, 1, t.region_digits) AND t.version=? AND t.tile_size >= ? AND t.min_overall_rating <= ? AND t.max_num_deficiencies >= ? AND t.max_penalties >= ?
+            ORDER BY t.min_overall_rating DESC, t.max_num_deficiencies, t.max_penalties, t.region_digits DESC, t.tile_size LIMIT 1""",
+            (args.zip_code, version, args.num_facilities, args.min_overall_rating, args.max_num_deficiencies, args.max_penalties)).fetchone()
+        if tile is None:
+            return None
+        profile, region, threshold = tile
+        with stage("tile_fetch") as s:
+            conditions = ["t.profile=?", "t.region=?"]
+            params = [profile, region]
+            get_count_conditions(args, conditions, params)
+            provider_cursor = connection.execute("""SELECT p.*, s.num_deficiencies AS num_deficiencies, s.num_penalties AS num_penalties, z.lat AS zip_lat, z.lng AS zip_lng
+                FROM provider_tile t INNER JOIN provider p ON p.num=t.num INNER JOIN provider_stats s ON s.num=p.num
+                LEFT JOIN zipcode_mapping z ON z.zip_code=p.zip WHERE %s""" % " AND ".join(conditions), params)
+            provider_columns = get_column_names(provider_cursor)
+            provider_rows = provider_cursor.fetchall()
+            zip_index, lat_index, lng_index = [provider_columns.index(c) for c in ("zip", "zip_lat", "zip_lng")]
+            zip_rows = [(row[zip_index], row[lat_index], row[lng_index]) for row in provider_rows if row[lat_index] is not None]
+            zip_rows.append(anchor)
+            cdf_rows, num_providers = read_cdfs(connection)
+            s.rows = len(provider_rows) + len(zip_rows) + len(cdf_rows)
+    finally:
+        connection.close()
+    zip_repository = ZipCodeRepository(zip_rows, ["zip_code", "lat", "lng"])
+    provider_repository = ProviderRepository(provider_rows, provider_columns)
+    return zip_repository, provider_repository, ProviderCdfs.from_rows(cdf_rows, num_providers), threshold
 
-    penalties_file = open("Penalties_Download.csv", "r")
-    penalties_reader = csv.DictReader(penalties_file)
-else:
-    # Default to the Sqlite implementation
+def search_tile(db_path, args):
+    """
+    Runs a search over a tile built by tiles.py, as load_tile describes, returning its top scoring providers,
+    or None if there is no tile for it or providers outside the tile might have placed among them.
+    """
+    tile = load_tile(db_path, args)
+    if tile is None:
+        return None
+    zip_repository, provider_repository, cdfs, threshold = tile
+    with stage("scorer_init"):
+        scorer = ProviderScorer(provider_repository, zip_repository, cdfs)
+    results = search(scorer, provider_repository.get_all_providers(), args)
+    # Without a threshold, the tile holds every provider its profile allows
+    if threshold is None or (len(results) >= args.num_facilities > 0 and results[-1].score > threshold):
+        return results
+    return None
+
+def load_sqlite(db_path = "snf.db", args = None, metrics = None):
+    """
+    Loads the zip code mappings, providers, and precomputed CDFs from a database built by csv_to_sqlite.py.
+    Returns a tuple of (ZipCodeRepository, ProviderRepository, ProviderCdfs) for the loaded data.
+
+    Arguments:
+        db_path (optional) - The path to the sqlite database.
+        args (optional) - Search arguments. If given, only providers passing their filters are loaded. With a
+            maximum distance, only the zip codes of the patient and those providers are loaded too.
+        metrics (optional) - A WeightedMetrics to compute for every provider, whether or not it is loaded.
+    """
     # This is an optimization over the standard, CSV implemenatation and
     # is one step closer to a production solution. It saves time and memory
     # by allowing us to filter out providers and deficiences / penalties at
     # query-time, before ever loading them into memory. It is intended to be used
-    # with csv_to_sqlite.py, also provided in this package. 
+    # with csv_to_sqlite.py, also provided in this package.
     import sqlite3
-    
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
-    connection = sqlite3.connect("snf.db")
+
+    connection = sqlite3.connect(db_path)
     connection.text_factory = str
-    connection.row_factory = dict_factory
-    zip_cursor = connection.execute("SELECT * FROM zipcode_mapping")
-    # NOTE: for an accurate CDF of overall_ratings / deficiences / penalties,
-    # we need to pull in all providers. In reality, we'd want to precompute these 
-    # anyway, which would allow us to uncomment the query filters below. 
-    provider_cursor = connection.execute("SELECT * FROM provider")# WHERE overall_rating >= ?", (args.min_overall_rating,))
-    select_statement = "SELECT p.num AS num, count(*) AS count FROM %s d INNER JOIN provider p ON d.provider_num=p.num GROUP BY p.num"
-    deficiencies_cursor = connection.execute(select_statement%"deficiency")
-    penalties_cursor = connection.execute(select_statement%"penalty")
-    
-    zipreader = zip_cursor.fetchall()
-    provider_reader = provider_cursor.fetchall()
-    deficiencies_reader = deficiencies_cursor.fetchall()
-    penalties_reader = penalties_cursor.fetchall()
-    
+    # Registered so that distances computed in SQL are exactly those the scorer computes
+    connection.create_function("haversine", 4, haversine)
+
+    # The CDFs of overall_ratings / deficiencies / penalties are precomputed by csv_to_sqlite.py,
+    # along with each provider's deficiency and penalty counts, so we only need to pull in
+    # the providers that pass the query filters.
+    provider_statement = "SELECT p.*, s.num_deficiencies AS num_deficiencies, s.num_penalties AS num_penalties FROM provider p INNER JOIN provider_stats s ON s.num=p.num"
+    conditions = []
+    provider_params = []
+    # The radius is only around the patient's zip code when there are no other anchors
+    located = args is not None and args.max_distance_miles != float("inf") and not args.anchors and has_table(connection, "provider_location")
+    if args is not None:
+        get_count_conditions(args, conditions, provider_params)
+    if located:
+        # Only providers within the search radius are loaded, found through the provider_location R*Tree
+        # by a bounding box around the patient's zip code, then checked with haversine.
+        anchor = connection.execute("SELECT lat, lng FROM zipcode_mapping WHERE zip_code=?", (args.zip_code,)).fetchone()
+        provider_statement = """SELECT p.*, s.num_deficiencies AS num_deficiencies, s.num_penalties AS num_penalties, z.lat AS zip_lat, z.lng AS zip_lng
+            FROM provider_location l INNER JOIN provider p ON p.rowid=l.id INNER JOIN provider_stats s ON s.num=p.num
+            INNER JOIN zipcode_mapping z ON z.zip_code=p.zip"""
+        if anchor is None or None in anchor:
+            # Nothing is within a finite distance of an unknown zip code
+            conditions.append("0")
+        else:
+            lat, lng = anchor
+            boxes = get_bounding_boxes(lat, lng, args.max_distance_miles)
+            conditions.append("(%s)" % " OR ".join(["(l.max_lat >= ? AND l.min_lat <= ? AND l.max_lng >= ? AND l.min_lng <= ?)"] * len(boxes)))
+            for min_lat, max_lat, min_lng, max_lng in boxes:
+                provider_params.extend([min_lat, max_lat, min_lng, max_lng])
+            conditions.append("haversine(z.lng, z.lat, ?, ?) <= ?")
+            provider_params.extend([lng, lat, args.max_distance_miles])
+    if conditions:
+        provider_statement += " WHERE " + " AND ".join(conditions)
+    with stage("sqlite_fetch") as s:
+        provider_cursor = connection.execute(provider_statement, provider_params)
+        provider_columns = get_column_names(provider_cursor)
+        provider_rows = provider_cursor.fetchall()
+        if located:
+            # Only the zip codes of the patient and the loaded providers are needed
+            zip_index, lat_index, lng_index = [provider_columns.index(c) for c in ("zip", "zip_lat", "zip_lng")]
+            zip_columns = ["zip_code", "lat", "lng"]
+            zip_rows = [(row[zip_index], row[lat_index], row[lng_index]) for row in provider_rows]
+            if anchor is not None:
+                zip_rows.append((args.zip_code, anchor[0], anchor[1]))
+        else:
+            zip_cursor = connection.execute("SELECT * FROM zipcode_mapping")
+            zip_columns = get_column_names(zip_cursor)
+            zip_rows = zip_cursor.fetchall()
+        cdf_rows, num_providers = read_cdfs(connection)
+        s.rows = len(provider_rows) + len(zip_rows) + len(cdf_rows)
+
+    # Rows are decoded positionally, by decoders compiled for each layout of columns
+    with stage("zip_repository") as s:
+        zip_repository = ZipCodeRepository(zip_rows, zip_columns)
+        s.rows = len(zip_rows)
+    with stage("provider_repository") as s:
+        provider_repository = ProviderRepository(provider_rows, provider_columns)
+        s.rows = len(provider_rows)
+    with stage("cdfs") as s:
+        cdfs = ProviderCdfs.from_rows(cdf_rows, num_providers)
+        s.rows = len(cdf_rows)
+    if metrics is not None:
+        # Aggregated in sqlite, so no deficiency or penalty rows are loaded
+        with stage("metrics") as s:
+            cdfs.metrics = metrics.compute_sqlite(connection)
+            s.rows = sum(len(values) for values in cdfs.metrics.values)
+
     connection.close()
-    
-# Read zip code file, creating a dictionary to look up coordinates later...
-zip_repository = ZipCodeRepository(zipreader)
-
-# Read providers file, creating provider objects and interning them in Provider.Repository
-provider_repository = ProviderRepository(provider_reader)
-    
-# We're only getting counts of deficiencies / penalties...
-# This would need to change if we want to take in the nature of the deficiencies / penalties 
-# while computing the score. 
-for row in deficiencies_reader:
-    provider = provider_repository.get_provider(row)
-    # Sql implementation will have already rolled up all rows into a count
-    # For CSV, we need to count them one at a time
-    provider.num_deficiencies += row["count"] if "count" in row else 1
-for row in penalties_reader:
-    provider = provider_repository.get_provider(row)
-    provider.num_penalties += row["count"] if "count" in row else 1
-
-# If we're using the csv implementation, make sure and close up those files...
-if args.csv:
-    zipfile.close()
-    provider_file.close()
-    deficiencies_file.close()
-    penalties_file.close()
-    
-from score import ProviderScorer
-
-scorer = ProviderScorer(provider_repository, zip_repository)
-
-filtered_providers = [p for p in provider_repository.get_all_providers() if p.num_deficiencies < args.max_num_deficiencies and p.num_penalties < args.max_penalties and p.overall_rating > args.min_overall_rating]
-
-scorer.populate_all_scores(filtered_providers, args.zip_code)
-
-filtered_providers.sort(key = lambda p: -p.score)
-
-for p in filtered_providers[:args.num_facilities]:
-    print p.toJson()
\ No newline at end of file
+    return zip_repository, provider_repository, cdfs
+
+def search(scorer, providers, args, locator = None):
+    """Runs a search, returning the top scoring providers that pass its filters, best first.
+
+    Arguments:
+        scorer - The ProviderScorer to score providers with.
+        providers - A sequence of candidate providers.
+        args - The search arguments, as parsed by argParser.
+        locator (optional) - A ProviderLocator over the candidate providers, which is built if needed and not given.
+    """
+    if args.anchors:
+        # Distances are combined across every anchor in one batched pass, so --nearest doesn't apply
+        zip_codes, weights = get_anchors(args)
+        filtered_providers = [p for p in providers if passes_filters(p, args)]
+        return scorer.get_combined_top_providers(filtered_providers, zip_codes, args.num_facilities, args.combine, weights, args.max_distance_miles)
+    if args.nearest or args.max_distance_miles != float("inf"):
+        if locator is None:
+            locator = ProviderLocator(providers, scorer.zipcode_repository)
+        if args.nearest:
+            return scorer.get_nearest_top_providers(locator, args.zip_code, args.num_facilities, args.max_distance_miles, lambda p: passes_filters(p, args))
+        providers = locator.within_miles(args.zip_code, args.max_distance_miles)
+    filtered_providers = [p for p in providers if passes_filters(p, args)]
+    return scorer.get_top_providers(filtered_providers, args.zip_code, args.num_facilities)
+
+def get_fingerprint(paths):
+    """Gets a tuple identifying the current contents of the given files by their sizes and modification times."""
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_size, stat.st_mtime))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+def get_dataset_version(paths, db_path = None, metrics = None):
+    """
+    Gets a string identifying the version of the data and of the scoring that results are computed with.
+    For a sqlite database, the data version is the build id and number of its latest dataset_version, which only
+    change when a build or refresh of it changes the data. A database without a build id, or any other data source,
+    is versioned by the fingerprint of the files the data is loaded from.
+    The scoring includes the configuration of any WeightedMetrics scored.
+    """
+    data_version = None
+    if db_path is not None and os.path.exists(db_path):
+        import sqlite3
+        try:
+            connection = sqlite3.connect(db_path)
+            try:
+                if has_table(connection, "dataset_version"):
+                    row = connection.execute("SELECT build, version FROM dataset_version ORDER BY version DESC LIMIT 1").fetchone()
+                    if row is not None and row[0] is not None:
+                        data_version = "sqlite:%s:%s" % row
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            pass
+    if data_version is None:
+        data_version = repr(get_fingerprint(paths))
+    return "%s|%s" % (data_version, get_scoring_signature(metrics))
+
+class SearchContext(object):
+    """
+    Everything needed to answer searches against one version of the data: the repositories, the scorer, and a
+    ProviderLocator over all providers. A context is never modified once built, apart from the scores written
+    onto its providers while a search runs, so searches against it are serialized with a lock. The results of
+    searches are kept in a ResultCache for this version of the data.
+    """
+    def __init__(self, use_csv = False, db_path = "snf.db", snapshot_path = DEFAULT_SNAPSHOT_PATH, columnar_path = None,
+            result_cache_size = DEFAULT_RESULT_CACHE_SIZE, result_cache_path = None, result_cache_ttl = None, metrics = None):
+        """
+        Loads a SearchContext from the CSV files in the current directory, from a columnar file if columnar_path
+        is given, or else from the given sqlite database. The CSV files are loaded through a snapshot at
+        snapshot_path, unless it is None. Results are cached for result_cache_ttl seconds, or until evicted,
+        in memory for up to result_cache_size searches, and in a DiskResultCache at result_cache_path if given.
+        Providers are scored on the WeightedMetrics given by metrics as well, which columnar files don't hold.
+        """
+        if metrics is not None and not use_csv and columnar_path is not None:
+            raise ValueError("weighted metrics can't be computed from a columnar file")
+        self.paths = CSV_FILES if use_csv else [columnar_path] if columnar_path is not None else [db_path]
+        # Fingerprint before loading, so that a change made while loading triggers another reload
+        self.fingerprint = get_fingerprint(self.paths)
+        self.version = get_dataset_version(self.paths, None if use_csv or columnar_path is not None else db_path, metrics)
+        disk = None if result_cache_path is None else DiskResultCache(result_cache_path, self.version, ttl = result_cache_ttl)
+        self.result_cache = ResultCache(self.version, result_cache_size, result_cache_ttl, disk)
+        if use_csv:
+            self.zip_repository, self.provider_repository, cdfs = load_csv(snapshot_path, metrics)
+        elif columnar_path is not None:
+            self.zip_repository, self.provider_repository, cdfs = load_columnar(columnar_path)
+        else:
+            self.zip_repository, self.provider_repository, cdfs = load_sqlite(db_path, metrics = metrics)
+        self.scorer = ProviderScorer(self.provider_repository, self.zip_repository, cdfs)
+        self.providers = list(self.provider_repository.get_all_providers())
+        self.locator = ProviderLocator(self.providers, self.zip_repository)
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        """Gets whether the files this context was loaded from have changed since."""
+        return get_fingerprint(self.paths) != self.fingerprint
+
+    def search(self, args, fields = None):
+        """
+        Runs a search, returning a list of the JSON representation of each top provider, with only the given
+        list of fields if any.
+        """
+        key = get_query_key(args) + (None if fields is None else tuple(fields),)
+        with self.lock:
+            results = self.result_cache.get(key)
+            if results is None:
+                # Scores live on the shared provider objects, so serialize them before releasing the lock
+                encoder = ProviderModel.get_json_encoder(fields)
+                results = [encoder(p) for p in search(self.scorer, self.providers, args, self.locator)]
+                self.result_cache.put(key, results)
+            return results
+
+    def search_anchors(self, args, fields = None):
+        """
+        Runs the search of args from each of its anchor zip codes on its own, the patient's and then each of its
+        anchors, returning a list of (zip code, list of the JSON representation of each top provider) tuples. The
+        results of each are those of a search from that zip code alone, and share its cache entries. Anchors whose
+        results aren't cached are scored together, against one matrix of distances from each of them.
+        """
+        zip_codes = get_anchors(args)[0]
+        fields_key = (None if fields is None else tuple(fields),)
+        keys = {}
+        for zip_code in zip_codes:
+            anchor_args = argparse.Namespace(**vars(args))
+            anchor_args.zip_code, anchor_args.anchors, anchor_args.combine, anchor_args.anchor_weights = zip_code, None, "min", None
+            keys[zip_code] = get_query_key(anchor_args) + fields_key
+        with self.lock:
+            results = {}
+            for zip_code, key in keys.iteritems():
+                cached = self.result_cache.get(key)
+                if cached is not None:
+                    results[zip_code] = cached
+            missing = [z for z in keys if z not in results]
+            if missing:
+                encoder = ProviderModel.get_json_encoder(fields)
+                filtered_providers = [p for p in self.providers if passes_filters(p, args)]
+                # Scores live on the shared provider objects, so each anchor's are serialized before the next is scored
+                for zip_code, top in self.scorer.iter_anchor_top_providers(filtered_providers, missing, args.num_facilities, args.max_distance_miles):
+                    results[zip_code] = [encoder(p) for p in top]
+                    self.result_cache.put(keys[zip_code], results[zip_code])
+            return [(zip_code, results[zip_code]) for zip_code in zip_codes]
+
+def run(args, output_file = sys.stdout, metrics = None):
+    """
+    Loads the data and runs a search, writing the top providers to output_file in the format given by args.
+    Providers are scored on the WeightedMetrics given by metrics as well.
+    """
+    writer = ResultWriter(output_file, args.format, args.fields)
+    result_cache = None
+    if args.result_cache_path is not None:
+        # The data is only loaded if the result cache misses
+        with stage("result_cache") as s:
+            paths = CSV_FILES if args.csv else [args.columnar_path] if args.columnar_path is not None else ["snf.db"]
+            version = get_dataset_version(paths, None if args.csv or args.columnar_path is not None else "snf.db", metrics)
+            result_cache = ResultCache(version, 0, disk = DiskResultCache(args.result_cache_path, version, ttl = args.result_cache_ttl))
+            # Results are cached as written, so the format and fields are part of the key
+            key = get_query_key(args) + (args.format, None if args.fields is None else tuple(args.fields))
+            results = result_cache.get(key)
+            s.rows = 0 if results is None else len(results)
+        if results is not None:
+            with stage("output") as s:
+                writer.write_serialized(results)
+                writer.close()
+                s.rows = len(results)
+            return
+
+    results = None
+    # Tiles are built without weighted metrics
+    if not args.csv and args.columnar_path is None and not args.no_tiles and metrics is None:
+        results = search_tile("snf.db", args)
+    if results is None:
+        if args.csv:
+            zip_repository, provider_repository, cdfs = load_csv(None if args.no_snapshot else args.snapshot_path, metrics, args.csv_workers)
+        elif args.columnar_path is not None:
+            with stage("columnar_load") as s:
+                zip_repository, provider_repository, cdfs = load_columnar(args.columnar_path, args)
+                s.rows = len(provider_repository.provider_hash)
+        else:
+            # Default to the Sqlite implementation
+            zip_repository, provider_repository, cdfs = load_sqlite("snf.db", args, metrics)
+
+        with stage("scorer_init"):
+            scorer = ProviderScorer(provider_repository, zip_repository, cdfs)
+
+        results = search(scorer, provider_repository.get_all_providers(), args)
+    with stage("output") as s:
+        results = writer.serialize(results)
+        writer.write_serialized(results)
+        writer.close()
+        s.rows = len(results)
+    if result_cache is not None:
+        result_cache.put(key, results)
+
+def main():
+    args = argParser.parse_args()
+    try:
+        metrics = get_weighted_metrics(args)
+        get_anchors(args)
+    except (ValueError, QueryError) as e:
+        argParser.error(str(e))
+    if args.profile_path is None:
+        run(args, metrics = metrics)
+        return
+    profiler = Profiler(args.cprofile_stages.split(",") if args.cprofile_stages else ())
+    with profiling(profiler):
+        run(args, metrics = metrics)
+    profiler.write_report(args.profile_path)
+
+if __name__ == "__main__":
+    main()
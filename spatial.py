@@ -0,0 +1,174 @@
+import heapq
+from math import radians, degrees, cos, sin, asin, sqrt, pi
+
+EARTH_RADIUS_MILES = 3956
+
+def to_unit_vector(lat, lng):
+    """Converts a lat, lng pair in decimal degrees to a point on the unit sphere."""
+    lat, lng = radians(lat), radians(lng)
+    return (cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat))
+
+def miles_to_chord(miles):
+    """Converts a great circle distance in miles to the straight-line distance between two points on the unit sphere."""
+    angle = miles / float(EARTH_RADIUS_MILES)
+    if angle >= pi:
+        return 2.0
+    return 2 * sin(angle / 2)
+
+def chord_to_miles(chord):
+    """Converts a straight-line distance between two points on the unit sphere to a great circle distance in miles."""
+    return 2 * asin(min(1.0, chord / 2)) * EARTH_RADIUS_MILES
+
+def get_bounding_boxes(lat, lng, miles, padding = 1e-6):
+    """
+    Gets a list of (min_lat, max_lat, min_lng, max_lng) boxes, in decimal degrees, that together contain every point
+    within the given number of miles of a lat, lng point. There are two boxes when the circle crosses the antimeridian.
+    The boxes are padded by a small number of degrees, so that points on the boundary are never lost to rounding.
+    """
+    angle = miles / float(EARTH_RADIUS_MILES)
+    if angle >= pi:
+        return [(-90.0, 90.0, -180.0, 180.0)]
+    min_lat = lat - degrees(angle) - padding
+    max_lat = lat + degrees(angle) + padding
+    if min_lat <= -90 or max_lat >= 90:
+        # The circle contains a pole, so it spans every longitude
+        return [(max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0)]
+    delta_lng = degrees(asin(min(1.0, sin(angle) / cos(radians(lat))))) + padding
+    min_lng, max_lng = lng - delta_lng, lng + delta_lng
+    if min_lng < -180:
+        return [(min_lat, max_lat, min_lng + 360, 180.0), (min_lat, max_lat, -180.0, max_lng)]
+    if max_lng > 180:
+        return [(min_lat, max_lat, min_lng, 180.0), (min_lat, max_lat, -180.0, max_lng - 360)]
+    return [(min_lat, max_lat, min_lng, max_lng)]
+
+class KDTree(object):
+    """
+    A static k-d tree over points on the unit sphere. Since straight-line (chord) distance between
+    two points on the sphere increases with their great circle distance, radius and nearest neighbor
+    searches by chord distance give the same results as they would by great circle distance.
+    """
+    def __init__(self, points, items):
+        """Initializes a KDTree with a list of 3-dimensional points and a list of items stored at each point."""
+        self.size = len(points)
+        self.root = self._build(zip(points, items), 0)
+
+    def _build(self, entries, depth):
+        """Recursively builds a node as a [point, item, axis, left, right] list, splitting entries on their median."""
+        if not entries:
+            return None
+        axis = depth % 3
+        entries.sort(key = lambda e: e[0][axis])
+        median = len(entries) // 2
+        point, item = entries[median]
+        return [point, item, axis, self._build(entries[:median], depth + 1), self._build(entries[median + 1:], depth + 1)]
+
+    def within(self, point, radius):
+        """Gets a list of all items whose points are within the given chord distance of the given point."""
+        found = []
+        radius_sq = radius * radius
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            node_point, item, axis, left, right = node
+            dx = node_point[0] - point[0]
+            dy = node_point[1] - point[1]
+            dz = node_point[2] - point[2]
+            if dx*dx + dy*dy + dz*dz <= radius_sq:
+                found.append(item)
+            diff = point[axis] - node_point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append(near)
+            if diff*diff <= radius_sq:
+                stack.append(far)
+        return found
+
+    def nearest(self, point):
+        """
+        Generates (chord distance, item) tuples for every item in the tree, in increasing order of distance
+        from the given point. Items are found lazily, so stopping early avoids visiting most of the tree.
+        """
+        # Entries are (lower bound on squared distance, tie breaker, is_item, node or item)
+        counter = 0
+        heap = [(0.0, counter, False, self.root)]
+        while heap:
+            bound, _, is_item, entry = heapq.heappop(heap)
+            if is_item:
+                yield sqrt(bound), entry
+                continue
+            if entry is None:
+                continue
+            node_point, item, axis, left, right = entry
+            dx = node_point[0] - point[0]
+            dy = node_point[1] - point[1]
+            dz = node_point[2] - point[2]
+            diff = point[axis] - node_point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            counter += 3
+            heapq.heappush(heap, (dx*dx + dy*dy + dz*dz, counter, True, item))
+            heapq.heappush(heap, (bound, counter + 1, False, near))
+            heapq.heappush(heap, (max(bound, diff*diff), counter + 2, False, far))
+
+class ProviderLocator(object):
+    """
+    Finds providers near a zip code. Providers are grouped by zip code, and a KDTree is built over
+    the geographical centers of those zip codes, so each search only visits nearby providers.
+    """
+    def __init__(self, providers, zipcode_repository):
+        """Initializes a ProviderLocator over a sequence of providers, using the given ZipCodeRepository for their locations.
+
+        Arguments:
+            providers - A sequence of ProviderModels. Providers whose zip codes are missing from the repository
+                are only ever returned by iter_nearest, at an infinite distance.
+            zipcode_repository - The zip code mappings used to locate the providers.
+        """
+        self.zipcode_repository = zipcode_repository
+        self.providers_by_zip = {}
+        self.unlocated = []
+        for p in providers:
+            if p.zip in zipcode_repository.ziphash:
+                self.providers_by_zip.setdefault(p.zip, []).append(p)
+            else:
+                self.unlocated.append(p)
+        zip_codes = list(self.providers_by_zip)
+        points = [self.get_point(z) for z in zip_codes]
+        self.tree = KDTree(points, zip_codes)
+
+    def get_point(self, zip_code):
+        """Gets the point on the unit sphere for the given zip code's geographical center, or None if it is unknown."""
+        try:
+            mapping = self.zipcode_repository.get(zip_code)
+        except KeyError:
+            return None
+        return to_unit_vector(mapping.lat, mapping.lng)
+
+    def within_miles(self, zip_code, miles):
+        """Gets a list of all providers within the given number of miles of the given zip code."""
+        point = self.get_point(zip_code)
+        if point is None:
+            return []
+        providers = []
+        anchor = self.zipcode_repository.get_anchor_distances(zip_code)
+        # Pad the radius slightly, then check each zip code with haversine so that the boundary
+        # agrees exactly with the distances the scorer computes.
+        for z in self.tree.within(point, miles_to_chord(miles) * (1 + 1e-9)):
+            if anchor.get_distance(z) <= miles:
+                providers.extend(self.providers_by_zip[z])
+        return providers
+
+    def iter_nearest(self, zip_code):
+        """
+        Generates (distance in miles, list of providers) tuples, grouped by the providers' zip codes,
+        in increasing order of distance from the given zip code. Distances are computed from the
+        chord between zip codes, and can differ from haversine in the last few bits.
+        """
+        point = self.get_point(zip_code)
+        if point is None:
+            for providers in self.providers_by_zip.itervalues():
+                yield float("inf"), providers
+        else:
+            for chord, z in self.tree.nearest(point):
+                yield chord_to_miles(chord), self.providers_by_zip[z]
+        if self.unlocated:
+            yield float("inf"), self.unlocated
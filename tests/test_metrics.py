@@ -0,0 +1,58 @@
+import csv
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csv_to_sqlite
+from metrics import WEIGHTED_DEFICIENCIES, WeightedMetrics
+
+def write_csv(path, rows):
+    with open(path, "wb") as f:
+        csv.writer(f).writerows(rows)
+
+class WeightedDeficienciesTest(unittest.TestCase):
+    """Checks that the sqlite and CSV passes weigh deficiencies alike, when a tag is given more than one prefix."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.providers_path = os.path.join(self.directory, "providers.csv")
+        self.deficiencies_path = os.path.join(self.directory, "deficiencies.csv")
+        write_csv(self.providers_path, [["provnum", "PROVNAME"], ["P1", "One"], ["P2", "Two"]])
+        # F0880 is first seen with the prefix F, later with G, and with H only by a provider that isn't known
+        write_csv(self.deficiencies_path, [
+            ["provnum", "tag", "defpref", "survey_date_output"],
+            ["P1", "F0880", "F", "2016-01-01"],
+            ["P1", "F0880", "G", "2016-01-01"],
+            ["P2", "F0880", "", "2016-01-01"],
+            ["P2", "K0100", "K", "2016-01-01"],
+            ["PX", "F0880", "H", "2016-01-01"]
+        ])
+        self.metrics = WeightedMetrics([WEIGHTED_DEFICIENCIES], { "F": 2.0, "G": 5.0, "H": 7.0 })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compute_sqlite(self):
+        connection = sqlite3.connect(":memory:")
+        connection.text_factory = str
+        cursor = connection.cursor()
+        for table, path in ((csv_to_sqlite.provider_table, self.providers_path), (csv_to_sqlite.deficiency_table, self.deficiencies_path)):
+            table.create(cursor)
+            table.bulk_load(cursor, path)
+        try:
+            return self.metrics.compute_sqlite(connection)
+        finally:
+            connection.close()
+
+    def test_greatest_prefix_of_a_tag_is_used(self):
+        expected = { "P1": 14.0, "P2": 8.0 }
+        csv_metrics = self.metrics.compute_csv(self.deficiencies_path, None, set(["P1", "P2"]))
+        self.assertEqual(csv_metrics.values[0], expected)
+        self.assertEqual(self.compute_sqlite().values[0], expected)
+
+if __name__ == "__main__":
+    unittest.main()
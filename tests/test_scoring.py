@@ -0,0 +1,86 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import score
+from models import ZipCodeRepository, ProviderRepository
+from score import ArrayScoringEngine, ProviderCdfs, ProviderScorer
+
+# Pairs of points where NumPy's sin, cos, and arcsin give a haversine distance a bit or two away from the math
+# module's: 00001 and 00002 are 6.475 miles apart, 00003 and 00004 15.712, and 00005 and 00006 1611.772
+ZIP_CODES = [
+    ("00001", 30.947335, -87.540868),
+    ("00002", 31.041079, -87.537865),
+    ("00003", 30.649439, -98.145192),
+    ("00004", 30.717476, -97.892685),
+    ("00005", 46.18916, -105.666177),
+    ("00006", 27.468588, -88.004943),
+    ("00007", 32.212319, -118.985327)
+]
+
+# Providers in each zip code, and in ones that aren't known
+PROVIDERS = [
+    ("P1", "00001", 5, 0, 0),
+    ("P2", "00002", 4, 3, 1),
+    ("P3", "00003", 3, 7, 0),
+    ("P4", "00004", 2, 1, 2),
+    ("P5", "00005", 1, 12, 3),
+    ("P6", "00006", 4, 0, 1),
+    ("P7", "00007", 3, 2, 0),
+    ("P8", "00002", 5, 9, 4),
+    ("P9", "00008", 2, 4, 0),
+    ("P10", "99998", 1, 0, 0)
+]
+
+# Anchors near and far from the providers, and one that isn't a known zip code, which every provider is infinitely far from
+ANCHORS = ["00001", "00003", "00006", "00008", "99999"]
+
+def get_scorer():
+    """
+    Gets a tuple of (ProviderScorer, list of providers by number) over new repositories, so that no distances are
+    shared through their AnchorDistances.
+    """
+    zip_repository = ZipCodeRepository([{ "zip_code": z, "lat": lat, "lng": lng } for z, lat, lng in ZIP_CODES])
+    provider_repository = ProviderRepository([{ "num": num, "zip": zip_code, "overall_rating": rating, "num_deficiencies": deficiencies,
+        "num_penalties": penalties } for num, zip_code, rating, deficiencies, penalties in PROVIDERS])
+    cdfs = ProviderCdfs.from_providers(provider_repository.get_all_providers())
+    providers = sorted(provider_repository.get_all_providers(), key = lambda p: p.num)
+    return ProviderScorer(provider_repository, zip_repository, cdfs), providers
+
+def get_fields(providers):
+    return dict((p.num, (getattr(p, "distance_miles", None), p.score)) for p in providers)
+
+@unittest.skipIf(score.numpy is None, "NumPy isn't installed")
+class ArrayScoringEngineTest(unittest.TestCase):
+    """Checks that the NumPy engine gives exactly the distances and scores of the scalar scorer."""
+    def test_scores_match_scalar_scorer(self):
+        for anchor in ANCHORS:
+            scalar, scalar_providers = get_scorer()
+            for p in scalar_providers:
+                scalar.populate_score(p, anchor)
+            array, array_providers = get_scorer()
+            ArrayScoringEngine(array_providers, array).populate_scores(anchor)
+            expected = get_fields(scalar_providers)
+            actual = get_fields(array_providers)
+            self.assertEqual(actual, expected)
+            # Past the end of the commute table, or from an unknown zip code, a score is an integer average
+            for num, (distance, value) in actual.iteritems():
+                self.assertEqual(type(value), type(expected[num][1]))
+
+    def test_combined_scores_match_scalar_scorer(self):
+        for combine, weights in (("min", None), ("mean", None), ("weighted", [1.0, 2.0, 0.5, 3.0])):
+            scalar, scalar_providers = get_scorer()
+            # Without NumPy, the scorer combines the distances itself
+            saved, score.numpy = score.numpy, None
+            try:
+                scalar.populate_combined_scores(scalar_providers, ANCHORS[:4], combine, weights)
+            finally:
+                score.numpy = saved
+            array, array_providers = get_scorer()
+            ArrayScoringEngine(array_providers, array).populate_combined_scores(ANCHORS[:4], combine, weights)
+            self.assertEqual(get_fields(array_providers), get_fields(scalar_providers))
+
+if __name__ == "__main__":
+    unittest.main()
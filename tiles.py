@@ -0,0 +1,166 @@
+import argparse
+import heapq
+import json
+import sqlite3
+import time
+from models import haversine, TileProfileModel, TileRegionModel, ProviderTileModel
+from orm import ModelTableBuilder
+from score import DOT_AVERAGE_COMMUTE_CDF, ProviderScorer, get_distance_percentile
+from spatial import KDTree, miles_to_chord, to_unit_vector
+import snf_search
+
+tile_profile_table = ModelTableBuilder("tile_profile", TileProfileModel)
+tile_region_table = ModelTableBuilder("tile_region", TileRegionModel, { "tile_region_profile_region": ["profile", "region"] })
+provider_tile_table = ModelTableBuilder("provider_tile", ProviderTileModel, { "provider_tile_profile_region": ["profile", "region"] })
+
+# The number of providers kept in each tile by default
+DEFAULT_TILE_SIZE = 200
+# The length of the zip code prefix shared by the zip codes of a region by default. With 5, each zip code is its own region.
+DEFAULT_REGION_DIGITS = 3
+
+# The filters of the searches most often run, with every other filter left at its default
+DEFAULT_PROFILES = [{ "min_overall_rating": rating } for rating in (1, 2, 3, 4)]
+
+# Providers farther than this from a zip code get no credit for their distance from it
+MAX_COMMUTE_MILES = max(DOT_AVERAGE_COMMUTE_CDF)
+
+# Added to each region's radius, so that rounding in haversine can never make a bound too tight
+RADIUS_PADDING_MILES = 1e-6
+
+def get_regions(zip_repository, region_digits):
+    """Gets a dictionary of the zip code mappings with known coordinates in each region, by their shared prefix of region_digits digits."""
+    regions = {}
+    for mapping in zip_repository.ziphash.itervalues():
+        if mapping.lat is not None and mapping.lng is not None:
+            regions.setdefault(mapping.zip_code[:region_digits], []).append(mapping)
+    return regions
+
+def get_bounding_circle(mappings):
+    """
+    Gets a (lat, lng, radius in miles) tuple for a circle containing each of the given zip code mappings. The center
+    is their mean coordinates, which only need to be near the zip codes, since the radius is measured from it.
+    """
+    lat = sum(m.lat for m in mappings) / len(mappings)
+    lng = sum(m.lng for m in mappings) / len(mappings)
+    radius = max(haversine(m.lng, m.lat, lng, lat) for m in mappings)
+    return lat, lng, radius * (1 + 1e-9) + RADIUS_PADDING_MILES
+
+def get_row(table, values):
+    """Gets the values of a row of a ModelTableBuilder's table from a dictionary of them by column name, in the order of its columns."""
+    return [values[name] for name in table.get_column_names()]
+
+def get_profile_args(profile):
+    """Gets search arguments with the filters of a profile dictionary, and every other filter at its default."""
+    return snf_search.parse_query(dict(profile, zip_code = ""))
+
+class TileBuilder(object):
+    """
+    Builds the tiles of a filter profile. For each region, a provider's distance from any zip code in the region is
+    at least its distance from the region's bounding circle, which bounds the score it could have from there. A
+    tile keeps the tile_size providers with the best bounds, and its threshold is the best bound of any other.
+    """
+    def __init__(self, scorer, providers, tile_size):
+        """Initializes a TileBuilder with a ProviderScorer, the providers passing the profile's filters, and the size of each tile."""
+        self.scorer = scorer
+        self.tile_size = tile_size
+        # Beyond commuting distance every provider's bound is its score at any distance, so the
+        # farthest providers rank in the order of their percentiles, best first
+        self.far_percentile = get_distance_percentile(float("inf"))
+        self.entries = []
+        self.entries_by_zip = {}
+        for p in providers:
+            entry = (p, scorer.get_percentiles(p))
+            self.entries.append(entry)
+            self.entries_by_zip.setdefault(p.zip, []).append(entry)
+        self.entries.sort(key = lambda e: (-scorer.get_score(e[1], self.far_percentile), e[0].num))
+
+    def build(self, zip_percentiles):
+        """
+        Builds the tile of a region, given a dictionary of the best distance percentile of any zip code in the region
+        from each provider zip code within commuting distance of it. Returns a tuple of (list of providers, best first, threshold).
+        """
+        # Candidates are (negated bound, provider number, provider) tuples, which sort best first
+        candidates = []
+        for zip_code, distance_percentile in zip_percentiles.iteritems():
+            for p, percentiles in self.entries_by_zip.get(zip_code, ()):
+                candidates.append((-self.scorer.get_score(percentiles, distance_percentile), p.num, p))
+        # Only the best tile_size + 1 of the farther providers could place
+        num_far = 0
+        for p, percentiles in self.entries:
+            if num_far > self.tile_size:
+                break
+            if p.zip not in zip_percentiles:
+                candidates.append((-self.scorer.get_score(percentiles, self.far_percentile), p.num, p))
+                num_far += 1
+        # The worst of the best tile_size + 1 bounds is the threshold, once the tile is full
+        ranked = heapq.nsmallest(self.tile_size + 1, candidates)
+        if len(ranked) <= self.tile_size:
+            return [e[2] for e in ranked], None
+        return [e[2] for e in ranked[:-1]], -ranked[-1][0]
+
+def build_tiles(connection, db_path, profiles = DEFAULT_PROFILES, tile_size = DEFAULT_TILE_SIZE, region_digits = DEFAULT_REGION_DIGITS):
+    """
+    Builds the tiles of each filter profile for each region, replacing any built before.
+
+    Arguments:
+        connection - A connection to the database built by csv_to_sqlite.py.
+        db_path - The path of that database, to load the providers from.
+        profiles (optional) - A list of dictionaries of the filters of each profile, named as the command line arguments are.
+        tile_size (optional) - The number of providers kept in each tile.
+        region_digits (optional) - The length of the zip code prefix shared by the zip codes of each region.
+    """
+    version = snf_search.get_dataset_version([db_path], db_path)
+    zip_repository, provider_repository, cdfs = snf_search.load_sqlite(db_path)
+    scorer = ProviderScorer(provider_repository, zip_repository, cdfs)
+    providers = list(provider_repository.get_all_providers())
+    builders = []
+    for profile in profiles:
+        args = get_profile_args(profile)
+        builders.append((args, TileBuilder(scorer, [p for p in providers if snf_search.passes_filters(p, args)], tile_size)))
+    # The provider zip codes near each region are found through a KDTree
+    mappings = [zip_repository.get(z) for z in set(p.zip for p in providers) if z in zip_repository.ziphash]
+    tree = KDTree([to_unit_vector(m.lat, m.lng) for m in mappings], mappings)
+
+    cursor = connection.cursor()
+    for table in (tile_profile_table, tile_region_table, provider_tile_table):
+        table.drop(cursor)
+        table.create(cursor, indexes = False)
+    for i, (args, builder) in enumerate(builders):
+        cursor.execute(tile_profile_table.get_insert_statement(), get_row(tile_profile_table, { "profile": i, "min_overall_rating": args.min_overall_rating,
+            "max_num_deficiencies": args.max_num_deficiencies, "max_penalties": args.max_penalties, "tile_size": tile_size, "region_digits": region_digits, "version": version }))
+
+    regions = get_regions(zip_repository, region_digits)
+    for region, region_mappings in regions.iteritems():
+        lat, lng, radius = get_bounding_circle(region_mappings)
+        percentiles = {}
+        for mapping in tree.within(to_unit_vector(lat, lng), miles_to_chord(radius + MAX_COMMUTE_MILES) * (1 + 1e-9)):
+            distance = max(0.0, haversine(mapping.lng, mapping.lat, lng, lat) - radius)
+            percentiles[mapping.zip_code] = get_distance_percentile(distance)
+        for i, (args, builder) in enumerate(builders):
+            tile, threshold = builder.build(percentiles)
+            cursor.execute(tile_region_table.get_insert_statement(), get_row(tile_region_table, { "profile": i, "region": region, "threshold": threshold }))
+            cursor.executemany(provider_tile_table.get_insert_statement(),
+                (get_row(provider_tile_table, { "profile": i, "region": region, "rank": rank, "num": p.num }) for rank, p in enumerate(tile)))
+    for table in (tile_region_table, provider_tile_table):
+        table.create_indexes(cursor)
+    connection.commit()
+    return len(regions)
+
+def main():
+    argParser = argparse.ArgumentParser(description="Precomputes the top scoring providers of each zip code region for common search filters, which snf_search.py answers searches from.")
+    argParser.add_argument("--db", dest="db_path", default="snf.db", help="The sqlite database to build tiles in.")
+    argParser.add_argument("--tile_size", dest="tile_size", type=int, default=DEFAULT_TILE_SIZE, help="The number of providers kept for each region.")
+    argParser.add_argument("--region_digits", dest="region_digits", type=int, choices=range(1,6), default=DEFAULT_REGION_DIGITS, help="The length of the zip code prefix shared by the zip codes of each region, or 5 for a tile per zip code.")
+    argParser.add_argument("--profiles", dest="profiles", default=None, help="A JSON list of the filters of each profile, e.g. [{\"min_overall_rating\": 3, \"max_penalties\": 1}].")
+    args = argParser.parse_args()
+
+    profiles = DEFAULT_PROFILES if args.profiles is None else json.loads(args.profiles)
+    connection = sqlite3.connect(args.db_path)
+    connection.text_factory = str
+    start = time.time()
+    num_regions = build_tiles(connection, args.db_path, profiles, args.tile_size, args.region_digits)
+    print "Built tiles of %d profiles for %d regions in %.2fs" % (len(profiles), num_regions, time.time() - start)
+    connection.close()
+
+if __name__ == "__main__":
+    main()